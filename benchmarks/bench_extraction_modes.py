@@ -0,0 +1,108 @@
+"""Compare the 'thread' and 'process' extraction modes.
+
+Runs a batch of extractions through ExtractionScheduler in each mode while a
+thread imitates discord.py's voice sender (wake up every 20 ms, do a little
+Python work) and records how late each wake-up is. Reports that jitter and
+the extraction throughput.
+
+    python benchmarks/bench_extraction_modes.py
+    python benchmarks/bench_extraction_modes.py --query "never gonna give you up"
+
+Without --query a synthetic CPU-bound workload stands in for yt-dlp (JSON
+parsing plus format sorting), so the numbers need no network access.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CACHE_DB_PATH', ':memory:')
+
+import music_bot  # noqa: E402
+
+FRAME = 0.020
+
+def synthetic_extract(seed):
+    """Roughly what extract_info spends its CPU on: parsing and sorting formats."""
+    rng = random.Random(seed)
+    formats = [
+        {'format_id': str(i), 'abr': rng.random() * 256, 'tbr': rng.random() * 4000,
+         'acodec': rng.choice(['opus', 'mp4a.40.2', 'none']), 'url': 'https://example.invalid/' + 'x' * 400}
+        for i in range(400)
+    ]
+    blob = json.dumps({'streamingData': {'adaptiveFormats': formats}, 'padding': ['y' * 200] * 2000})
+    for _ in range(8):
+        data = json.loads(blob)
+        ranked = sorted(data['streamingData']['adaptiveFormats'], key=lambda f: (f['acodec'] != 'opus', -f['abr']))
+    return {'id': str(seed), 'url': ranked[0]['url']}
+
+class VoiceLoopProbe(threading.Thread):
+    """Imitates the voice send loop and records how late each frame fires."""
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.lateness = []
+        self.running = True
+
+    def run(self):
+        start = time.perf_counter()
+        frame = 0
+        buf = bytearray(3840)
+        while self.running:
+            frame += 1
+            target = start + frame * FRAME
+            delay = target - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.lateness.append(max(0.0, time.perf_counter() - target))
+            # A touch of per-frame Python work, like the volume transformer
+            buf[0] = frame & 0xFF
+
+async def run_mode(mode, workers, jobs, query):
+    scheduler = music_bot.ExtractionScheduler(workers, mode=mode)
+    music_bot.extraction_scheduler = scheduler
+    # Warm up the pool so worker start-up isn't counted
+    await asyncio.gather(*(scheduler.run(partial(synthetic_extract, -i)) for i in range(workers)))
+
+    probe = VoiceLoopProbe()
+    probe.start()
+    started = time.perf_counter()
+    if query:
+        await asyncio.gather(*(music_bot.extract_info(f"ytsearch{i + 1}:{query}") for i in range(jobs)))
+    else:
+        await asyncio.gather(*(scheduler.run(partial(synthetic_extract, i)) for i in range(jobs)))
+    elapsed = time.perf_counter() - started
+    probe.running = False
+    probe.join()
+    scheduler._get_executor().shutdown()
+
+    late = sorted(probe.lateness)
+    return {
+        'mode': mode,
+        'throughput': jobs / elapsed,
+        'jitter_p50_ms': statistics.median(late) * 1000,
+        'jitter_p99_ms': late[int(len(late) * 0.99)] * 1000,
+        'jitter_max_ms': late[-1] * 1000,
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=music_bot.EXTRACTION_WORKERS)
+    parser.add_argument('--jobs', type=int, default=40)
+    parser.add_argument('--query', help='run real yt-dlp searches for this query instead of the synthetic load')
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'extract/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for mode in ('thread', 'process'):
+        r = await run_mode(mode, args.workers, args.jobs, args.query)
+        print(f"{r['mode']:<8} {r['throughput']:>10.2f} {r['jitter_p50_ms']:>8.2f} "
+              f"{r['jitter_p99_ms']:>8.2f} {r['jitter_max_ms']:>8.2f}")
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,403 @@
+"""End-to-end benchmarks that need no Discord, YouTube or Spotify.
+
+Drives the bot's real code paths against the stand-ins in fakes.py:
+
+  enqueue   many guilds calling add_to_queue at once
+  playback  short tracks played back to back through the guild player
+  spotify   !play with a Spotify playlist served by a local fake API
+  links     !play with many pasted Spotify track links, then with an album
+  ytplaylist !play with a large YouTube playlist, queued as placeholders
+  strategy  resolving songs while the primary yt-dlp profile fails, fixed vs learned order
+  search    matching Spotify tracks on YouTube: full search vs ranked flat candidates,
+            then again from the Spotify match index
+  controls  MusicControlView button handlers on a playing guild
+
+and reports throughput, p50/p99 latencies and yt-dlp extractions per song.
+
+    python benchmarks/bench_offline.py
+    python benchmarks/bench_offline.py --scenario playback --latency 0.5 --failure-rate 0.1
+    python benchmarks/bench_offline.py --json before.json
+
+yt-dlp latency and failure rate, track length and Spotify latency are all
+configurable; the same seed gives the same sequence of fake failures.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CACHE_DB_PATH', ':memory:')
+os.environ.setdefault('AUDIO_CACHE_MAX_MB', '0')
+os.environ.setdefault('EXTRACTION_MODE', 'thread')
+os.environ.setdefault('PLAYBACK_MODE', 'pcm')
+
+import music_bot  # noqa: E402
+from fakes import (  # noqa: E402
+    FakeContext, FakeGuild, FakeInteraction, FakePCMAudio, FakeSpotifyServer, FakeYoutubeDL, install,
+)
+
+SCENARIOS = ('enqueue', 'playback', 'spotify', 'links', 'ytplaylist', 'strategy', 'search', 'controls')
+BUTTONS = ('play_pause', 'play_pause', 'queue_btn', 'now_btn', 'shuffle_btn', 'loop_btn', 'loop_btn',
+           'loop_btn', 'vol_up', 'vol_down', 'skip_btn')
+
+def percentiles(samples):
+    return {
+        'p50': music_bot._percentile(samples, 50),
+        'p99': music_bot._percentile(samples, 99),
+    }
+
+async def connected_guild(guild_id):
+    guild = FakeGuild(guild_id)
+    await guild.voice_channel.connect()
+    return guild
+
+async def teardown(guilds):
+    for guild in guilds:
+        await music_bot.bot.get_player(guild).disconnect()
+    # Let after() callbacks of the stopped players finish
+    await asyncio.sleep(0.1)
+
+async def bench_enqueue(args):
+    """Every guild queues songs one after another, all guilds at once."""
+    FakePCMAudio.track_seconds = 3600
+    guilds = [await connected_guild(10_000 + i * 16) for i in range(args.guilds)]
+    latencies = []
+
+    async def run_guild(guild):
+        ctx = FakeContext(guild)
+        for n in range(args.songs):
+            started = time.perf_counter()
+            await music_bot.add_to_queue(ctx, f'enqueue {guild.id} song {n}')
+            latencies.append(time.perf_counter() - started)
+
+    FakeYoutubeDL.reset()
+    started = time.perf_counter()
+    await asyncio.gather(*(run_guild(guild) for guild in guilds))
+    elapsed = time.perf_counter() - started
+    songs = args.guilds * args.songs
+    queued = sum(len(music_bot.bot.get_player(g).queue) + (g.voice_client.source is not None) for g in guilds)
+    await teardown(guilds)
+    return {
+        'songs': songs,
+        'queued': queued,
+        'seconds': elapsed,
+        'songs_per_second': songs / elapsed,
+        'add_to_queue': percentiles(latencies),
+        'extractions_per_song': FakeYoutubeDL.calls / songs,
+    }
+
+async def bench_playback(args):
+    """Short tracks back to back: time to first audio and the gaps between tracks."""
+    FakePCMAudio.track_seconds = args.track_seconds
+    guilds = [await connected_guild(20_000 + i * 16) for i in range(args.guilds)]
+    for samples in music_bot.bot.ttfa_samples.values():
+        samples.clear()
+    FakeYoutubeDL.reset()
+    started = time.perf_counter()
+    for guild in guilds:
+        ctx = FakeContext(guild)
+        for n in range(args.tracks):
+            await music_bot.add_to_queue(ctx, f'playback {guild.id} track {n}', silent=True)
+
+    deadline = time.perf_counter() + args.tracks * (args.track_seconds + args.latency * 4 + 2) + 10
+    while time.perf_counter() < deadline:
+        if all(len(g.voice_client.track_ends) >= args.tracks for g in guilds):
+            break
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    gaps = []
+    played = late = frames = 0
+    for guild in guilds:
+        vc = guild.voice_client
+        played += len(vc.track_ends)
+        late += vc.late_frames
+        frames += vc.frames
+        gaps.extend(start - end for end, start in zip(vc.track_ends, vc.first_frames[1:]))
+    ttfa = {kind: percentiles(samples) | {'n': len(samples)}
+            for kind, samples in music_bot.bot.ttfa_samples.items() if samples}
+    await teardown(guilds)
+    return {
+        'tracks': args.guilds * args.tracks,
+        'played': played,
+        'seconds': elapsed,
+        'time_to_first_audio': ttfa,
+        'gap_between_tracks': percentiles(gaps),
+        'late_frame_ratio': late / frames if frames else 0.0,
+        'extractions_per_song': FakeYoutubeDL.calls / max(1, played),
+    }
+
+async def bench_spotify(args):
+    """!play with a Spotify playlist, end to end through the local fake API."""
+    FakePCMAudio.track_seconds = 3600
+    server = await FakeSpotifyServer(latency=args.spotify_latency).start()
+    real_client = music_bot.spotify
+    music_bot.spotify = server.spotify_client(music_bot)
+    guild = FakeGuild(30_000)
+    ctx = FakeContext(guild)
+    FakeYoutubeDL.reset()
+    try:
+        started = time.perf_counter()
+        await music_bot.play.callback(ctx, query=f'https://open.spotify.com/playlist/bench-{args.playlist_size}')
+        elapsed = time.perf_counter() - started
+        vc = guild.voice_client
+        first_audio = vc.play_calls[0] - started if vc and vc.play_calls else None
+        queued = len(music_bot.bot.get_player(guild).queue) + (1 if vc and vc.source is not None else 0)
+    finally:
+        await teardown([guild])
+        await music_bot.spotify.close()
+        music_bot.spotify = real_client
+        await server.stop()
+    return {
+        'tracks': args.playlist_size,
+        'queued': queued,
+        'seconds': elapsed,
+        'tracks_per_second': queued / elapsed if elapsed else 0.0,
+        'first_track_playing_after': first_audio,
+        'spotify_requests': server.requests,
+        'extractions_per_song': FakeYoutubeDL.calls / max(1, queued),
+    }
+
+async def bench_links(args):
+    """!play with pasted track links and with an album; both should use batched Spotify requests."""
+    FakePCMAudio.track_seconds = 3600
+    server = await FakeSpotifyServer(latency=args.spotify_latency).start()
+    real_client, real_matches = music_bot.spotify, music_bot.spotify_matches
+    music_bot.spotify = server.spotify_client(music_bot)
+    # Start without the matches the spotify scenario stored, so every track is searched
+    music_bot.spotify_matches = music_bot.SpotifyMatchIndex(':memory:')
+    links = ' '.join(f"https://open.spotify.com/track/{FakeSpotifyServer.track(10_000 + i)['id']}"
+                     for i in range(args.links))
+    result = {}
+    try:
+        for kind, query in (('links', links), ('album', f'https://open.spotify.com/album/bench-{args.links}')):
+            guild = FakeGuild(50_000 + len(result))
+            ctx = FakeContext(guild)
+            requests = server.requests
+            FakeYoutubeDL.reset()
+            started = time.perf_counter()
+            await music_bot.play.callback(ctx, query=query)
+            elapsed = time.perf_counter() - started
+            vc = guild.voice_client
+            queued = len(music_bot.bot.get_player(guild).queue) + (1 if vc and vc.source is not None else 0)
+            # The import's status message ends up as "Playlist Added"; per-song acks would be "Added to Queue"
+            acks = sum(1 for message in guild.text_channel.sent
+                       if message.embed is not None and 'Added' in (message.embed.title or ''))
+            result[f'{kind}_queued'] = queued
+            result[f'{kind}_seconds'] = elapsed
+            result[f'{kind}_spotify_requests'] = server.requests - requests
+            result[f'{kind}_import_messages'] = acks
+            await teardown([guild])
+    finally:
+        await music_bot.spotify.close()
+        music_bot.spotify, music_bot.spotify_matches = real_client, real_matches
+        await server.stop()
+    return {'tracks': args.links, **result}
+
+async def bench_ytplaylist(args):
+    """!play with a YouTube playlist: entries are listed flat and only resolved when about to play.
+
+    Afterwards the queue is drained without playing, so the rest of the
+    playlist is listed window by window as the player asks for it.
+    """
+    FakePCMAudio.track_seconds = 3600
+    guild = FakeGuild(60_000)
+    ctx = FakeContext(guild)
+    FakeYoutubeDL.reset()
+    started = time.perf_counter()
+    await music_bot.play.callback(ctx, query=f'https://www.youtube.com/playlist?list=PLbench-{args.yt_playlist_size}')
+    elapsed = time.perf_counter() - started
+    vc = guild.voice_client
+    player = music_bot.bot.get_player(guild)
+    # The first song starts on the player's task, after the command returned
+    deadline = time.perf_counter() + 10
+    while vc and not vc.play_calls and time.perf_counter() < deadline:
+        await asyncio.sleep(0.005)
+    first_audio = vc.play_calls[0] - started if vc and vc.play_calls else None
+    queued = len(player.queue) + (1 if vc and vc.source is not None else 0)
+    # The listing and the first song
+    extractions = FakeYoutubeDL.calls
+    listed = queued
+    refills = []
+    player.queue.clear()
+    player.refresh_prefetch()
+    while player._refill_task is not None:
+        refill_started = time.perf_counter()
+        await player._refill_task
+        refills.append(time.perf_counter() - refill_started)
+        listed += len(player.queue)
+        player.queue.clear()
+        player.refresh_prefetch()
+    await teardown([guild])
+    return {
+        'tracks': args.yt_playlist_size,
+        'queued': queued,
+        'seconds': elapsed,
+        'first_track_playing_after': first_audio,
+        'extractions': extractions,
+        'listed_in_total': listed,
+        'refills': len(refills),
+        'refill': percentiles(refills),
+    }
+
+async def bench_strategy(args):
+    """Resolve songs while the primary profile's format fails for every video.
+
+    'fixed' always tries the profiles in their default order; 'adaptive'
+    lets ExtractionStrategies learn to start with the one that works.
+    """
+    requester = FakeContext(FakeGuild(70_000)).author
+    real_cache, real_strategies = music_bot.resolution_cache, music_bot.extraction_strategies
+    FakeYoutubeDL.broken_formats = {music_bot.YTDL_PROFILES['primary']['format']}
+    result = {'songs': args.strategy_songs}
+    try:
+        for mode in ('fixed', 'adaptive'):
+            music_bot.resolution_cache = music_bot.ResolutionCache(':memory:')
+            music_bot.extraction_strategies = music_bot.ExtractionStrategies(':memory:')
+            if mode == 'fixed':
+                music_bot.extraction_strategies.order = lambda source, chain: list(chain)
+            FakeYoutubeDL.reset()
+            timings = []
+            for n in range(args.strategy_songs):
+                started = time.perf_counter()
+                await music_bot.resolve_song(f'https://www.youtube.com/watch?v={mode[:3]}{n:08d}', requester)
+                timings.append(time.perf_counter() - started)
+            result[f'{mode}_resolve'] = percentiles(timings)
+            result[f'{mode}_extractions_per_song'] = FakeYoutubeDL.calls / args.strategy_songs
+    finally:
+        FakeYoutubeDL.broken_formats = set()
+        music_bot.resolution_cache, music_bot.extraction_strategies = real_cache, real_strategies
+    return result
+
+async def bench_search(args):
+    """Match Spotify tracks with a full search (first result) and with ranked flat candidates.
+
+    The 'indexed' run repeats the flat one with an empty resolution cache but
+    the match index it filled, as another guild playing the same tracks would.
+    """
+    tracks = [music_bot.spotify_track_info(FakeSpotifyServer.track(i)) for i in range(args.search_tracks)]
+    real_cache, real_matches = music_bot.resolution_cache, music_bot.spotify_matches
+    real_candidates = music_bot.SEARCH_CANDIDATES
+    result = {'tracks': len(tracks), 'candidates': args.candidates}
+    try:
+        for mode, candidates in (('full', 0), ('flat', args.candidates), ('indexed', args.candidates)):
+            # Every track misses the cache; only the indexed run keeps the previous matches
+            music_bot.resolution_cache = music_bot.ResolutionCache(':memory:')
+            if mode != 'indexed':
+                music_bot.spotify_matches = music_bot.SpotifyMatchIndex(':memory:')
+            music_bot.SEARCH_CANDIDATES = candidates
+            FakeYoutubeDL.reset()
+            started = time.perf_counter()
+            urls = await asyncio.gather(*(
+                music_bot.search_youtube(track['search_query'], track=track, priority=music_bot.PRIORITY_BULK)
+                for track in tracks
+            ))
+            result[f'{mode}_seconds'] = time.perf_counter() - started
+            result[f'{mode}_extraction_seconds_per_track'] = FakeYoutubeDL.seconds / len(tracks)
+            result[f'{mode}_correct_matches'] = sum(
+                bool(url) and url.endswith(FakeYoutubeDL.expected_id(track['search_query']))
+                for url, track in zip(urls, tracks)
+            ) / len(tracks)
+    finally:
+        music_bot.resolution_cache, music_bot.spotify_matches = real_cache, real_matches
+        music_bot.SEARCH_CANDIDATES = real_candidates
+    result['extraction_time_saved'] = 1 - result['flat_extraction_seconds_per_track'] / result['full_extraction_seconds_per_track']
+    return result
+
+async def bench_controls(args):
+    """Press every control button in turn while a queue is playing."""
+    FakePCMAudio.track_seconds = 3600
+    guild = await connected_guild(40_000)
+    ctx = FakeContext(guild)
+    latency = FakeYoutubeDL.latency
+    FakeYoutubeDL.latency = 0.0
+    for n in range(args.rounds + 5):
+        await music_bot.add_to_queue(ctx, f'controls track {n}', silent=True)
+    FakeYoutubeDL.latency = latency
+    await asyncio.sleep(0.2)
+
+    view = music_bot.MusicControlView(music_bot.bot)
+    timings = {name: [] for name in BUTTONS}
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        for name in BUTTONS:
+            interaction = FakeInteraction(guild)
+            pressed = time.perf_counter()
+            await getattr(view, name).callback(interaction)
+            timings[name].append(time.perf_counter() - pressed)
+        # Give the player a moment to start the song after the skipped one
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+    view.stop()
+    await teardown([guild])
+    presses = args.rounds * len(BUTTONS)
+    return {
+        'presses': presses,
+        'seconds': elapsed,
+        'buttons': {name: percentiles(samples) for name, samples in timings.items()},
+    }
+
+def ms(value):
+    return '-' if value is None else f'{value * 1000:.1f} ms'
+
+def report(name, result):
+    print(f'== {name}')
+    for key, value in result.items():
+        if isinstance(value, dict) and 'p50' in value:
+            print(f'  {key:<28} p50 {ms(value["p50"])}  p99 {ms(value["p99"])}')
+        elif isinstance(value, dict):
+            for sub, stats in value.items():
+                extra = f'  n={stats["n"]}' if 'n' in stats else ''
+                print(f'  {key + " / " + sub:<28} p50 {ms(stats["p50"])}  p99 {ms(stats["p99"])}{extra}')
+        elif isinstance(value, float):
+            print(f'  {key:<28} {value:.3f}')
+        else:
+            print(f'  {key:<28} {value}')
+
+async def main(args):
+    install(music_bot, latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate, seed=args.seed)
+    # Sets bot.loop and friends without logging in
+    await music_bot.bot._async_setup_hook()
+    benches = {'enqueue': bench_enqueue, 'playback': bench_playback, 'spotify': bench_spotify,
+               'links': bench_links, 'ytplaylist': bench_ytplaylist, 'strategy': bench_strategy,
+               'search': bench_search,
+               'controls': bench_controls}
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        # The bot prints every failure; keep the report readable unless asked
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+            results[name] = await benches[name](args)
+        report(name, results[name])
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmarks.')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='run only these (repeatable)')
+    parser.add_argument('--latency', type=float, default=0.1, help='mean fake yt-dlp latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.3, help='latency varies by +/- this fraction')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of yt-dlp calls that fail')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--songs', type=int, default=10, help='songs queued per guild (enqueue)')
+    parser.add_argument('--tracks', type=int, default=8, help='tracks played per guild (playback)')
+    parser.add_argument('--track-seconds', type=float, default=0.5, help='length of each fake track (playback)')
+    parser.add_argument('--playlist-size', type=int, default=250, help='tracks in the Spotify playlist')
+    parser.add_argument('--spotify-latency', type=float, default=0.05)
+    parser.add_argument('--yt-playlist-size', type=int, default=2000, help='videos in the YouTube playlist')
+    parser.add_argument('--links', type=int, default=120, help='track links pasted, and album size (links)')
+    parser.add_argument('--strategy-songs', type=int, default=40, help='songs resolved per mode (strategy)')
+    parser.add_argument('--search-tracks', type=int, default=100, help='Spotify tracks matched (search)')
+    parser.add_argument('--candidates', type=int, default=5, help='flat search results ranked per track (search)')
+    parser.add_argument('--rounds', type=int, default=20, help='times each button is pressed (controls)')
+    parser.add_argument('--json', metavar='PATH', help='also write the results to a JSON file')
+    parser.add_argument('--verbose', action='store_true', help="show the bot's own output")
+    args = parser.parse_args()
+    results = asyncio.run(main(args))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
@@ -0,0 +1,99 @@
+"""Memory used by queued songs: per-song dicts vs QueueEntry.
+
+Builds 100k queue entries both ways and measures what stays allocated with
+tracemalloc. The dict version holds a Member-like object per requester, as
+the old queue did; the QueueEntry version keeps only the requester's ID and
+display name, so those objects can be freed.
+
+    python benchmarks/bench_queue_memory.py [--entries 100000] [--requesters 500]
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CACHE_DB_PATH', ':memory:')
+
+import music_bot  # noqa: E402
+
+class FakeMember:
+    """Stand-in for discord.Member with a similar number of attributes."""
+    def __init__(self, i):
+        self.id = 10**17 + i
+        self.display_name = f"user{i}"
+        self.name = f"user{i}"
+        self.nick = None
+        self.roles = [object() for _ in range(3)]
+        self.joined_at = None
+        self.avatar = f"avatar{i}"
+        self.guild = None
+        self.activities = ()
+        self.flags = 0
+
+def make_infos(n, seed=0):
+    rng = random.Random(seed)
+    uploaders = [f"Channel {i}" for i in range(300)]
+    for i in range(n):
+        # Fresh string objects, like the ones json/yt-dlp hand back
+        yield {
+            'id': f"{i:011d}",
+            'webpage_url': f"https://www.youtube.com/watch?v={i:011d}",
+            'title': f"Song number {i}",
+            'duration': rng.randint(120, 420),
+            'thumbnail': f"https://i.ytimg.com/vi/{i:011d}/hqdefault.jpg",
+            'uploader': ''.join(rng.choice(uploaders)),
+        }
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    queue = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, len(queue)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=100_000)
+    parser.add_argument('--requesters', type=int, default=500)
+    args = parser.parse_args()
+
+    def build_dicts():
+        members = [FakeMember(i) for i in range(args.requesters)]
+        queue = deque()
+        for i, info in enumerate(make_infos(args.entries)):
+            queue.append({
+                'id': info['id'],
+                'url': info['webpage_url'],
+                'title': info['title'],
+                'duration': info['duration'],
+                'thumbnail': info['thumbnail'],
+                'uploader': info['uploader'],
+                'requester': members[i % len(members)],
+                'resolved': None,
+            })
+        return queue
+
+    def build_entries():
+        members = [FakeMember(i) for i in range(args.requesters)]
+        queue = deque()
+        for i, info in enumerate(make_infos(args.entries)):
+            entry = music_bot.song_from_info(info, members[i % len(members)])
+            entry.resolved = None
+            queue.append(entry)
+        return queue
+
+    old, n = measure(build_dicts)
+    new, _ = measure(build_entries)
+    print(f"{n} entries")
+    print(f"dict + Member : {old / 1024 / 1024:8.2f} MiB ({old / n:6.0f} B/entry)")
+    print(f"QueueEntry    : {new / 1024 / 1024:8.2f} MiB ({new / n:6.0f} B/entry)")
+    print(f"saved         : {(old - new) / old:8.1%}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,542 @@
+"""Local stand-ins for YouTube, Spotify and Discord voice, for offline runs.
+
+    import fakes
+    fakes.install(music_bot, latency=0.2, failure_rate=0.05, track_seconds=3)
+
+install() swaps yt-dlp's YoutubeDL and discord.FFmpegPCMAudio for fakes.
+Contexts, guilds and voice clients are built from the classes below.
+FakeSpotifyServer is a real HTTP server on localhost; point
+music_bot.spotify at it with spotify_client(). Only the 'thread' extraction
+mode and 'pcm' playback mode are covered, since worker processes and the
+Opus path spawn real yt-dlp/ffmpeg.
+"""
+import asyncio
+import random
+import socket
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import discord
+import yt_dlp
+from aiohttp import web
+
+FRAME_SECONDS = 0.02
+FRAME_BYTES = 3840  # 20 ms of 48 kHz stereo 16-bit PCM
+
+def song_seconds(terms):
+    """Length of the song a search for `terms` is after; Spotify and YouTube fakes agree on it."""
+    return 180 + zlib.crc32(terms.encode()) % 120
+
+class FakeYoutubeDL:
+    """yt_dlp.YoutubeDL with a configurable delay and failure rate.
+
+    Settings and counters are class attributes, shared by every instance the
+    bot creates. `latency` is the mean delay in seconds of resolving one
+    video, varied by +/- `jitter`. A search resolves every result it returns
+    unless the profile uses extract_flat, which only lists them and costs
+    `flat_cost` of one resolution. `seconds` adds up all simulated delays.
+
+    A search for "name artist" finds a few versions of the song; the one
+    expected_id() names has the right title and length (song_seconds).
+    """
+    latency = 0.1
+    jitter = 0.3
+    failure_rate = 0.0
+    # Profiles whose 'format' is in here fail every video, after the usual delay
+    broken_formats = set()
+    flat_cost = 0.3
+    calls = 0
+    searches = 0
+    failures = 0
+    seconds = 0.0
+    _rng = random.Random(0)
+    _lock = threading.Lock()
+
+    def __init__(self, params=None, *args, **kwargs):
+        self.params = params or {}
+
+    @classmethod
+    def configure(cls, *, latency=None, jitter=None, failure_rate=None, seed=0):
+        if latency is not None:
+            cls.latency = latency
+        if jitter is not None:
+            cls.jitter = jitter
+        if failure_rate is not None:
+            cls.failure_rate = failure_rate
+        cls._rng = random.Random(seed)
+        cls.reset()
+
+    @classmethod
+    def reset(cls):
+        cls.calls = cls.searches = cls.failures = 0
+        cls.seconds = 0.0
+
+    @staticmethod
+    def expected_id(terms):
+        return f'{zlib.crc32(terms.encode()):011d}'
+
+    @classmethod
+    def candidates(cls, terms):
+        """(id, title, duration) of every version a search for `terms` finds, in YouTube's order."""
+        seconds = song_seconds(terms)
+        found = [
+            (cls.expected_id(terms), f'{terms} (Official Audio)', seconds),
+            (cls.expected_id(terms + ' video'), f'{terms} (Official Video)', seconds + 25),
+            (cls.expected_id(terms + ' cover'), f'{terms} cover', seconds + 4),
+            (cls.expected_id(terms + ' remix'), f'{terms} Remix', seconds + 60),
+            (cls.expected_id(terms + ' live'), f'{terms} (Live)', seconds + 40),
+        ]
+        if zlib.crc32(terms.encode()) % 3 == 0:
+            # Sometimes a live version ranks first
+            found.insert(0, found.pop())
+        return found
+
+    def extract_info(self, query, download=False, **kwargs):
+        search = not query.startswith(('http://', 'https://'))
+        playlist_id = None if search else parse_qs(urlparse(query).query).get('list', [None])[0]
+        if playlist_id and self.params.get('noplaylist') is False:
+            return self._playlist(playlist_id)
+        count = 1
+        if search and query.startswith('ytsearch'):
+            prefix, terms = query.split(':', 1)
+            count = int(prefix[len('ytsearch'):] or 1)
+        elif search:
+            # Plain text is a search, as with default_search='ytsearch'
+            terms = query
+        flat = search and bool(self.params.get('extract_flat'))
+        cost = self.flat_cost if flat else count
+        with self._lock:
+            FakeYoutubeDL.calls += 1
+            delay = max(0.0, cost * self.latency * (1 + self.jitter * (2 * self._rng.random() - 1)))
+            fail = self._rng.random() < self.failure_rate
+            FakeYoutubeDL.seconds += delay
+        time.sleep(delay)
+        if fail:
+            with self._lock:
+                FakeYoutubeDL.failures += 1
+            raise yt_dlp.utils.DownloadError(f'simulated failure for {query}')
+        if self.params.get('format') in self.broken_formats:
+            raise yt_dlp.utils.DownloadError(f'ERROR: [youtube] {query}: Requested format is not available')
+        if search:
+            with self._lock:
+                FakeYoutubeDL.searches += 1
+            found = self.candidates(terms)[:count]
+            if flat:
+                return {'entries': [
+                    {'_type': 'url', 'id': video_id, 'title': title, 'duration': float(duration),
+                     'url': f'https://www.youtube.com/watch?v={video_id}', 'channel': 'Fake Channel'}
+                    for video_id, title, duration in found
+                ]}
+            return {'entries': [self._video(video_id, title, duration) for video_id, title, duration in found]}
+        video_id = parse_qs(urlparse(query).query).get('v', [query.rsplit('/', 1)[-1]])[0]
+        return self._video(video_id, None)
+
+    def _playlist(self, playlist_id):
+        """Flat listing of a playlist; 'PLbench-2000' has 2000 videos.
+
+        Like YouTube, the listing comes 100 entries a page and reaching an
+        entry means fetching every page before it, each costing `flat_cost`.
+        """
+        try:
+            size = int(playlist_id.rsplit('-', 1)[-1])
+        except ValueError:
+            size = 50
+        start = self.params.get('playliststart', 1) - 1
+        end = min(size, self.params.get('playlistend') or size)
+        if self.params.get('playlist_items'):
+            # Only the 'first-last' form is used
+            first, last = self.params['playlist_items'].split('-')
+            start, end = int(first) - 1, min(size, int(last))
+        pages = max(1, -(-end // 100))
+        with self._lock:
+            FakeYoutubeDL.calls += 1
+            delay = max(0.0, pages * self.flat_cost * self.latency * (1 + self.jitter * (2 * self._rng.random() - 1)))
+            FakeYoutubeDL.seconds += delay
+        time.sleep(delay)
+        return {
+            'id': playlist_id,
+            'title': f'Playlist {playlist_id}',
+            'entries': [
+                {'_type': 'url', 'id': f'{playlist_id}.{i}', 'title': f'{playlist_id} video {i}',
+                 'duration': float(180 + i % 120), 'url': f'https://www.youtube.com/watch?v={playlist_id}.{i}',
+                 'channel': 'Fake Channel'}
+                for i in range(start, end)
+            ],
+        }
+
+    @staticmethod
+    def _video(video_id, title, duration=None):
+        return {
+            'id': video_id,
+            'title': title or f'Video {video_id}',
+            'duration': duration or 180 + zlib.crc32(video_id.encode()) % 120,
+            'uploader': f'Channel {zlib.crc32(video_id.encode()) % 50}',
+            'thumbnail': f'https://i.ytimg.com/vi/{video_id}/hqdefault.jpg',
+            'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+            'url': f'https://rr1.googlevideo.com/videoplayback?expire={int(time.time()) + 6 * 3600}&id={video_id}',
+            'http_headers': {'User-Agent': 'fake'},
+            'acodec': 'opus',
+            'ext': 'webm',
+        }
+
+    def prepare_filename(self, info):
+        return f"{info['id']}.{info.get('ext', 'webm')}"
+
+class FakePCMAudio(discord.AudioSource):
+    """Replaces discord.FFmpegPCMAudio: silent PCM for `track_seconds`.
+
+    The first read waits `startup` seconds, like ffmpeg opening a stream.
+    """
+    track_seconds = 3.0
+    startup = 0.05
+
+    def __init__(self, source, **kwargs):
+        self.url = source
+        self.frames_left = int(self.track_seconds / FRAME_SECONDS)
+        self.started = False
+
+    def read(self):
+        if not self.started:
+            self.started = True
+            time.sleep(self.startup)
+        if self.frames_left <= 0:
+            return b''
+        self.frames_left -= 1
+        return b'\0' * FRAME_BYTES
+
+    def is_opus(self):
+        return False
+
+class FakeVoiceClient:
+    """Plays sources like discord.py's AudioPlayer: one read every 20 ms.
+
+    Records when each source was handed over and when its first and last
+    frames were read, so callers can measure start-up time and gaps.
+    """
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self._source = None
+        self._playing = False
+        self._stop = threading.Event()
+        self._resume = threading.Event()
+        self._connected = True
+        self.frames = 0
+        self.late_frames = 0
+        self.play_calls = []
+        self.first_frames = []
+        self.track_ends = []
+        self.finished = threading.Event()
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, value):
+        self._source = value
+        self._resume.set()
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._playing and self._resume.is_set()
+
+    def is_paused(self):
+        return self._playing and not self._resume.is_set()
+
+    def play(self, source, *, after=None, **kwargs):
+        if self._playing:
+            raise discord.ClientException('Already playing audio.')
+        self._source = source
+        self._playing = True
+        self._stop = threading.Event()
+        self._resume = threading.Event()
+        self._resume.set()
+        self.finished.clear()
+        self.play_calls.append(time.perf_counter())
+        threading.Thread(target=self._run, args=(after, self._stop, self._resume), daemon=True).start()
+
+    def _run(self, after, stop, resume):
+        next_frame = time.perf_counter()
+        first = True
+        error = None
+        try:
+            while not stop.is_set():
+                if not resume.is_set():
+                    resume.wait()
+                    next_frame = time.perf_counter()
+                    continue
+                data = self._source.read()
+                if not data:
+                    break
+                now = time.perf_counter()
+                if first:
+                    # Start-up time is measured separately; pace from here
+                    self.first_frames.append(now)
+                    first = False
+                    next_frame = now
+                self.frames += 1
+                next_frame += FRAME_SECONDS
+                delay = next_frame - now
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.late_frames += 1
+                    next_frame = now
+        except Exception as e:
+            error = e
+        self.track_ends.append(time.perf_counter())
+        source = self._source
+        self._playing = False
+        self.finished.set()
+        if after is not None:
+            after(error)
+        source.cleanup()
+
+    def pause(self):
+        self._resume.clear()
+
+    def resume(self):
+        self._resume.set()
+
+    def stop(self):
+        self._stop.set()
+        self._resume.set()
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self._connected = False
+        if self.guild.voice_client is self:
+            self.guild.voice_client = None
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None, view=None):
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.view = view
+        self.edits = 0
+
+    async def edit(self, **kwargs):
+        self.edits += 1
+        self.embed = kwargs.get('embed', self.embed)
+        self.view = kwargs.get('view', self.view)
+
+class FakeTextChannel:
+    def __init__(self, channel_id, name='music'):
+        self.id = channel_id
+        self.name = name
+        self.sent = []
+
+    async def send(self, content=None, *, embed=None, view=None, **kwargs):
+        message = FakeMessage(self, content, embed, view)
+        self.sent.append(message)
+        return message
+
+class FakeVoiceChannel(FakeTextChannel):
+    def __init__(self, guild, channel_id, name='Voice'):
+        super().__init__(channel_id, name)
+        self.guild = guild
+        self.members = []
+
+    async def connect(self, **kwargs):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+class FakeMember:
+    def __init__(self, member_id, name, channel=None, bot=False):
+        self.id = member_id
+        self.display_name = name
+        self.name = name
+        self.bot = bot
+        self.voice = SimpleNamespace(channel=channel) if channel else None
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f'Guild {guild_id}'
+        self.voice_client = None
+        self.voice_channel = FakeVoiceChannel(self, guild_id + 1)
+        self.text_channel = FakeTextChannel(guild_id + 2)
+        self.listener = FakeMember(guild_id + 3, 'listener', self.voice_channel)
+        self.voice_channel.members.append(self.listener)
+
+    def get_channel(self, channel_id):
+        return {self.voice_channel.id: self.voice_channel, self.text_channel.id: self.text_channel}.get(channel_id)
+
+class FakeContext:
+    """commands.Context as seen by the command callbacks and add_to_queue."""
+    def __init__(self, guild, author=None):
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.author = author or guild.listener
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+class FakeInteraction:
+    """A button press from `user`, enough for MusicControlView's handlers."""
+    def __init__(self, guild, user=None):
+        self.guild = guild
+        self.user = user or guild.listener
+        self.messages = []
+        self._done = False
+        self.response = SimpleNamespace(is_done=lambda: self._done, send_message=self._respond)
+        self.followup = SimpleNamespace(send=self._followup)
+
+    async def _respond(self, content=None, **kwargs):
+        self._done = True
+        self.messages.append(content or kwargs.get('embed'))
+
+    async def _followup(self, content=None, **kwargs):
+        self.messages.append(content or kwargs.get('embed'))
+
+class FakeSpotifyServer:
+    """The Spotify Web API endpoints the bot uses, served from localhost.
+
+    Every request waits `latency` seconds. Playlists and albums are generated
+    from their ID: 'bench-250' has 250 tracks. Pages hold `page_size` tracks
+    (albums at most 50, as on Spotify); every artist has 10 top tracks.
+    """
+    def __init__(self, *, latency=0.05, page_size=100):
+        self.latency = latency
+        self.page_size = page_size
+        self.requests = 0
+        self.base = None
+        self._runner = None
+
+    @staticmethod
+    def track(index):
+        return {
+            'id': f'fake{index:018d}',
+            'name': f'Song {index}',
+            'duration_ms': song_seconds(f'Song {index} Artist {index % 37}') * 1000,
+            'external_ids': {'isrc': f'QZFAKE{index:06d}'},
+            'artists': [{'name': f'Artist {index % 37}'}],
+        }
+
+    @staticmethod
+    def _size(playlist_id):
+        try:
+            return int(playlist_id.rsplit('-', 1)[-1])
+        except ValueError:
+            return 50
+
+    async def _delay(self):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+    async def _token(self, request):
+        await self._delay()
+        return web.json_response({'access_token': 'fake-token', 'token_type': 'Bearer', 'expires_in': 3600})
+
+    @staticmethod
+    def _index(track_id):
+        return int(track_id[4:] or 0)
+
+    async def _track(self, request):
+        await self._delay()
+        return web.json_response(self.track(self._index(request.match_info['id'])))
+
+    async def _tracks(self, request):
+        await self._delay()
+        ids = request.query['ids'].split(',')
+        if len(ids) > 50:
+            return web.json_response({'error': 'too many ids'}, status=400)
+        return web.json_response({'tracks': [self.track(self._index(track_id)) for track_id in ids]})
+
+    def _album_page(self, album_id, offset, limit):
+        size = self._size(album_id)
+        limit = min(limit, self.page_size, 50)
+        end = min(offset + limit, size)
+        # Album tracks are simplified objects: no ISRC
+        items = [{k: v for k, v in self.track(i).items() if k != 'external_ids'} for i in range(offset, end)]
+        next_url = f'{self.base}/v1/albums/{album_id}/tracks?offset={end}&limit={limit}' if end < size else None
+        return {'items': items, 'next': next_url, 'total': size}
+
+    async def _album(self, request):
+        await self._delay()
+        album_id = request.match_info['id']
+        return web.json_response({'name': f'Album {album_id}', 'artists': [{'name': 'Artist 0'}],
+                                  'tracks': self._album_page(album_id, 0, 50)})
+
+    async def _album_tracks(self, request):
+        await self._delay()
+        return web.json_response(self._album_page(request.match_info['id'], int(request.query.get('offset', 0)),
+                                                  int(request.query.get('limit', 50))))
+
+    async def _artist(self, request):
+        await self._delay()
+        return web.json_response({'name': f"Artist {request.match_info['id']}"})
+
+    async def _artist_top_tracks(self, request):
+        await self._delay()
+        if 'market' not in request.query:
+            return web.json_response({'error': 'market required'}, status=400)
+        return web.json_response({'tracks': [self.track(i) for i in range(10)]})
+
+    async def _playlist(self, request):
+        await self._delay()
+        playlist_id = request.match_info['id']
+        return web.json_response({'name': f'Playlist {playlist_id}', 'tracks': {'total': self._size(playlist_id)}})
+
+    async def _playlist_tracks(self, request):
+        await self._delay()
+        playlist_id = request.match_info['id']
+        size = self._size(playlist_id)
+        offset = int(request.query.get('offset', 0))
+        limit = min(int(request.query.get('limit', self.page_size)), self.page_size)
+        end = min(offset + limit, size)
+        next_url = f'{self.base}/v1/playlists/{playlist_id}/tracks?offset={end}&limit={limit}' if end < size else None
+        return web.json_response({
+            'items': [{'track': self.track(i)} for i in range(offset, end)],
+            'next': next_url,
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/api/token', self._token)
+        app.router.add_get('/v1/tracks', self._tracks)
+        app.router.add_get('/v1/tracks/{id}', self._track)
+        app.router.add_get('/v1/albums/{id}', self._album)
+        app.router.add_get('/v1/albums/{id}/tracks', self._album_tracks)
+        app.router.add_get('/v1/artists/{id}', self._artist)
+        app.router.add_get('/v1/artists/{id}/top-tracks', self._artist_top_tracks)
+        app.router.add_get('/v1/playlists/{id}', self._playlist)
+        app.router.add_get('/v1/playlists/{id}/tracks', self._playlist_tracks)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.base = f'http://127.0.0.1:{sock.getsockname()[1]}'
+        await web.SockSite(self._runner, sock).start()
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def spotify_client(self, music_bot):
+        return music_bot.SpotifyClient('fake-id', 'fake-secret', api_base=f'{self.base}/v1',
+                                       token_url=f'{self.base}/api/token')
+
+def install(music_bot, *, latency=None, jitter=None, failure_rate=None, track_seconds=None, seed=0):
+    """Point music_bot at the fakes. Call before the bot does any work."""
+    FakeYoutubeDL.configure(latency=latency, jitter=jitter, failure_rate=failure_rate, seed=seed)
+    if track_seconds is not None:
+        FakePCMAudio.track_seconds = track_seconds
+    # music_bot imports yt_dlp lazily and builds its YoutubeDL instances on first use
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    discord.FFmpegPCMAudio = FakePCMAudio
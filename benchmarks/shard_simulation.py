@@ -0,0 +1,139 @@
+"""Simulate a sharded deployment locally, without connecting to Discord.
+
+Splits the shards into clusters the way shard_launcher.py does and starts
+one process per cluster with SHARD_COUNT/SHARD_IDS set. It then routes
+every simulated guild to the process that owns the guild's shard, as the
+gateway would. Each process queues tracks through the normal add_to_queue
+path and snapshots its player state into one shared SQLite file. yt-dlp,
+ffmpeg and the voice connection are replaced with the fakes in fakes.py.
+
+The run checks that:
+  - every guild reaches exactly one process, and that process owns it
+  - each process holds queue state only for its own guilds
+  - each process restores only its own guilds' snapshots from the shared DB
+
+    python benchmarks/shard_simulation.py [--shards 8] [--per-process 3] [--guilds 200]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from shard_launcher import shard_clusters  # noqa: E402
+
+def fake_guild_ids(count, seed=0):
+    """Snowflake-shaped guild IDs spread over the last few years."""
+    rng = random.Random(seed)
+    ids = set()
+    while len(ids) < count:
+        ms = rng.randint(0, 9 * 365 * 24 * 3600 * 1000)
+        ids.add((ms << 22) | rng.randint(0, (1 << 22) - 1))
+    return sorted(ids)
+
+def run_cluster(shard_ids, shard_count, db_path, guild_ids, tracks):
+    """Entry point of one simulated shard process."""
+    os.environ.update(
+        SHARD_COUNT=str(shard_count),
+        SHARD_IDS=','.join(map(str, shard_ids)),
+        CACHE_DB_PATH=db_path,
+        AUDIO_CACHE_MAX_MB='0',
+    )
+    return asyncio.run(_run_cluster(guild_ids, tracks))
+
+async def _run_cluster(guild_ids, tracks):
+    import music_bot
+    from fakes import FakeContext, FakeGuild, FakeYoutubeDL, install
+
+    install(music_bot, latency=0.002, track_seconds=3600)
+    bot = music_bot.bot
+    await bot._async_setup_hook()
+    guilds = {guild_id: FakeGuild(guild_id) for guild_id in guild_ids}
+    for guild in guilds.values():
+        await guild.voice_channel.connect()
+    bot.get_guild = guilds.get
+    type(bot).voice_clients = property(lambda self: [g.voice_client for g in guilds.values() if g.voice_client])
+
+    misrouted = [guild_id for guild_id in guild_ids if not bot.owns_guild(guild_id)]
+    started = time.perf_counter()
+    for guild_id in guild_ids:
+        ctx = FakeContext(guilds[guild_id])
+        for n in range(tracks):
+            await music_bot.add_to_queue(ctx, f'https://www.youtube.com/watch?v={guild_id % 10**6:06d}{n:05d}')
+    bot.snapshot_state()
+    elapsed = time.perf_counter() - started
+    result = {
+        'shards': list(bot.shard_ids),
+        'received': list(guild_ids),
+        'misrouted': misrouted,
+        'state_guilds': sorted(guild_id for guild_id, player in bot.players.items() if player.queue or player.current),
+        'restorable': sorted(music_bot.player_state.pending(bot.owns_guild)),
+        'extractions': FakeYoutubeDL.calls,
+        'elapsed': elapsed,
+    }
+    for guild in guilds.values():
+        await guild.voice_client.disconnect()
+    # Let the stopped players' after() callbacks run before the loop closes
+    await asyncio.sleep(0.2)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a sharded deployment locally.')
+    parser.add_argument('--shards', type=int, default=8)
+    parser.add_argument('--per-process', type=int, default=3)
+    parser.add_argument('--guilds', type=int, default=200)
+    parser.add_argument('--tracks', type=int, default=3, help='tracks queued per guild')
+    args = parser.parse_args()
+
+    # Route with the bot's own formula; each process then checks it owns what it got
+    os.environ.setdefault('CACHE_DB_PATH', ':memory:')
+    os.environ.setdefault('AUDIO_CACHE_MAX_MB', '0')
+    from music_bot import shard_of
+
+    clusters = shard_clusters(args.shards, args.per_process)
+    guild_ids = fake_guild_ids(args.guilds)
+    routed = {index: [] for index in range(len(clusters))}
+    cluster_of_shard = {shard: index for index, shard_ids in enumerate(clusters) for shard in shard_ids}
+    for guild_id in guild_ids:
+        routed[cluster_of_shard[shard_of(guild_id, args.shards)]].append(guild_id)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bot_cache.sqlite3')
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(len(clusters)) as pool:
+            results = pool.starmap(run_cluster, [
+                (shard_ids, args.shards, db_path, routed[index], args.tracks)
+                for index, shard_ids in enumerate(clusters)
+            ])
+
+    failures = []
+    seen = set()
+    for index, result in enumerate(results):
+        received = set(result['received'])
+        print(f"process {index}: shards {result['shards']}, {len(received)} guilds, "
+              f"{result['extractions']} extractions in {result['elapsed']:.2f}s")
+        if result['misrouted']:
+            failures.append(f"process {index} does not own {len(result['misrouted'])} guilds routed to it")
+        if set(result['state_guilds']) - received:
+            failures.append(f"process {index} holds state for guilds it never saw")
+        if set(result['restorable']) != received:
+            failures.append(f"process {index} would restore {len(result['restorable'])} guilds, expected {len(received)}")
+        if seen & received:
+            failures.append(f"process {index} shares guilds with another process")
+        seen |= received
+    if seen != set(guild_ids):
+        failures.append(f"{len(set(guild_ids) - seen)} guilds were not handled by any process")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("OK" if not failures else f"{len(failures)} check(s) failed")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
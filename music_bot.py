@@ -1,14 +1,29 @@
+import time
+# Startup timings are measured from here, so they include the imports below
+PROCESS_STARTED = time.perf_counter()
 import discord
 from discord.ext import commands
 import asyncio
 import os
-import yt_dlp
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+import aiohttp
+from aiohttp import web
 from dotenv import load_dotenv
 import re
-from collections import deque
+import json
+import sqlite3
+import subprocess
+import threading
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from urllib.parse import urlparse, parse_qs
 import random
+import sys
+import multiprocessing
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import partial
 
 # Load environment variables
 load_dotenv()
@@ -17,6 +32,11 @@ load_dotenv()
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
+# Overridable so the Spotify layer can be pointed at a local stand-in server
+SPOTIFY_API_BASE = os.getenv('SPOTIFY_API_BASE', 'https://api.spotify.com/v1')
+SPOTIFY_TOKEN_URL = os.getenv('SPOTIFY_TOKEN_URL', 'https://accounts.spotify.com/api/token')
+# Market used for artist top tracks (required with client-credentials tokens)
+SPOTIFY_MARKET = os.getenv('SPOTIFY_MARKET', 'US')
 
 # Optional yt-dlp cookie support (helps with age/region restricted videos)
 YTDLP_COOKIE_FILE = os.getenv('YTDLP_COOKIE_FILE')  # Path to cookies.txt (Netscape format)
@@ -30,11 +50,179 @@ USER_AGENT = (
     "Chrome/127.0.0.0 Safari/537.36"
 )
 
-# Initialize Spotify client
-spotify = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(
-    client_id=SPOTIFY_CLIENT_ID,
-    client_secret=SPOTIFY_CLIENT_SECRET
-))
+class SpotifyError(Exception):
+    pass
+
+class SpotifyAuthError(SpotifyError):
+    """Missing or rejected credentials: no request can work until the config is fixed."""
+
+class SpotifyClient:
+    """Async Spotify Web API client using the client-credentials flow.
+
+    Requests go through aiohttp so a slow Spotify response never blocks the
+    event loop. The access token is cached until shortly before it expires.
+    """
+    # Refresh the token this many seconds before Spotify says it expires
+    TOKEN_MARGIN = 60
+    MAX_RETRIES = 3
+    # Most IDs GET /tracks accepts in one request
+    BATCH_TRACKS = 50
+
+    def __init__(self, client_id, client_secret, *, api_base=SPOTIFY_API_BASE, token_url=SPOTIFY_TOKEN_URL):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.api_base = api_base.rstrip('/')
+        self.token_url = token_url
+        self._session = None
+        self._token = None
+        self._token_expires = 0.0
+        self._token_lock = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _get_token(self, *, force=False):
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        async with self._token_lock:
+            if not force and self._token and time.time() < self._token_expires:
+                return self._token
+            if not self.client_id or not self.client_secret:
+                raise SpotifyAuthError("Spotify credentials are not configured")
+            auth = aiohttp.BasicAuth(self.client_id, self.client_secret)
+            started = time.perf_counter()
+            async with self._get_session().post(self.token_url, data={'grant_type': 'client_credentials'}, auth=auth) as resp:
+                if resp.status != 200:
+                    if resp.status in (400, 401, 403):
+                        raise SpotifyAuthError(f"Spotify rejected the client credentials (HTTP {resp.status})")
+                    raise SpotifyError(f"Token request failed with HTTP {resp.status}")
+                payload = await resp.json()
+            SPOTIFY_SECONDS.observe(time.perf_counter() - started, 'token')
+            self._token = payload['access_token']
+            self._token_expires = time.time() + payload.get('expires_in', 3600) - self.TOKEN_MARGIN
+            return self._token
+
+    async def get(self, path, params=None):
+        """GET an API path (or a full `next` URL) and return the JSON body."""
+        url = path if path.startswith('http') else f"{self.api_base}/{path.lstrip('/')}"
+        # First path segment ('tracks', 'playlists', ...) keeps the metric's label set small
+        endpoint = 'other'
+        if url.startswith(self.api_base):
+            endpoint = url[len(self.api_base):].lstrip('/').split('/', 1)[0].split('?', 1)[0]
+        token = await self._get_token()
+        for attempt in range(self.MAX_RETRIES + 1):
+            headers = {'Authorization': f'Bearer {token}'}
+            started = time.perf_counter()
+            async with self._get_session().get(url, params=params, headers=headers) as resp:
+                if resp.status == 200:
+                    body = await resp.json()
+                    SPOTIFY_SECONDS.observe(time.perf_counter() - started, endpoint)
+                    return body
+                SPOTIFY_SECONDS.observe(time.perf_counter() - started, endpoint)
+                if attempt < self.MAX_RETRIES:
+                    if resp.status == 401:
+                        token = await self._get_token(force=True)
+                        continue
+                    if resp.status == 429 or resp.status >= 500:
+                        delay = float(resp.headers.get('Retry-After', 2 ** attempt))
+                        await asyncio.sleep(min(delay, 30))
+                        continue
+                raise SpotifyError(f"GET {url} failed with HTTP {resp.status}")
+
+    async def track(self, track_id):
+        return await self.get(f'tracks/{track_id}')
+
+    async def playlist(self, playlist_id):
+        return await self.get(f'playlists/{playlist_id}', params={'fields': 'name,tracks.total'})
+
+    async def album(self, album_id):
+        """The album, with its first page of tracks."""
+        return await self.get(f'albums/{album_id}')
+
+    async def artist(self, artist_id):
+        return await self.get(f'artists/{artist_id}')
+
+    async def artist_top_tracks(self, artist_id, market=SPOTIFY_MARKET):
+        body = await self.get(f'artists/{artist_id}/top-tracks', params={'market': market})
+        return body.get('tracks') or []
+
+    async def _iter_pages(self, page):
+        """Yield the items of a paged response starting at `page`, following `next` links.
+
+        The next page is requested while the current one is being consumed,
+        so callers can start on the first items right away.
+        """
+        pending = None
+        try:
+            while page is not None:
+                pending = asyncio.ensure_future(self.get(page['next'])) if page.get('next') else None
+                for item in page.get('items') or []:
+                    yield item
+                page = await pending if pending is not None else None
+                pending = None
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def iter_playlist_tracks(self, playlist_id):
+        """Yield every track of a playlist, page by page."""
+        fields = 'next,items(track(id,name,duration_ms,external_ids,artists(name)))'
+        page = await self.get(f'playlists/{playlist_id}/tracks', params={'limit': 100, 'fields': fields})
+        items = self._iter_pages(page)
+        try:
+            async for item in items:
+                if item.get('track'):
+                    yield item['track']
+        finally:
+            await items.aclose()
+
+    async def iter_album_tracks(self, album):
+        """Yield every track of an album returned by album(), page by page."""
+        items = self._iter_pages(album['tracks'])
+        try:
+            async for track in items:
+                yield track
+        finally:
+            await items.aclose()
+
+    async def iter_tracks(self, track_ids):
+        """Yield the tracks for `track_ids` in order, BATCH_TRACKS per request.
+
+        IDs Spotify doesn't know are skipped. Like the page iterators, the
+        next batch is requested while the current one is being consumed.
+        """
+        batches = [track_ids[i:i + self.BATCH_TRACKS] for i in range(0, len(track_ids), self.BATCH_TRACKS)]
+        pending = None
+        try:
+            for index, batch in enumerate(batches):
+                current = pending or asyncio.ensure_future(self.get('tracks', params={'ids': ','.join(batch)}))
+                pending = None
+                if index + 1 < len(batches):
+                    pending = asyncio.ensure_future(
+                        self.get('tracks', params={'ids': ','.join(batches[index + 1])})
+                    )
+                body = await current
+                for track in body.get('tracks') or []:
+                    if track:
+                        yield track
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+# Created on first use by get_spotify(); may be replaced (e.g. by the benchmarks)
+spotify = None
+
+def get_spotify():
+    global spotify
+    if spotify is None:
+        spotify = SpotifyClient(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
+    return spotify
 
 # yt-dlp configuration (robust defaults + retries + headers)
 ytdl_format_options = {
@@ -74,97 +262,2630 @@ elif YTDLP_COOKIES_FROM_BROWSER:
     # Best effort: use cookies from installed browser
     ytdl_format_options['cookiesfrombrowser'] = (YTDLP_BROWSER, )
 
-# FFmpeg configuration with explicit headers and user-agent
-ffmpeg_before_headers = (
-    f'-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 '
-    f'-user_agent "{USER_AGENT}" '
-    f'-headers "User-Agent: {USER_AGENT}\r\nAccept-Language: en-US,en;q=0.9" '
-    f'-nostdin'
-)
+# FFmpeg configuration with explicit headers and user-agent
+ffmpeg_before_headers = (
+    f'-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 '
+    f'-user_agent "{USER_AGENT}" '
+    f'-headers "User-Agent: {USER_AGENT}\r\nAccept-Language: en-US,en;q=0.9" '
+    f'-nostdin'
+)
+
+ffmpeg_options = {
+    'before_options': ffmpeg_before_headers,
+    'options': '-vn'
+}
+
+# Stream URLs are refreshed this many seconds before they expire
+STREAM_EXPIRY_MARGIN = 60
+# Assumed lifetime of a stream URL that carries no expiry hint
+STREAM_DEFAULT_TTL = 60 * 60
+# On-disk cache of query -> video resolutions
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', 'bot_cache.sqlite3')
+RESOLUTION_CACHE_TTL = int(os.getenv('RESOLUTION_CACHE_TTL', str(7 * 24 * 3600)))
+RESOLUTION_CACHE_MAX_ENTRIES = int(os.getenv('RESOLUTION_CACHE_MAX_ENTRIES', '50000'))
+# Seconds between writes of cache bookkeeping (last-used times) kept in memory
+CACHE_FLUSH_INTERVAL = float(os.getenv('CACHE_FLUSH_INTERVAL', '30'))
+# Local copies of frequently played tracks (AUDIO_CACHE_MAX_MB=0 disables)
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'audio_cache')
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_MB', '2048')) * 1024 * 1024
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv('AUDIO_CACHE_MIN_PLAYS', '3'))
+# Workers dedicated to yt-dlp extraction (shared by every guild)
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', '4'))
+# 'thread' or 'process'; process mode keeps yt-dlp's CPU work off the bot's GIL
+EXTRACTION_MODE = os.getenv('EXTRACTION_MODE', 'thread').lower()
+# A yt-dlp profile failing this share of its recent attempts is skipped for
+# EXTRACTION_BREAKER_COOLDOWN seconds (see ExtractionStrategies)
+EXTRACTION_BREAKER_RATIO = float(os.getenv('EXTRACTION_BREAKER_RATIO', '0.8'))
+EXTRACTION_BREAKER_COOLDOWN = float(os.getenv('EXTRACTION_BREAKER_COOLDOWN', '60'))
+# Share of extractions that start with a profile other than the learned best,
+# so one that lost before gets another chance
+EXTRACTION_EXPLORE_RATE = float(os.getenv('EXTRACTION_EXPLORE_RATE', '0.05'))
+# Seconds between saves of what the bot learned about the profiles
+EXTRACTION_STATS_SAVE_INTERVAL = float(os.getenv('EXTRACTION_STATS_SAVE_INTERVAL', '60'))
+# Playlist imports: tracks resolved in parallel, max tracks taken, seconds between progress edits
+PLAYLIST_CONCURRENCY = int(os.getenv('PLAYLIST_CONCURRENCY', '4'))
+PLAYLIST_MAX_TRACKS = int(os.getenv('PLAYLIST_MAX_TRACKS', '500'))
+PLAYLIST_PROGRESS_INTERVAL = 2.0
+# YouTube playlists and mixes: entries listed per extraction (playback starts
+# after the first; the next is listed as the queue drains), and the most
+# entries taken from one playlist
+YOUTUBE_PLAYLIST_PAGE = int(os.getenv('YOUTUBE_PLAYLIST_PAGE', '100'))
+YOUTUBE_PLAYLIST_MAX_TRACKS = int(os.getenv('YOUTUBE_PLAYLIST_MAX_TRACKS', '5000'))
+# The next window of a YouTube playlist is listed once fewer songs than this are queued;
+# a window that fails to list is tried this many times, backing off from the delay
+PLAYLIST_REFILL_AT = max(1, YOUTUBE_PLAYLIST_PAGE // 4)
+PLAYLIST_REFILL_ATTEMPTS = 3
+PLAYLIST_REFILL_RETRY_DELAY = 5.0
+# Leave out imported tracks that are already queued or playing
+DEDUPE_IMPORTS = os.getenv('DEDUPE_IMPORTS', '').lower() in ('1', 'true', 'yes', 'y')
+# Spotify tracks are matched from this many flat (unresolved) YouTube search
+# results, ranked by title, artist and duration. 0 = full search, first result.
+SEARCH_CANDIDATES = int(os.getenv('SEARCH_CANDIDATES', '5'))
+# Stored Spotify matches scoring below this (see match_score) are searched again
+SPOTIFY_MATCH_MIN_CONFIDENCE = float(os.getenv('SPOTIFY_MATCH_MIN_CONFIDENCE', '0.5'))
+# Message sends/edits run at once per channel (see MessageScheduler)
+MESSAGE_CONCURRENCY = 4
+# "Added to Queue" for songs added within this many seconds of each other
+# goes into one message, edited at most every QUEUE_SUMMARY_INTERVAL seconds
+QUEUE_SUMMARY_WINDOW = 15.0
+QUEUE_SUMMARY_INTERVAL = 2.0
+# 'pcm': decode to PCM and scale volume in Python (volume changes are instant)
+# 'opus': send ffmpeg's Opus packets as-is; Opus sources are copied without
+#         transcoding while the volume is 100%, otherwise ffmpeg applies the volume
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'pcm').lower()
+DEFAULT_VOLUME = float(os.getenv('DEFAULT_VOLUME', '1.0' if PLAYBACK_MODE == 'opus' else '0.5'))
+# Discord audio frames are 20 ms
+FRAME_SECONDS = 0.02
+# Also start ffmpeg for the next track ahead of time (costs one idle process per guild)
+PREFETCH_FFMPEG = os.getenv('PREFETCH_FFMPEG', '').lower() in ('1', 'true', 'yes', 'y')
+# Seconds between player-state snapshots used for warm restarts (0 disables)
+PLAYER_SNAPSHOT_INTERVAL = float(os.getenv('PLAYER_SNAPSHOT_INTERVAL', '15'))
+# Snapshots older than this are not restored
+PLAYER_STATE_MAX_AGE = int(os.getenv('PLAYER_STATE_MAX_AGE', str(6 * 3600)))
+# Guilds rejoined at the same time after a restart
+RESTORE_CONCURRENCY = 3
+# Tries to start a song before skipping it, and failed songs in a row before the player gives up
+PLAY_ATTEMPTS = int(os.getenv('PLAY_ATTEMPTS', '2'))
+MAX_FAILED_TRACKS = int(os.getenv('MAX_FAILED_TRACKS', '5'))
+# Seconds to wait after a failed start; doubled for each further failure
+PLAY_RETRY_DELAY = 1.0
+# Sharding: total shard count (unset = Discord's recommendation) and the shard IDs
+# this process runs (unset = all of them). shard_launcher.py sets both per process.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(i) for i in os.getenv('SHARD_IDS', '').split(',') if i.strip()] or None
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics (METRICS_PORT=0 disables)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+# Once the bot is ready, import yt-dlp, build YoutubeDL instances and fetch a
+# Spotify token in the background instead of on the first request
+STARTUP_WARMUP = os.getenv('STARTUP_WARMUP', '1').lower() in ('1', 'true', 'yes', 'y')
+
+# ===== Metrics =====
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, le=None):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for values, total in self._values.items():
+                lines.append(f'{self.name}{_format_labels(self.labels, values)} {total}')
+        return lines
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for values, series in self._values.items():
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labels, values, le=bound)} {count}')
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, values, le="+Inf")} {series[-2]}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labels, values)} {series[-1]}')
+                lines.append(f'{self.name}_count{_format_labels(self.labels, values)} {series[-2]}')
+        return lines
+
+class Gauge:
+    """A value read when the endpoint is scraped.
+
+    `collect` returns a number, or a dict of label-value tuples to numbers.
+    """
+    def __init__(self, name, help_text, collect, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self._runner = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f"Could not collect metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+    async def start(self, host, port):
+        """Serve the metrics in Prometheus text format on http://host:port/metrics."""
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8',
+                                headers={'X-Content-Type-Options': 'nosniff'})
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics = MetricsRegistry()
+EXTRACT_SECONDS = metrics.register(Histogram(
+    'musicbot_extract_seconds', 'yt-dlp extract_info duration, including time queued for a worker', ('profile',)))
+EXTRACT_FAILURES = metrics.register(Counter(
+    'musicbot_extract_failures_total', 'Failed extract_info calls', ('profile',)))
+FALLBACKS = metrics.register(Counter(
+    'musicbot_extraction_fallbacks_total', 'Extractions retried with a more permissive profile', ('path',)))
+EXTRACTION_ATTEMPTS = metrics.register(Counter(
+    'musicbot_extraction_attempts_total', 'Strategy attempts by profile and result (ok or error class)',
+    ('profile', 'result')))
+TTFA_SECONDS = metrics.register(Histogram(
+    'musicbot_time_to_first_audio_seconds', 'From starting a song to its first audio frame', ('kind',)))
+SPOTIFY_SECONDS = metrics.register(Histogram(
+    'musicbot_spotify_request_seconds', 'Spotify Web API request latency', ('endpoint',)))
+FAILURES = metrics.register(Counter(
+    'musicbot_failures_total', 'Errors by the stage they happened in', ('stage',)))
+DISCORD_WRITE_SECONDS = metrics.register(Histogram(
+    'musicbot_discord_write_seconds', 'Message sends and edits, including time queued per channel', ('op',)))
+SPOTIFY_MATCH_LOOKUPS = metrics.register(Counter(
+    'musicbot_spotify_match_lookups_total', 'Spotify match index lookups by result (hit, weak, miss)', ('result',)))
+YTDL_BUILD_SECONDS = metrics.register(Histogram(
+    'musicbot_ytdl_build_seconds', 'Time to construct a YoutubeDL instance', ('profile',)))
+YTDL_POOL_WAIT_SECONDS = metrics.register(Histogram(
+    'musicbot_ytdl_pool_wait_seconds', 'Time an extraction waited for a free YoutubeDL instance', ('profile',)))
+# Seconds from PROCESS_STARTED to each startup phase: import, login, ready, warm
+startup_seconds = {}
+
+def mark_startup(phase):
+    """Record when `phase` was first reached; returns False if it already was."""
+    if phase in startup_seconds:
+        return False
+    startup_seconds[phase] = time.perf_counter() - PROCESS_STARTED
+    print(f'Startup: {phase} after {startup_seconds[phase]:.2f}s')
+    return True
+
+metrics.register(Gauge(
+    'musicbot_startup_seconds', 'Seconds from process start to each startup phase',
+    lambda: {(phase,): seconds for phase, seconds in startup_seconds.items()}, ('phase',)))
+# Sources whose ffmpeg process may still be running (see the ffmpeg gauge)
+_ffmpeg_sources = weakref.WeakSet()
+
+def _live_ffmpeg_processes():
+    return sum(
+        1 for source in list(_ffmpeg_sources)
+        if isinstance(getattr(source, '_process', None), subprocess.Popen) and source._process.poll() is None
+    )
+
+
+def _with_cookies(opts):
+    # propagate cookies settings if any
+    if 'cookiefile' in ytdl_format_options:
+        opts['cookiefile'] = ytdl_format_options['cookiefile']
+    if 'cookiesfrombrowser' in ytdl_format_options:
+        opts['cookiesfrombrowser'] = ytdl_format_options['cookiesfrombrowser']
+    return opts
+
+# Named yt-dlp option sets, tried by name so they can also be used in worker processes
+YTDL_PROFILES = {
+    'primary': ytdl_format_options,
+    # Retry with more permissive settings after the primary options fail
+    'fallback': _with_cookies({
+        'format': 'bestaudio/best/18/worst',
+        'quiet': True,
+        'no_warnings': True,
+        'default_search': 'ytsearch',
+        'source_address': '0.0.0.0',
+        'http_headers': ytdl_format_options.get('http_headers'),
+        'extractor_args': ytdl_format_options.get('extractor_args'),
+        'geo_bypass': True,
+        'extractor_retries': 2
+    }),
+    # Like fallback, but tolerates per-entry errors (used when queueing)
+    'permissive': _with_cookies({
+        'format': 'bestaudio/best/18/worst',
+        'quiet': True,
+        'no_warnings': True,
+        'default_search': 'ytsearch',
+        'extract_flat': False,
+        'ignoreerrors': True,
+        'http_headers': ytdl_format_options.get('http_headers'),
+        'extractor_args': ytdl_format_options.get('extractor_args'),
+        'geo_bypass': True
+    }),
+    # Background downloads into the local audio cache, stored by video ID
+    'audio_cache': {
+        **ytdl_format_options,
+        'format': 'bestaudio[acodec=opus]/bestaudio/best',
+        'outtmpl': os.path.join(AUDIO_CACHE_DIR, '%(id)s.%(ext)s'),
+        'restrictfilenames': False,
+    },
+    # Search result listings only: titles, channels and durations, no formats
+    'search': {
+        **ytdl_format_options,
+        'extract_flat': 'in_playlist',
+    },
+    # YouTube playlist/mix listings, entries only, one window of items per
+    # extraction (see PlaylistFeed)
+    'playlist': {
+        **ytdl_format_options,
+        'noplaylist': False,
+        'extract_flat': 'in_playlist',
+    },
+    # !forceplay: alternative settings for problematic videos
+    'forceplay': {
+        'format': 'worst[ext=mp4]/worst[ext=webm]/worst',
+        'quiet': True,
+        'no_warnings': True,
+        'default_search': 'ytsearch',
+        'ignoreerrors': True,
+        'extract_flat': False
+    },
+}
+
+def load_yt_dlp():
+    """Import yt_dlp on first use: it is the slowest import by far and
+    nothing needs it before the first song is requested."""
+    import yt_dlp
+    return yt_dlp
+
+# Used on the event loop thread only (prepare_filename); extractions use ytdl_pools
+_ytdl = None
+
+def get_ytdl():
+    global _ytdl
+    if _ytdl is None:
+        _ytdl = load_yt_dlp().YoutubeDL(ytdl_format_options)
+    return _ytdl
+
+class YoutubeDLPool:
+    """Reusable YoutubeDL instances for one profile.
+
+    YoutubeDL isn't safe to share between threads, and building one reloads
+    cookies and sets up every extractor. A job checks an instance out, uses
+    it on its own thread and puts it back. Instances are built on demand up
+    to `size` (or ahead of time with warm()) and then reused.
+    """
+    def __init__(self, profile, size):
+        self.profile = profile
+        self.size = size
+        self.built = 0
+        self._idle = []
+        self._cond = threading.Condition()
+
+    def _build(self):
+        started = time.perf_counter()
+        ydl = load_yt_dlp().YoutubeDL(YTDL_PROFILES[self.profile])
+        YTDL_BUILD_SECONDS.observe(time.perf_counter() - started, self.profile)
+        return ydl
+
+    def acquire(self):
+        """Take an idle instance, build one if below `size`, or wait. Blocks."""
+        started = time.perf_counter()
+        with self._cond:
+            while not self._idle and self.built >= self.size:
+                self._cond.wait()
+            ydl = self._idle.pop() if self._idle else None
+            if ydl is None:
+                self.built += 1
+        YTDL_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, self.profile)
+        if ydl is None:
+            try:
+                ydl = self._build()
+            except BaseException:
+                with self._cond:
+                    self.built -= 1
+                    self._cond.notify()
+                raise
+        return ydl
+
+    def release(self, ydl):
+        with self._cond:
+            self._idle.append(ydl)
+            self._cond.notify()
+
+    def extract_info(self, query, download=False, items=None):
+        ydl = self.acquire()
+        try:
+            if items is None:
+                return ydl.extract_info(query, download=download)
+            # The instance is checked out, so its params can be changed for this call
+            ydl.params['playlist_items'] = items
+            try:
+                return ydl.extract_info(query, download=download)
+            finally:
+                ydl.params.pop('playlist_items', None)
+        finally:
+            self.release(ydl)
+
+    def warm(self, count):
+        """Build instances until `count` exist (at most `size`). Blocks."""
+        while True:
+            with self._cond:
+                if self.built >= min(count, self.size):
+                    return
+                self.built += 1
+            try:
+                ydl = self._build()
+            except BaseException:
+                with self._cond:
+                    self.built -= 1
+                raise
+            self.release(ydl)
+
+    def stats(self):
+        with self._cond:
+            return {'built': self.built, 'idle': len(self._idle), 'size': self.size}
+
+# Never more extractions at once than there are extraction workers
+ytdl_pools = {profile: YoutubeDLPool(profile, EXTRACTION_WORKERS) for profile in YTDL_PROFILES}
+# Built at startup: one instance per extraction worker for the primary profile,
+# one for each fallback so the first retry doesn't pay for construction either
+YTDL_WARM_COUNTS = {'primary': EXTRACTION_WORKERS, 'search': 1, 'fallback': 1, 'permissive': 1, 'forceplay': 1}
+
+def warm_ytdl_pools():
+    for profile, count in YTDL_WARM_COUNTS.items():
+        try:
+            ytdl_pools[profile].warm(count)
+        except Exception as e:
+            print(f"Could not pre-build YoutubeDL instances for {profile}: {e}")
+            FAILURES.inc('ytdl_warm')
+
+metrics.register(Gauge(
+    'musicbot_ytdl_instances', 'YoutubeDL instances built, per profile',
+    lambda: {(profile,): pool.built for profile, pool in ytdl_pools.items()}, ('profile',)))
+
+# Fields of an extract_info() result worth keeping around after resolution
+INFO_KEYS = (
+    'id', 'title', 'duration', 'thumbnail', 'uploader', 'channel', 'webpage_url',
+    'url', 'http_headers', 'extractor', 'ext', 'acodec', 'abr', 'asr',
+)
+
+def trim_info(data):
+    """Drop the heavy parts (formats, thumbnails list, etc.) of an info dict."""
+    return {k: data[k] for k in INFO_KEYS if data.get(k) is not None}
+
+# Format fields kept for !formats when results cross a process boundary
+FORMAT_KEYS = ('format_id', 'ext', 'acodec', 'vcodec', 'abr', 'tbr')
+
+def trim_result(info):
+    """Small, picklable copy of an extract_info() result (entries included)."""
+    if info is None:
+        return None
+    out = trim_info(info)
+    if info.get('entries') is not None:
+        out['entries'] = [trim_result(entry) for entry in info['entries']]
+    if info.get('formats'):
+        out['formats'] = [{k: f.get(k) for k in FORMAT_KEYS} for f in info['formats']]
+    return out
+
+# Warm YoutubeDL instances, one per profile, inside each extraction worker process
+_worker_ytdls = {}
+
+def _init_extraction_worker():
+    _worker_ytdls['primary'] = load_yt_dlp().YoutubeDL(YTDL_PROFILES['primary'])
+
+def _process_extract(profile, query, download, items=None):
+    """extract_info() entry point for worker processes."""
+    ydl = _worker_ytdls.get(profile)
+    if ydl is None:
+        ydl = _worker_ytdls[profile] = load_yt_dlp().YoutubeDL(YTDL_PROFILES[profile])
+    if items is None:
+        return trim_result(ydl.extract_info(query, download=download))
+    ydl.params['playlist_items'] = items
+    try:
+        return trim_result(ydl.extract_info(query, download=download))
+    finally:
+        ydl.params.pop('playlist_items', None)
+
+def parse_stream_expiry(url):
+    """Return the unix time a googlevideo stream URL expires at, or None."""
+    if not url:
+        return None
+    parsed = urlparse(url)
+    values = parse_qs(parsed.query).get('expire')
+    if not values:
+        # Some manifests carry the parameters in the path: /expire/1700000000/...
+        m = re.search(r'/expire/(\d+)', parsed.path)
+        values = [m.group(1)] if m else None
+    try:
+        return float(values[0]) if values else None
+    except ValueError:
+        return None
+
+def ffmpeg_options_for(headers=None, position=0.0, local=False):
+    """FFmpeg options that send the headers yt-dlp says the stream needs.
+
+    A non-zero `position` (seconds) seeks the input before decoding. Local
+    files get no HTTP options at all.
+    """
+    if local:
+        before = '-nostdin'
+    elif not headers:
+        before = ffmpeg_options['before_options']
+    else:
+        user_agent = headers.get('User-Agent', USER_AGENT)
+        header_lines = ''.join(
+            f'{k}: {v}\r\n' for k, v in headers.items() if k.lower() != 'user-agent'
+        )
+        before = (
+            f'-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 '
+            f'-user_agent "{user_agent}" '
+            f'-headers "{header_lines}" '
+            f'-nostdin'
+        )
+    if position > 0:
+        before = f'-ss {position:.2f} {before}'
+    return {'before_options': before, 'options': ffmpeg_options['options']}
+
+class ResolvedTrack:
+    """A direct audio URL for a track, valid until `expires_at`."""
+    __slots__ = ('stream_url', 'headers', 'expires_at', 'data', 'local')
+
+    def __init__(self, stream_url, *, headers=None, expires_at=None, data=None, local=False):
+        self.stream_url = stream_url
+        self.headers = headers or {}
+        self.expires_at = expires_at or (time.time() + STREAM_DEFAULT_TTL)
+        self.data = data or {}
+        # A file in the audio cache rather than a remote stream
+        self.local = local
+
+    @classmethod
+    def from_info(cls, data):
+        """Build from an extract_info() entry; None if it has no stream URL."""
+        if not data or not data.get('url'):
+            return None
+        return cls(
+            data['url'],
+            headers=data.get('http_headers'),
+            expires_at=parse_stream_expiry(data['url']),
+            data=trim_info(data),
+        )
+
+    def is_valid(self, margin=STREAM_EXPIRY_MARGIN):
+        return time.time() + margin < self.expires_at
+
+# Video metadata worth caching; stream URLs expire, so they are left out
+CACHED_KEYS = ('id', 'webpage_url', 'title', 'duration', 'thumbnail', 'uploader')
+
+_YOUTUBE_ID_RE = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([A-Za-z0-9_-]{11})'
+)
+
+def normalize_query(query):
+    """Cache key for a search query or URL.
+
+    YouTube video URLs collapse to their video ID; other URLs are kept as-is
+    (IDs are case-sensitive) and free-text queries are case/space-folded.
+    """
+    query = query.strip()
+    m = _YOUTUBE_ID_RE.search(query)
+    if m:
+        return f'yt:{m.group(1)}'
+    if query.startswith(('http://', 'https://')):
+        return f'url:{query}'
+    return 'q:' + ' '.join(query.lower().split())
+
+class CacheStore:
+    """Base of the stores kept in the cache database.
+
+    The connection is opened by open(), which the bot calls in setup_hook, or
+    on first use. Extraction worker processes import this module too but
+    never use the stores, so they never open the database.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._open_lock = threading.Lock()
+
+    def open(self):
+        with self._open_lock:
+            if self._db is None:
+                conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                conn.execute('PRAGMA journal_mode=WAL')
+                # With WAL, commits no longer wait for fsync; a crash loses at most the last few
+                conn.execute('PRAGMA synchronous=NORMAL')
+                self._setup(conn)
+                self._db = conn
+        return self._db
+
+    @property
+    def _conn(self):
+        return self._db or self.open()
+
+    def _setup(self, conn):
+        """Create the store's tables and load what it keeps in memory."""
+        raise NotImplementedError
+
+class ResolutionCache(CacheStore):
+    """Persistent map from normalized queries / Spotify track IDs to videos.
+
+    Entries expire after `ttl` seconds. Once there are more than
+    `max_entries`, the least recently used ones are evicted. Hits only note
+    their last-used time in memory; flush() writes them in one transaction.
+    """
+    def __init__(self, path, *, ttl=RESOLUTION_CACHE_TTL, max_entries=RESOLUTION_CACHE_MAX_ENTRIES):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> last use not written yet
+        self._touched = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _setup(self, conn):
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS resolutions ('
+            ' key TEXT PRIMARY KEY, video_id TEXT, data TEXT NOT NULL,'
+            ' created REAL NOT NULL, last_used REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS resolutions_last_used ON resolutions(last_used)')
+        self._count = conn.execute('SELECT COUNT(*) FROM resolutions').fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT data, created FROM resolutions WHERE key = ?', (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute('DELETE FROM resolutions WHERE key = ?', (key,))
+                    self._touched.pop(key, None)
+                    self._count -= 1
+                self.misses += 1
+                return None
+            self._touched[key] = now
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, data):
+        info = {k: data[k] for k in CACHED_KEYS if data.get(k) is not None}
+        if not info.get('webpage_url'):
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO resolutions (key, video_id, data, created, last_used) VALUES (?, ?, ?, ?, ?)',
+                (key, info.get('id'), json.dumps(info, separators=(',', ':')), now, now),
+            )
+            self._touched.pop(key, None)
+            # INSERT OR REPLACE reports 1 row either way; re-count only when over the cap
+            self._count += 1
+            if self._count > self.max_entries:
+                # Evict by the real last-used times
+                self._write_touched()
+                self._count = self._conn.execute('SELECT COUNT(*) FROM resolutions').fetchone()[0]
+                excess = self._count - self.max_entries
+                if excess > 0:
+                    self._conn.execute(
+                        'DELETE FROM resolutions WHERE key IN '
+                        '(SELECT key FROM resolutions ORDER BY last_used LIMIT ?)',
+                        (excess,),
+                    )
+                    self.evictions += excess
+                    self._count -= excess
+
+    def forget_video(self, video_id):
+        """Drop every entry that resolves to `video_id`."""
+        with self._lock:
+            removed = self._conn.execute('DELETE FROM resolutions WHERE video_id = ?', (video_id,)).rowcount
+            self._count -= removed
+
+    def flush(self):
+        """Write the last-used times noted since the previous flush."""
+        with self._lock:
+            self._write_touched()
+
+    def _write_touched(self):
+        if not self._touched:
+            return
+        touched, self._touched = self._touched, {}
+        self._conn.execute('BEGIN')
+        try:
+            self._conn.executemany('UPDATE resolutions SET last_used = ? WHERE key = ?',
+                                   [(used, key) for key, used in touched.items()])
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': self._count,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+resolution_cache = ResolutionCache(CACHE_DB_PATH)
+
+class SpotifyMatchIndex(CacheStore):
+    """Persistent map from Spotify tracks to the YouTube videos chosen for them.
+
+    Looked up by Spotify track ID, then by ISRC, so the same recording on
+    another album or in another market reuses the match. Every match keeps
+    the confidence it was chosen with; ones below `min_confidence` are
+    ignored so weak guesses get searched again. Matches don't expire, they
+    are dropped by invalidate() once their video stops working.
+    """
+    def __init__(self, path, *, min_confidence=SPOTIFY_MATCH_MIN_CONFIDENCE):
+        super().__init__(path)
+        self.min_confidence = min_confidence
+        self.hits = 0
+        self.weak = 0
+        self.misses = 0
+        self.invalidated = 0
+        self._lock = threading.Lock()
+
+    def _setup(self, conn):
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS spotify_matches ('
+            ' track_id TEXT PRIMARY KEY, isrc TEXT, video_id TEXT NOT NULL,'
+            ' confidence REAL NOT NULL, matched REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS spotify_matches_isrc ON spotify_matches(isrc)')
+        conn.execute('CREATE INDEX IF NOT EXISTS spotify_matches_video ON spotify_matches(video_id)')
+
+    @staticmethod
+    def _key(track):
+        if track.get('id'):
+            return track['id']
+        return f"isrc:{track['isrc']}" if track.get('isrc') else None
+
+    def get(self, track):
+        """The video ID matched to `track` (from spotify_track_info), or None."""
+        match = self.lookup(track)
+        return match[0] if match and match[1] >= self.min_confidence else None
+
+    def lookup(self, track):
+        """(video ID, confidence) stored for `track`, however weak, or None."""
+        key = self._key(track)
+        row = None
+        with self._lock:
+            if key:
+                row = self._conn.execute(
+                    'SELECT video_id, confidence FROM spotify_matches WHERE track_id = ?', (key,)
+                ).fetchone()
+            if row is None and track.get('isrc'):
+                row = self._conn.execute(
+                    'SELECT video_id, confidence FROM spotify_matches WHERE isrc = ? ORDER BY confidence DESC LIMIT 1',
+                    (track['isrc'],),
+                ).fetchone()
+        if row is None:
+            self.misses += 1
+            SPOTIFY_MATCH_LOOKUPS.inc('miss')
+            return None
+        if row[1] < self.min_confidence:
+            self.weak += 1
+            SPOTIFY_MATCH_LOOKUPS.inc('weak')
+        else:
+            self.hits += 1
+            SPOTIFY_MATCH_LOOKUPS.inc('hit')
+        return row[0], row[1]
+
+    def put(self, track, video_id, confidence):
+        key = self._key(track)
+        if not key or not video_id:
+            return
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO spotify_matches (track_id, isrc, video_id, confidence, matched) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, track.get('isrc'), video_id, confidence, time.time()),
+            )
+
+    def invalidate(self, video_id):
+        """Forget every match pointing at `video_id`; returns how many there were."""
+        with self._lock:
+            removed = self._conn.execute('DELETE FROM spotify_matches WHERE video_id = ?', (video_id,)).rowcount
+        self.invalidated += removed
+        return removed
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM spotify_matches').fetchone()[0]
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'weak': self.weak,
+            'misses': self.misses,
+            'invalidated': self.invalidated,
+        }
+
+spotify_matches = SpotifyMatchIndex(CACHE_DB_PATH)
+
+# yt-dlp error texts meaning the video itself is gone, not that one request failed
+VIDEO_GONE_MARKERS = (
+    'video unavailable', 'private video', 'has been removed', 'no longer available',
+    'account associated with this video has been terminated',
+)
+
+def video_gone(error):
+    return extraction_error_class(error) == 'unavailable'
+
+def forget_video(video_id):
+    """Stop handing out `video_id` for Spotify tracks and cached searches."""
+    removed = spotify_matches.invalidate(video_id)
+    resolution_cache.forget_video(video_id)
+    if removed:
+        print(f"Video {video_id} is unavailable; dropped {removed} Spotify match(es)")
+
+# Extraction priority classes, most urgent first
+PRIORITY_PLAYBACK = 0  # needed to start or continue playback now
+PRIORITY_BULK = 1      # playlist imports
+PRIORITY_DEBUG = 2     # !test, !formats
+PRIORITY_NAMES = ('playback', 'bulk', 'debug')
+
+@dataclass(slots=True, eq=False)
+class QueueEntry:
+    """One queued song.
+
+    The requester is kept as ID + display name rather than a Member, so long
+    or looping queues don't pin Member objects. Entries compare by identity.
+    """
+    url: str
+    title: str
+    duration: int = 0
+    thumbnail: str | None = None
+    uploader: str = 'Unknown'
+    requester_id: int = 0
+    requester_name: str = ''
+    video_id: str | None = None
+    resolved: ResolvedTrack | None = None
+
+    def __post_init__(self):
+        # The same channel names repeat across thousands of entries
+        self.uploader = sys.intern(self.uploader)
+
+class ExtractionScheduler:
+    """Runs blocking yt-dlp calls on a dedicated thread pool.
+
+    Waiting jobs are picked by priority class first and then round-robin over
+    the guilds waiting in that class, so one guild importing a huge playlist
+    can't starve everyone else's playback. All bookkeeping happens on the
+    event loop thread. A pool that breaks (a worker process died) fails the
+    jobs it had and is replaced for the next ones.
+    """
+    def __init__(self, workers, *, mode='thread'):
+        self.workers = workers
+        self.mode = mode
+        self._executor = None
+        # One OrderedDict per priority: guild_id -> deque of (fn, future)
+        self._pending = [OrderedDict() for _ in PRIORITY_NAMES]
+        self._depth = [0] * len(PRIORITY_NAMES)
+        self.max_depth = [0] * len(PRIORITY_NAMES)
+        self.completed = [0] * len(PRIORITY_NAMES)
+        self.active = 0
+
+    async def run(self, fn, *, guild_id=None, priority=PRIORITY_PLAYBACK):
+        """Run `fn()` on the pool and return its result.
+
+        Cancelling the caller drops the job if it hasn't started yet.
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending[priority].setdefault(guild_id, deque()).append((fn, fut))
+        self._depth[priority] += 1
+        self.max_depth[priority] = max(self.max_depth[priority], self._depth[priority])
+        self._pump(loop)
+        return await fut
+
+    def _next_job(self):
+        for priority, guilds in enumerate(self._pending):
+            while guilds:
+                guild_id, jobs = guilds.popitem(last=False)
+                fn, fut = jobs.popleft()
+                self._depth[priority] -= 1
+                if jobs:
+                    # Back of the line: the next job in this class goes to another guild
+                    guilds[guild_id] = jobs
+                if not fut.done():
+                    return priority, fn, fut
+        return None
+
+    def _get_executor(self):
+        # Created on first use so worker processes never build pools of their own
+        if self._executor is None:
+            if self.mode == 'process':
+                # spawn everywhere: forking a process that already runs threads is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_extraction_worker,
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='extract')
+        return self._executor
+
+    def _pump(self, loop):
+        while self.active < self.workers:
+            job = self._next_job()
+            if job is None:
+                return
+            priority, fn, fut = job
+            self.active += 1
+            executor = self._get_executor()
+            try:
+                done = loop.run_in_executor(executor, fn)
+            except Exception as e:
+                # A broken pool refuses new work straight away
+                self.active -= 1
+                if not fut.done():
+                    fut.set_exception(e)
+                if isinstance(e, BrokenExecutor):
+                    self._replace_executor(executor)
+                continue
+            done.add_done_callback(lambda d, p=priority, f=fut, e=executor: self._finished(loop, p, f, d, e))
+
+    def _finished(self, loop, priority, fut, done, executor):
+        self.active -= 1
+        self.completed[priority] += 1
+        if not fut.done():
+            if done.cancelled():
+                # e.g. the executor was shut down with cancel_futures=True
+                fut.cancel()
+            elif done.exception() is not None:
+                fut.set_exception(done.exception())
+            else:
+                fut.set_result(done.result())
+        if not done.cancelled() and isinstance(done.exception(), BrokenExecutor):
+            self._replace_executor(executor)
+        self._pump(loop)
+
+    def _replace_executor(self, executor):
+        """Drop a pool that broke (a worker process died); the next job builds a new one."""
+        if self._executor is not executor:
+            # Already replaced, by an earlier job of the same pool
+            return
+        self._executor = None
+        print(f"Extraction {self.mode} pool broke; starting a new one")
+        FAILURES.inc('extraction_pool')
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'workers': self.workers,
+            'active': self.active,
+            'queued': dict(zip(PRIORITY_NAMES, self._depth)),
+            'max_queued': dict(zip(PRIORITY_NAMES, self.max_depth)),
+            'completed': dict(zip(PRIORITY_NAMES, self.completed)),
+            'waiting_guilds': sum(len(guilds) for guilds in self._pending),
+        }
+
+extraction_scheduler = ExtractionScheduler(EXTRACTION_WORKERS, mode=EXTRACTION_MODE)
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one shared task.
+
+    Callers wait on the shared task through a shield, so cancelling one of
+    them doesn't affect the rest. The task itself is only cancelled once
+    every caller waiting on it has gone away.
+    """
+    def __init__(self):
+        self._inflight = {}  # key -> [task, number of waiting callers]
+        self.calls = 0
+        self.saved = 0
+
+    async def run(self, key, factory):
+        self.calls += 1
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(factory())
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.saved += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and entry[1] == 1:
+                # Last one waiting: nobody wants the result any more. Forget it
+                # now so a caller arriving before it finishes starts afresh.
+                self._forget(key, task)
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _forget(self, key, task):
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+
+    def stats(self):
+        return {'calls': self.calls, 'saved': self.saved, 'inflight': len(self._inflight)}
+
+extraction_flights = SingleFlight()
+
+def _flight_key(profile, query, download, items=None):
+    if items is not None:
+        # A window of a listing: the playlist, not the video a link points at
+        return (profile, query.strip(), download, items)
+    # 'foo' and 'ytsearch:foo' are the same search with default_search=ytsearch
+    if query.startswith('ytsearch:'):
+        query = query[len('ytsearch:'):]
+    return (profile, normalize_query(query), download)
+
+async def extract_info(query, *, profile='primary', download=False, items=None, guild_id=None,
+                       priority=PRIORITY_PLAYBACK):
+    """Run yt-dlp's extract_info() with a named profile on the extraction scheduler.
+
+    `items` ('1-100') limits a playlist listing to those entries. Identical
+    requests already in flight share one extraction (scheduled with the first
+    caller's guild and priority); treat the result as read-only.
+    """
+    started = time.perf_counter()
+    try:
+        return await extraction_flights.run(
+            _flight_key(profile, query, download, items),
+            lambda: _extract_info(query, profile, download, items, guild_id, priority),
+        )
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        EXTRACT_FAILURES.inc(profile)
+        raise
+    finally:
+        EXTRACT_SECONDS.observe(time.perf_counter() - started, profile)
+
+async def _extract_info(query, profile, download, items, guild_id, priority):
+    if extraction_scheduler.mode == 'process':
+        # Only the picklable trimmed result comes back from the worker
+        return await extraction_scheduler.run(
+            partial(_process_extract, profile, query, download, items), guild_id=guild_id, priority=priority
+        )
+    pool = ytdl_pools[profile]
+    return await extraction_scheduler.run(
+        lambda: pool.extract_info(query, download=download, items=items), guild_id=guild_id, priority=priority
+    )
+
+# Profiles tried for each kind of extraction, in their default order. Last
+# resorts (lower quality) go after the rest whatever their record.
+STRATEGY_CHAINS = {
+    'stream': ('primary', 'fallback', 'forceplay'),
+    'resolve': ('primary', 'permissive', 'forceplay'),
+    'search': ('primary', 'fallback'),
+}
+LAST_RESORT_PROFILES = frozenset(('forceplay',))
+
+# Error classes by yt-dlp message, checked in order
+EXTRACTION_ERROR_CLASSES = (
+    # Geo blocks also say "Video unavailable", but another profile may get around them
+    ('geo', ('available in your country', 'geo restrict', 'geo-restrict')),
+    ('unavailable', VIDEO_GONE_MARKERS),
+    ('age', ('confirm your age', 'age-restricted', 'inappropriate for some users')),
+    ('bot_check', ('not a bot',)),
+    ('format', ('requested format is not available', 'no video formats')),
+    ('forbidden', ('http error 403', 'forbidden')),
+    ('rate_limited', ('http error 429', 'too many requests')),
+    ('network', ('timed out', 'connection', 'temporary failure in name resolution')),
+)
+# No other profile will do better: stop there, and don't hold it against the profile
+TERMINAL_ERRORS = frozenset(('unavailable',))
+
+def extraction_error_class(error):
+    text = str(error).lower()
+    for name, markers in EXTRACTION_ERROR_CLASSES:
+        if any(marker in text for marker in markers):
+            return name
+    return 'other'
+
+def extraction_source(query):
+    """What ExtractionStrategies keeps statistics by: 'search', 'youtube' or the site's host."""
+    if not query.startswith(('http://', 'https://')):
+        return 'search'
+    host = urlparse(query).netloc.lower().removeprefix('www.')
+    if host == 'youtu.be' or host == 'youtube.com' or host.endswith('.youtube.com'):
+        return 'youtube'
+    return host
+
+class ExtractionStrategies(CacheStore):
+    """Learns which yt-dlp profile to try first for each kind of request.
+
+    Outcomes are counted per source (see extraction_source) and profile:
+    attempts, successes, seconds spent and the error classes seen. A chain's
+    profiles are tried lowest expected cost first (mean seconds per attempt
+    over success rate), so a profile that keeps failing for a source stops
+    costing its latency up front. Counts (error classes included) are halved
+    past DECAY_AT attempts so old behaviour fades, and `explore_rate` of the requests start with
+    another profile of the chain instead, so a profile that lost once still
+    gets retried and can win its place back.
+
+    Each profile also has a circuit breaker over its last BREAKER_WINDOW
+    attempts from any source. At `failure_ratio` or worse it goes to the
+    back of every chain for `cooldown` seconds; after that the next request
+    tries it first and the result closes or reopens it.
+
+    save() adds the counts recorded since the last save to the database
+    (which every bot process shares) and reloads the merged totals; they are
+    loaded at startup too.
+    """
+    DECAY_AT = 200
+    BREAKER_WINDOW = 20
+    BREAKER_MIN_ATTEMPTS = 10
+    # Seconds per attempt assumed for a profile with no history
+    PRIOR_SECONDS = 2.0
+
+    def __init__(self, path, *, failure_ratio=EXTRACTION_BREAKER_RATIO, cooldown=EXTRACTION_BREAKER_COOLDOWN,
+                 explore_rate=EXTRACTION_EXPLORE_RATE):
+        super().__init__(path)
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.explore_rate = explore_rate
+        self._stats = {}       # (source, profile) -> [attempts, successes, seconds]
+        self._errors = {}      # (source, profile, error class) -> count
+        # The same, recorded since the last save()
+        self._unsaved = {}
+        self._unsaved_errors = {}
+        self._recent = {}      # profile -> deque of recent outcomes (True = ok)
+        self._open_until = {}  # profile -> when its open breaker allows a trial
+        self._lock = threading.Lock()
+
+    def _setup(self, conn):
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS extraction_stats ('
+            ' source TEXT NOT NULL, profile TEXT NOT NULL, attempts INTEGER NOT NULL,'
+            ' successes INTEGER NOT NULL, seconds REAL NOT NULL, PRIMARY KEY (source, profile))'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS extraction_errors ('
+            ' source TEXT NOT NULL, profile TEXT NOT NULL, error TEXT NOT NULL,'
+            ' count INTEGER NOT NULL, PRIMARY KEY (source, profile, error))'
+        )
+        with self._lock:
+            self._load(conn)
+
+    def _load(self, conn):
+        """Saved counts, plus the ones recorded since the last save."""
+        self._stats = {
+            (source, profile): [attempts, successes, seconds]
+            for source, profile, attempts, successes, seconds in conn.execute(
+                'SELECT source, profile, attempts, successes, seconds FROM extraction_stats')
+        }
+        for key, (attempts, successes, seconds) in self._unsaved.items():
+            stats = self._stats.setdefault(key, [0, 0, 0.0])
+            stats[0] += attempts
+            stats[1] += successes
+            stats[2] += seconds
+        self._errors = {
+            (source, profile, error): count
+            for source, profile, error, count in conn.execute(
+                'SELECT source, profile, error, count FROM extraction_errors')
+        }
+        for key, count in self._unsaved_errors.items():
+            self._errors[key] = self._errors.get(key, 0) + count
+
+    def _cost(self, source, profile):
+        attempts, successes, seconds = self._stats.get((source, profile), (0, 0, 0.0))
+        mean_seconds = (seconds + self.PRIOR_SECONDS) / (attempts + 1)
+        return mean_seconds / ((successes + 1) / (attempts + 2))
+
+    def _rank(self, profile):
+        """0 for a profile whose breaker allows its trial now, 1 if closed, 2 while open."""
+        until = self._open_until.get(profile)
+        if until is None:
+            return 1
+        now = time.monotonic()
+        if now < until:
+            return 2
+        # Cooldown over: this request tries it first, the rest wait for its result
+        self._open_until[profile] = now + self.cooldown
+        return 0
+
+    def order(self, source, chain):
+        """The profiles of `chain` in the order to try them for `source`."""
+        ranks = {profile: self._rank(profile) for profile in chain}
+        # sorted() is stable: with no history the chain keeps its default order
+        ordered = sorted(chain, key=lambda profile: (
+            ranks[profile], profile in LAST_RESORT_PROFILES, self._cost(source, profile)))
+        if ranks[ordered[0]] == 1 and random.random() < self.explore_rate:
+            others = [profile for profile in ordered[1:]
+                      if ranks[profile] == 1 and profile not in LAST_RESORT_PROFILES]
+            if others:
+                profile = random.choice(others)
+                ordered.remove(profile)
+                ordered.insert(0, profile)
+        return ordered
+
+    def record(self, source, profile, seconds, error=None):
+        """Count one attempt; `error` is its error class, None if it worked."""
+        stats = self._stats.setdefault((source, profile), [0, 0, 0.0])
+        unsaved = self._unsaved.setdefault((source, profile), [0, 0, 0.0])
+        for counts in (stats, unsaved):
+            counts[0] += 1
+            counts[2] += seconds
+            if error is None:
+                counts[1] += 1
+        if error is not None:
+            key = (source, profile, error)
+            self._errors[key] = self._errors.get(key, 0) + 1
+            self._unsaved_errors[key] = self._unsaved_errors.get(key, 0) + 1
+        if stats[0] > self.DECAY_AT:
+            stats[0] //= 2
+            stats[1] //= 2
+            stats[2] /= 2
+            # Error classes fade with the rest; ones no longer seen are dropped
+            for key in [key for key in self._errors if key[:2] == (source, profile)]:
+                self._errors[key] //= 2
+                if not self._errors[key]:
+                    del self._errors[key]
+        EXTRACTION_ATTEMPTS.inc(profile, error or 'ok')
+        if error not in TERMINAL_ERRORS:
+            self._update_breaker(profile, error is None)
+
+    def _update_breaker(self, profile, ok):
+        recent = self._recent.setdefault(profile, deque(maxlen=self.BREAKER_WINDOW))
+        if profile in self._open_until:
+            if ok:
+                del self._open_until[profile]
+                recent.clear()
+                print(f"Extraction profile {profile} works again")
+            else:
+                self._open_until[profile] = time.monotonic() + self.cooldown
+            return
+        recent.append(ok)
+        failures = recent.count(False)
+        if len(recent) >= self.BREAKER_MIN_ATTEMPTS and failures >= self.failure_ratio * len(recent):
+            self._open_until[profile] = time.monotonic() + self.cooldown
+            print(f"Extraction profile {profile} failed {failures} of its last {len(recent)} attempts; "
+                  f"trying it last for {self.cooldown:.0f}s")
+
+    def is_open(self, profile):
+        return profile in self._open_until
+
+    def save(self):
+        if not self._unsaved and not self._unsaved_errors:
+            return
+        stats = [(source, profile, *values) for (source, profile), values in self._unsaved.items()]
+        errors = [(*key, count) for key, count in self._unsaved_errors.items()]
+        # Opened outside the lock: the first open loads the saved counts under it
+        conn = self._conn
+        with self._lock:
+            conn.execute('BEGIN')
+            try:
+                # Added to what other processes saved, not written over it
+                conn.executemany(
+                    'INSERT INTO extraction_stats VALUES (?, ?, ?, ?, ?) ON CONFLICT (source, profile) DO UPDATE SET'
+                    ' attempts = attempts + excluded.attempts, successes = successes + excluded.successes,'
+                    ' seconds = seconds + excluded.seconds', stats)
+                conn.executemany(
+                    'INSERT INTO extraction_errors VALUES (?, ?, ?, ?) ON CONFLICT (source, profile, error)'
+                    ' DO UPDATE SET count = count + excluded.count', errors)
+                conn.execute(
+                    'UPDATE extraction_errors SET count = count / 2 WHERE (source, profile) IN'
+                    ' (SELECT source, profile FROM extraction_stats WHERE attempts > ?)', (self.DECAY_AT,))
+                conn.execute('DELETE FROM extraction_errors WHERE count = 0')
+                conn.execute(
+                    'UPDATE extraction_stats SET attempts = attempts / 2, successes = successes / 2,'
+                    ' seconds = seconds / 2 WHERE attempts > ?', (self.DECAY_AT,))
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            self._unsaved.clear()
+            self._unsaved_errors.clear()
+            self._load(conn)
+
+    def stats(self):
+        """Per profile, over all sources: attempts, successes, seconds, breaker state."""
+        totals = {}
+        for (source, profile), (attempts, successes, seconds) in self._stats.items():
+            entry = totals.setdefault(profile, {'attempts': 0, 'successes': 0, 'seconds': 0.0})
+            entry['attempts'] += attempts
+            entry['successes'] += successes
+            entry['seconds'] += seconds
+        for profile, entry in totals.items():
+            entry['open'] = self.is_open(profile)
+        return totals
+
+extraction_strategies = ExtractionStrategies(CACHE_DB_PATH)
+
+metrics.register(Gauge(
+    'musicbot_extraction_breaker_open', '1 while a profile is skipped by its circuit breaker',
+    lambda: {(profile,): int(extraction_strategies.is_open(profile))
+             for profile in {p for chain in STRATEGY_CHAINS.values() for p in chain}}, ('profile',)))
+
+async def extract_with_strategy(kind, query, *, download=False, guild_id=None, priority=PRIORITY_PLAYBACK):
+    """Extract `query` with the profiles of STRATEGY_CHAINS[kind], most promising first.
+
+    Stops at the first profile that returns a result, or when one reports
+    that the video itself is gone. Raises the last error.
+    """
+    source = extraction_source(query)
+    error = None
+    for attempt, profile in enumerate(extraction_strategies.order(source, STRATEGY_CHAINS[kind])):
+        if attempt:
+            FALLBACKS.inc(kind)
+        started = time.perf_counter()
+        try:
+            data = await extract_info(query, profile=profile, download=download, guild_id=guild_id, priority=priority)
+            if not data:
+                # Profiles with ignoreerrors return nothing instead of raising
+                raise Exception("No video data found")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Extraction with {profile} failed: {e}")
+            error = e
+            error_class = extraction_error_class(e)
+            extraction_strategies.record(source, profile, time.perf_counter() - started, error_class)
+            if error_class in TERMINAL_ERRORS:
+                break
+            continue
+        extraction_strategies.record(source, profile, time.perf_counter() - started)
+        return data
+    raise error
+
+class YTDLSource(discord.PCMVolumeTransformer):
+    def __init__(self, source, *, data, volume=0.5):
+        super().__init__(source, volume)
+        self.data = data
+        self.title = data.get('title')
+        self.url = data.get('url')
+        self.duration = data.get('duration')
+        self.thumbnail = data.get('thumbnail')
+        self.uploader = data.get('uploader')
+        self.resolved = None
+        # Called once from the audio thread when the first frame is read
+        self.on_first_frame = None
+        self.start_position = 0.0
+        self.frames = 0
+
+    @property
+    def position(self):
+        """Seconds into the track, from the frames handed to Discord so far."""
+        return self.start_position + self.frames * FRAME_SECONDS
+
+    def read(self):
+        data = super().read()
+        if self.on_first_frame is not None:
+            callback, self.on_first_frame = self.on_first_frame, None
+            callback()
+        if data:
+            self.frames += 1
+        return data
+
+    @classmethod
+    def from_resolved(cls, resolved, *, volume=0.5, position=0.0):
+        """Open an already resolved stream without running yt-dlp again."""
+        opts = ffmpeg_options_for(resolved.headers, position, resolved.local)
+        source = discord.FFmpegPCMAudio(resolved.stream_url, **opts)
+        _ffmpeg_sources.add(source)
+        source = cls(source, data=resolved.data, volume=volume)
+        source.resolved = resolved
+        source.start_position = position
+        return source
+
+    @classmethod
+    async def extract(cls, url, *, download=False, guild_id=None, priority=PRIORITY_PLAYBACK):
+        """Run yt-dlp on a URL, trying the stream profiles in their learned order."""
+        data = await extract_with_strategy('stream', url, download=download, guild_id=guild_id, priority=priority)
+        if 'entries' in data:
+            data = data['entries'][0]
+        return data
+
+    @classmethod
+    async def resolve(cls, url, *, guild_id=None):
+        """Resolve a URL to a ResolvedTrack without starting ffmpeg."""
+        data = await cls.extract(url, guild_id=guild_id)
+        resolved = ResolvedTrack.from_info(data)
+        if resolved is None:
+            raise Exception("No stream URL found")
+        return resolved
+
+    @classmethod
+    async def from_url(cls, url, *, stream=False, guild_id=None):
+        if stream:
+            return cls.from_resolved(await cls.resolve(url, guild_id=guild_id))
+        data = await cls.extract(url, download=True, guild_id=guild_id)
+        filename = get_ytdl().prepare_filename(data)
+        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+
+class OpusTrackSource(discord.FFmpegOpusAudio):
+    """Opus playback without Python-side PCM work.
+
+    ffmpeg copies Opus streams straight through when the volume is 100%;
+    otherwise it transcodes once and applies the volume itself. The volume is
+    fixed for the life of the process, so a change means opening a new source
+    at the current position (see MusicBot.set_volume).
+    """
+    def __init__(self, resolved, *, codec, volume, position=0.0):
+        opts = ffmpeg_options_for(resolved.headers, position, resolved.local)
+        options = opts['options']
+        self.passthrough = codec == 'opus' and volume == 1.0
+        if not self.passthrough:
+            options += f' -filter:a volume={volume:.2f}'
+        super().__init__(
+            resolved.stream_url,
+            codec='copy' if self.passthrough else None,
+            before_options=opts['before_options'],
+            options=options,
+        )
+        _ffmpeg_sources.add(self)
+        self.resolved = resolved
+        self.data = resolved.data
+        self.codec = codec
+        self.volume = volume
+        self.on_first_frame = None
+        self.start_position = position
+        self.frames = 0
+
+    @property
+    def position(self):
+        return self.start_position + self.frames * FRAME_SECONDS
+
+    def read(self):
+        data = super().read()
+        if self.on_first_frame is not None:
+            callback, self.on_first_frame = self.on_first_frame, None
+            callback()
+        if data:
+            self.frames += 1
+        return data
+
+async def probe_codec(resolved):
+    """Audio codec of a resolved stream ('opus', 'mp4a', ...), or None.
+
+    yt-dlp usually reports it for free; ffprobe is only run when it didn't.
+    """
+    codec = resolved.data.get('acodec')
+    if not codec or codec == 'none':
+        try:
+            codec, _ = await discord.FFmpegOpusAudio.probe(resolved.stream_url)
+        except Exception as e:
+            print(f"Codec probe failed: {e}")
+            FAILURES.inc('codec_probe')
+            codec = None
+        resolved.data['acodec'] = codec or 'unknown'
+    return codec.split('.')[0] if codec and codec != 'unknown' else None
+
+async def create_source(resolved, *, volume, position=0.0):
+    """Open a resolved track for playback in the configured PLAYBACK_MODE."""
+    if PLAYBACK_MODE == 'opus':
+        codec = await probe_codec(resolved)
+        return OpusTrackSource(resolved, codec=codec, volume=volume, position=position)
+    return YTDLSource.from_resolved(resolved, volume=volume, position=position)
+
+class AudioCache(CacheStore):
+    """Size-bounded LRU cache of downloaded audio files, keyed by video ID.
+
+    Plays are counted per video; once a video reaches `min_plays` it is
+    downloaded in the background (bulk extraction priority) and later plays
+    read the local file. The index and play counts live in SQLite next to the
+    resolution cache, so they survive restarts. Plays and last-used times are
+    noted in memory and written by flush(), which also starts the downloads
+    of tracks that became hot.
+    """
+    def __init__(self, db_path, directory, *, max_bytes=AUDIO_CACHE_MAX_BYTES, min_plays=AUDIO_CACHE_MIN_PLAYS):
+        super().__init__(db_path)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.hits = 0
+        self.misses = 0
+        self.downloads = 0
+        self.evictions = 0
+        self._downloading = set()
+        # Download tasks, kept so they aren't garbage-collected mid-run
+        self._tasks = set()
+        # video_id -> last use not written yet
+        self._touched = {}
+        # video_id -> [plays not written yet, URL to download it from]
+        self._plays = {}
+        self._lock = threading.Lock()
+
+    def _setup(self, conn):
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS audio_files ('
+            ' video_id TEXT PRIMARY KEY, plays INTEGER NOT NULL DEFAULT 0,'
+            ' path TEXT, size INTEGER NOT NULL DEFAULT 0, acodec TEXT, last_used REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS audio_files_last_used ON audio_files(last_used)')
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def lookup(self, video_id, *, count=True):
+        """ResolvedTrack for the cached file of `video_id`, or None.
+
+        `count=False` peeks without touching the hit/miss counters.
+        """
+        if not self.enabled or not video_id:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT path, acodec FROM audio_files WHERE video_id = ? AND path IS NOT NULL', (video_id,)
+            ).fetchone()
+            if row is None or not os.path.exists(row[0]):
+                if row is not None:
+                    # Deleted behind our back
+                    self._conn.execute('UPDATE audio_files SET path = NULL, size = 0 WHERE video_id = ?', (video_id,))
+                self.misses += count
+                return None
+            self._touched[video_id] = time.time()
+            self.hits += count
+        return ResolvedTrack(row[0], expires_at=float('inf'), data={'id': video_id, 'acodec': row[1]}, local=True)
+
+    def record_play(self, song_info):
+        """Count a play; the next flush() downloads the track once it is hot."""
+        video_id = song_info.video_id
+        if not self.enabled or not video_id:
+            return
+        with self._lock:
+            pending = self._plays.setdefault(video_id, [0, song_info.url])
+            pending[0] += 1
+            self._touched[video_id] = time.time()
+
+    def flush(self):
+        """Write the plays and last-used times noted since the previous flush.
+
+        Starts a background download for every track that reached
+        `min_plays` and isn't cached yet.
+        """
+        with self._lock:
+            plays, self._plays = self._plays, {}
+            self._write(plays)
+            hot = []
+            if plays:
+                rows = self._conn.execute(
+                    f"SELECT video_id, plays, path FROM audio_files WHERE video_id IN ({','.join('?' * len(plays))})",
+                    list(plays),
+                )
+                hot = [(video_id, plays[video_id][1]) for video_id, count, path in rows
+                       if count >= self.min_plays and path is None]
+        for video_id, url in hot:
+            if video_id not in self._downloading:
+                self._downloading.add(video_id)
+                task = asyncio.get_running_loop().create_task(self._download(video_id, url))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    def _write(self, plays=None):
+        """Write `plays` and the noted last-used times in one transaction. Hold the lock."""
+        touched, self._touched = self._touched, {}
+        if not (touched or plays):
+            return
+        now = time.time()
+        counted = [(video_id, count, touched.pop(video_id, now)) for video_id, (count, _) in (plays or {}).items()]
+        self._conn.execute('BEGIN')
+        try:
+            self._conn.executemany(
+                'INSERT INTO audio_files (video_id, plays, last_used) VALUES (?, ?, ?) '
+                'ON CONFLICT(video_id) DO UPDATE SET plays = plays + excluded.plays, last_used = excluded.last_used',
+                counted,
+            )
+            self._conn.executemany('UPDATE audio_files SET last_used = ? WHERE video_id = ?',
+                                   [(used, video_id) for video_id, used in touched.items()])
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    async def _download(self, video_id, url):
+        try:
+            info = await extract_info(url, profile='audio_cache', download=True, priority=PRIORITY_BULK)
+            if 'entries' in info:
+                info = info['entries'][0]
+            path = os.path.join(self.directory, f"{video_id}.{info.get('ext')}")
+            if not os.path.exists(path):
+                raise Exception(f"download finished but {path} is missing")
+            with self._lock:
+                self._conn.execute(
+                    'UPDATE audio_files SET path = ?, size = ?, acodec = ? WHERE video_id = ?',
+                    (path, os.path.getsize(path), info.get('acodec'), video_id),
+                )
+            self.downloads += 1
+            self._evict()
+        except Exception as e:
+            print(f"Audio cache download failed for {video_id}: {e}")
+            FAILURES.inc('audio_cache')
+        finally:
+            self._downloading.discard(video_id)
+
+    def _evict(self):
+        """Delete least recently used files until the cache fits its budget."""
+        with self._lock:
+            self._write()
+            total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM audio_files WHERE path IS NOT NULL').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self._conn.execute(
+                'SELECT video_id, path, size FROM audio_files WHERE path IS NOT NULL ORDER BY last_used'
+            ).fetchall()
+            for video_id, path, size in rows:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    # Probably open by a player (Windows); try again next time
+                    print(f"Could not evict {path}: {e}")
+                    continue
+                self._conn.execute('UPDATE audio_files SET path = NULL, size = 0 WHERE video_id = ?', (video_id,))
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            files, total = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio_files WHERE path IS NOT NULL'
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'files': files,
+            'bytes': total,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'downloads': self.downloads,
+            'evictions': self.evictions,
+        }
+
+audio_cache = AudioCache(CACHE_DB_PATH, AUDIO_CACHE_DIR)
+
+class TrackPrefetcher:
+    """Resolves a guild's upcoming track while the current one is playing.
+
+    The prefetch belongs to one queue entry (compared by identity), so any
+    queue change that puts a different song next simply makes it stale.
+    """
+    def __init__(self, bot, guild_id):
+        self.bot = bot
+        self.loop = bot.loop
+        self.guild_id = guild_id
+        self.song = None
+        self.task = None
+
+    def schedule(self, song):
+        """Start prefetching `song` unless it is already being prefetched."""
+        if song is self.song:
+            return
+        self.invalidate()
+        if song is None:
+            return
+        self.song = song
+        self.task = self.loop.create_task(self._run(song))
+
+    async def _run(self, song):
+        """Resolve `song` in place; returns a started source if PREFETCH_FFMPEG."""
+        try:
+            resolved = audio_cache.lookup(song.video_id, count=False) or song.resolved
+            if not (resolved and resolved.is_valid()):
+                resolved = await YTDLSource.resolve(song.url, guild_id=self.guild_id)
+                song.resolved = resolved
+            if PREFETCH_FFMPEG:
+                # Spawning ffmpeg now lets it connect and buffer before vc.play
+                return await create_source(resolved, volume=self.bot.get_volume(self.guild_id))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Prefetch failed for {song.title}: {e}")
+            FAILURES.inc('prefetch')
+        return None
+
+    async def claim(self, song):
+        """Return a ready source for `song` if one was prefetched, else None.
+
+        Waits for an in-flight prefetch of the same song instead of starting
+        a second extraction for it.
+        """
+        if song is not self.song:
+            self.invalidate()
+            return None
+        # Detach first so a concurrent schedule() can't cancel what we wait on
+        task, self.task, self.song = self.task, None, None
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                # We were cancelled, not the prefetch: don't leak its source
+                task.add_done_callback(self._discard)
+                raise
+            return None
+
+    @staticmethod
+    def _discard(task):
+        if not task.cancelled() and task.exception() is None and task.result() is not None:
+            task.result().cleanup()
+
+    def invalidate(self):
+        task, self.task, self.song = self.task, None, None
+        if task is None:
+            return
+        if task.done():
+            self._discard(task)
+        else:
+            task.cancel()
+
+class PlayerStateStore(CacheStore):
+    """Per-guild player state saved for warm restarts.
+
+    One row per guild with a voice connection: channels, loop mode, volume,
+    the current track and how far into it playback was, and the queue.
+    Tracks are stored as zlib-compressed JSON arrays of QueueEntry fields.
+    Stream URLs are left out; they would have expired by the next start.
+    """
+    def __init__(self, path, *, max_age=PLAYER_STATE_MAX_AGE):
+        super().__init__(path)
+        self.max_age = max_age
+        self.saves = 0
+        self.restores = 0
+        self._lock = threading.Lock()
+
+    def _setup(self, conn):
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS player_state ('
+            ' guild_id INTEGER PRIMARY KEY, voice_channel_id INTEGER NOT NULL, text_channel_id INTEGER,'
+            ' loop_mode INTEGER NOT NULL DEFAULT 0, volume REAL, position REAL NOT NULL DEFAULT 0,'
+            ' current BLOB, queue BLOB, updated REAL NOT NULL)'
+        )
+
+    @staticmethod
+    def encode(entries):
+        rows = [
+            [e.url, e.title, e.duration, e.thumbnail, e.uploader, e.requester_id, e.requester_name, e.video_id]
+            for e in entries
+        ]
+        return zlib.compress(json.dumps(rows, separators=(',', ':')).encode())
+
+    @staticmethod
+    def decode(blob):
+        if not blob:
+            return []
+        return [QueueEntry(*fields) for fields in json.loads(zlib.decompress(blob))]
+
+    def save(self, guild_id, *, voice_channel_id, text_channel_id, loop_mode, volume, position, current, queue):
+        row = (
+            guild_id, voice_channel_id, text_channel_id, loop_mode, volume, position,
+            self.encode([current]) if current else None, self.encode(queue), time.time(),
+        )
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO player_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            self.saves += 1
+
+    def save_positions(self, positions):
+        """Update just the playback position of guilds whose queue didn't change."""
+        if not positions:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE player_state SET position = ?, updated = ? WHERE guild_id = ?',
+                [(position, now, guild_id) for guild_id, position in positions.items()],
+            )
+
+    def delete(self, guild_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM player_state WHERE guild_id = ?', (guild_id,))
+
+    def pending(self, owns=None):
+        """IDs of guilds with a restorable snapshot, most recently active first.
+
+        `owns` filters the IDs when several shard processes share the
+        database. Reads only the keys; queues are decoded per guild by load().
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM player_state WHERE updated < ?', (time.time() - self.max_age,))
+            rows = self._conn.execute('SELECT guild_id FROM player_state ORDER BY updated DESC').fetchall()
+        return [row[0] for row in rows if owns is None or owns(row[0])]
+
+    def load(self, guild_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT voice_channel_id, text_channel_id, loop_mode, volume, position, current, queue'
+                ' FROM player_state WHERE guild_id = ?', (guild_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        current = self.decode(row[5])
+        return {
+            'voice_channel_id': row[0],
+            'text_channel_id': row[1],
+            'loop_mode': row[2],
+            'volume': row[3],
+            'position': row[4],
+            'current': current[0] if current else None,
+            'queue': self.decode(row[6]),
+        }
+
+player_state = PlayerStateStore(CACHE_DB_PATH)
+
+def shard_of(guild_id, shard_count):
+    """The shard Discord routes a guild's events to."""
+    return (guild_id >> 22) % shard_count
+
+class MessageScheduler:
+    """Sends and edits the bot's own messages without holding up playback.
+
+    Requests are grouped by channel, the unit Discord rate-limits message
+    writes by. Up to MESSAGE_CONCURRENCY of them run at once per channel and
+    discord.py waits out any 429 for its bucket. submit() runs a request in
+    the background for callers that don't need the result.
+    """
+    def __init__(self, concurrency=MESSAGE_CONCURRENCY):
+        self.concurrency = concurrency
+        self._limits = {}     # channel ID -> [Semaphore, requests holding or waiting for it]
+        self._summaries = {}  # channel ID -> QueueSummary
+        self._tasks = set()
+
+    @asynccontextmanager
+    async def _limit(self, channel_id):
+        """One of the channel's slots; a channel is forgotten once no request uses it."""
+        entry = self._limits.get(channel_id)
+        if entry is None:
+            entry = self._limits[channel_id] = [asyncio.Semaphore(self.concurrency), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1] and self._limits.get(channel_id) is entry:
+                del self._limits[channel_id]
+
+    def submit(self, coro):
+        task = asyncio.ensure_future(coro)
+        # Keep a reference until it finishes
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def send(self, channel, content=None, **kwargs):
+        """channel.send(); returns the message, or None if Discord refused it."""
+        async with self._limit(channel.id):
+            started = time.perf_counter()
+            try:
+                message = await channel.send(content, **kwargs)
+            except discord.HTTPException as e:
+                print(f"Could not send to channel {channel.id}: {e}")
+                FAILURES.inc('message')
+                return None
+            finally:
+                DISCORD_WRITE_SECONDS.observe(time.perf_counter() - started, 'send')
+        return message
+
+    async def edit(self, message, **kwargs):
+        """message.edit(); returns False if it failed (e.g. the message is gone)."""
+        async with self._limit(message.channel.id):
+            started = time.perf_counter()
+            try:
+                await message.edit(**kwargs)
+            except discord.NotFound:
+                return False
+            except discord.HTTPException as e:
+                print(f"Could not edit message {message.id}: {e}")
+                FAILURES.inc('message')
+                return False
+            finally:
+                DISCORD_WRITE_SECONDS.observe(time.perf_counter() - started, 'edit')
+        return True
+
+    def remove_views(self, messages):
+        """Strip the buttons off `messages`, all at once, in the background."""
+        for message in messages:
+            self.submit(self.edit(message, view=None))
+
+    def announce_queued(self, channel, songs, position, requester_name):
+        """Post "Added to Queue" for `songs`, queued from `position` on.
+
+        Songs added to a channel within QUEUE_SUMMARY_WINDOW of each other
+        share a message, edited at most every QUEUE_SUMMARY_INTERVAL.
+        """
+        if not songs:
+            return
+        now = time.monotonic()
+        summary = self._summaries.get(channel.id)
+        if summary is None or now > summary.until:
+            summary = self._summaries[channel.id] = QueueSummary(channel)
+        for offset, song in enumerate(songs):
+            summary.add(song, position + offset, requester_name)
+        summary.until = now + QUEUE_SUMMARY_WINDOW
+        if summary.task is None:
+            summary.task = self.submit(self._flush(summary))
+
+    async def _flush(self, summary):
+        try:
+            while summary.changed:
+                summary.changed = False
+                if summary.message is None:
+                    summary.message = await self.send(summary.channel, embed=summary.embed())
+                else:
+                    await self.edit(summary.message, embed=summary.embed())
+                await asyncio.sleep(QUEUE_SUMMARY_INTERVAL)
+        finally:
+            summary.task = None
+        if self._summaries.get(summary.channel.id) is summary and time.monotonic() > summary.until:
+            del self._summaries[summary.channel.id]
+
+class QueueSummary:
+    """The "Added to Queue" message of one channel and the songs it lists."""
+    # Songs listed in a summary; older ones are only counted
+    SHOWN = 10
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.message = None
+        self.songs = deque(maxlen=self.SHOWN)  # (song, position, requester name)
+        self.count = 0
+        self.changed = False
+        self.until = 0.0
+        self.task = None
+
+    def add(self, song, position, requester_name):
+        self.songs.append((song, position, requester_name))
+        self.count += 1
+        self.changed = True
+
+    def embed(self):
+        if self.count == 1:
+            song, position, requester_name = self.songs[0]
+            embed = discord.Embed(
+                title="📝 Added to Queue",
+                description=f"**{song.title}**\nPosition in queue: {position}",
+                color=0x00ff00,
+            )
+            if song.thumbnail:
+                embed.set_thumbnail(url=song.thumbnail)
+            embed.set_footer(text=f"Requested by {requester_name}")
+            return embed
+        lines = [f"{position}. **{song.title}** ({name})" for song, position, name in self.songs]
+        if self.count > len(self.songs):
+            lines.insert(0, f"... and {self.count - len(self.songs)} earlier")
+        return discord.Embed(
+            title=f"📝 Added {self.count} Songs to Queue",
+            description="\n".join(lines),
+            color=0x00ff00,
+        )
+
+messages = MessageScheduler()
+
+class GuildPlayer:
+    """Playback engine for one guild.
+
+    Owns the guild's queue, current song, loop mode and volume. Anything that
+    changes playback (play, skip, stop, pause, loop, volume) is a command
+    handled in order by the player's own task. The audio thread only posts a
+    track-end event and returns, so it never waits on the next extraction.
+
+    States: idle -> starting -> playing <-> paused, and back to starting
+    (next song) or idle when a track ends.
+    """
+    IDLE = 'idle'
+    STARTING = 'starting'
+    PLAYING = 'playing'
+    PAUSED = 'paused'
+
+    def __init__(self, bot, guild):
+        self.bot = bot
+        self.guild = guild
+        self.queue = deque()
+        self.current = None
+        self.loop_mode = 0  # 0: no loop, 1: loop song, 2: loop queue
+        self.volume = DEFAULT_VOLUME
+        # Where now-playing messages go; the channel the last song was requested in
+        self.channel = None
+        self.state = self.IDLE
+        self.prefetcher = TrackPrefetcher(bot, guild.id)
+        # YouTube playlists still being listed, in the order they were added
+        self.feeds = deque()
+        self._refill_task = None
+        # Identifies the vc.play() call whose track-end event we're waiting for
+        self._track = None
+        self._start_task = None
+        self._commands = asyncio.Queue()
+        self._task = bot.loop.create_task(self._run())
+
+    # ----- called by the rest of the bot -----
+
+    @property
+    def active(self):
+        return self.state != self.IDLE
+
+    def enqueue_many(self, songs, *, channel=None, dedupe=False):
+        """Append `songs` to the queue in one step and start playing if idle.
+
+        With `dedupe`, songs already queued or playing (or repeated within
+        `songs`) are left out. Returns the songs that were added.
+        """
+        if channel is not None:
+            self.channel = channel
+        if dedupe:
+            seen = {song.video_id or song.url for song in self.queue}
+            if self.current is not None:
+                seen.add(self.current.video_id or self.current.url)
+            fresh = []
+            for song in songs:
+                key = song.video_id or song.url
+                if key not in seen:
+                    seen.add(key)
+                    fresh.append(song)
+            songs = fresh
+        else:
+            songs = list(songs)
+        if not songs:
+            return songs
+        self.queue.extend(songs)
+        self.refresh_prefetch()
+        if self.state == self.IDLE:
+            self._post('play')
+        return songs
+
+    def clear(self):
+        self.queue.clear()
+        self._drop_feeds()
+        self.refresh_prefetch()
+
+    def shuffle(self):
+        songs = list(self.queue)
+        random.shuffle(songs)
+        self.queue.clear()
+        self.queue.extend(songs)
+        self.refresh_prefetch()
+
+    def upcoming(self):
+        """The entry that will play when the current song ends."""
+        if self.loop_mode == 1 and self.current:
+            return self.current
+        if self.queue:
+            return self.queue[0]
+        return self.current if self.loop_mode == 2 else None
+
+    def refresh_prefetch(self):
+        """Re-target the prefetch after anything that may change what plays next.
+
+        Also marks the guild's player state for the next snapshot.
+        """
+        self.prefetcher.schedule(self.upcoming())
+        self.bot.mark_state_dirty(self.guild.id)
+        self._maybe_refill()
+
+    def add_feed(self, feed):
+        """Queue the rest of a playlist a window at a time, once the queue runs low."""
+        self.feeds.append(feed)
+        self._maybe_refill()
+
+    def _maybe_refill(self):
+        if not self.feeds or len(self.queue) >= PLAYLIST_REFILL_AT:
+            return
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = self.bot.loop.create_task(self._refill(self.feeds[0]))
+
+    async def _refill(self, feed):
+        for attempt in range(PLAYLIST_REFILL_ATTEMPTS):
+            try:
+                songs = await feed.next_window(self.guild.id)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error listing YouTube playlist {feed.url} (attempt {attempt + 1}): {e}")
+                FAILURES.inc('youtube_playlist')
+                if playlist_gone(e) or attempt + 1 == PLAYLIST_REFILL_ATTEMPTS:
+                    # The playlist is gone, or keeps failing: give up on the rest of it
+                    songs = []
+                    feed.done = True
+                    break
+                await asyncio.sleep(PLAYLIST_REFILL_RETRY_DELAY * 2 ** attempt)
+        if feed.done and self.feeds and self.feeds[0] is feed:
+            self.feeds.popleft()
+        self._refill_task = None
+        if not self.enqueue_many(songs, dedupe=DEDUPE_IMPORTS):
+            # Nothing new in this window; go on with the next one
+            self._maybe_refill()
+
+    def _drop_feeds(self):
+        self.feeds.clear()
+        task, self._refill_task = self._refill_task, None
+        if task is not None and not task.done():
+            task.cancel()
+
+    async def play(self, start_position=0.0):
+        """Start the queue if nothing is playing, `start_position` seconds into the first song."""
+        return await self._send('play', start_position)
+
+    async def skip(self):
+        return await self._send('skip')
+
+    async def stop(self):
+        return await self._send('stop')
+
+    async def pause(self):
+        return await self._send('pause')
+
+    async def resume(self):
+        return await self._send('resume')
+
+    async def set_loop(self, mode):
+        return await self._send('loop', mode)
+
+    async def set_volume(self, volume):
+        return await self._send('volume', volume)
+
+    async def disconnect(self):
+        return await self._send('disconnect')
+
+    def close(self):
+        self._cancel_start()
+        self._drop_feeds()
+        self.prefetcher.invalidate()
+        self._task.cancel()
+
+    # ----- command handling (runs on the player's task) -----
+
+    def _post(self, command, *args):
+        self._commands.put_nowait((command, args, None))
+
+    async def _send(self, command, *args):
+        done = self.bot.loop.create_future()
+        self._commands.put_nowait((command, args, done))
+        return await done
+
+    def _post_threadsafe(self, command, *args):
+        try:
+            self.bot.loop.call_soon_threadsafe(self._post, command, *args)
+        except RuntimeError:
+            # Event loop already closed: shutting down
+            pass
+
+    async def _run(self):
+        while True:
+            command, args, done = await self._commands.get()
+            try:
+                result = await getattr(self, f'_on_{command}')(*args)
+            except Exception as e:
+                print(f'Player error in guild {self.guild.id} ({command}): {e}')
+                FAILURES.inc('player')
+                if done is not None and not done.done():
+                    done.set_exception(e)
+            else:
+                if done is not None and not done.done():
+                    done.set_result(result)
+
+    async def _on_play(self, start_position=0.0):
+        if self.state == self.IDLE and self.queue:
+            self._begin(start_position)
+            return True
+        return False
+
+    async def _on_track_end(self, track, error):
+        if track is not self._track:
+            # From a track that was stopped or replaced on purpose
+            return
+        self._track = None
+        if error:
+            print(f'Player error: {error}')
+            FAILURES.inc('player')
+        if self.current is not None:
+            if self.loop_mode == 1:
+                self.queue.appendleft(self.current)
+            elif self.loop_mode == 2:
+                self.queue.append(self.current)
+        self._next()
+
+    async def _on_skip(self):
+        if self.state == self.STARTING:
+            # Drop the song that was about to start
+            self._cancel_start()
+            self.current = None
+            self._next()
+            return True
+        vc = self.guild.voice_client
+        if vc and (vc.is_playing() or vc.is_paused()):
+            # The track-end event moves on to the next song
+            vc.stop()
+            return True
+        return False
+
+    async def _on_stop(self):
+        self.queue.clear()
+        self._drop_feeds()
+        self.current = None
+        self._cancel_start()
+        self._track = None
+        vc = self.guild.voice_client
+        if vc:
+            vc.stop()
+        self._idle()
+
+    async def _on_pause(self):
+        vc = self.guild.voice_client
+        if self.state == self.PLAYING and vc and vc.is_playing():
+            vc.pause()
+            self.state = self.PAUSED
+            return True
+        return False
+
+    async def _on_resume(self):
+        vc = self.guild.voice_client
+        if self.state == self.PAUSED and vc and vc.is_paused():
+            vc.resume()
+            self.state = self.PLAYING
+            return True
+        return False
+
+    async def _on_loop(self, mode):
+        self.loop_mode = mode
+        self.refresh_prefetch()
+
+    async def _on_volume(self, volume):
+        self.volume = volume
+        # A prefetched Opus source has the old volume baked in
+        self.prefetcher.invalidate()
+        self.refresh_prefetch()
+        vc = self.guild.voice_client
+        source = vc.source if vc else None
+        if isinstance(source, OpusTrackSource):
+            if source.volume == volume:
+                return
+            # ffmpeg applies the volume, so restart it where the old one is now
+            new_source = await create_source(source.resolved, volume=volume, position=source.position)
+            if vc.source is not source:
+                # The song changed while ffmpeg was starting
+                new_source.cleanup()
+                return
+            paused = vc.is_paused()
+            try:
+                vc.source = new_source
+            except ValueError:
+                new_source.cleanup()
+                return
+            if paused:
+                # Swapping the source resumes the player
+                vc.pause()
+            source.cleanup()
+        elif source is not None:
+            source.volume = volume
+
+    async def _on_disconnect(self):
+        await self._on_stop()
+        self.prefetcher.invalidate()
+        vc = self.guild.voice_client
+        if vc:
+            await vc.disconnect()
 
-ffmpeg_options = {
-    'before_options': ffmpeg_before_headers,
-    'options': '-vn'
-}
+    # ----- starting songs -----
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
+    def _begin(self, start_position=0.0):
+        self.state = self.STARTING
+        self._start_task = self.bot.loop.create_task(self._start_next(start_position))
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
-        self.data = data
-        self.title = data.get('title')
-        self.url = data.get('url')
-        self.duration = data.get('duration')
-        self.thumbnail = data.get('thumbnail')
-        self.uploader = data.get('uploader')
+    def _next(self):
+        if self.queue:
+            self._begin()
+        else:
+            self._idle()
 
-    @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        
-        try:
-            # First attempt with current settings
-            data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
-        except Exception as e:
-            print(f"First extraction attempt failed: {e}")
-            # Fallback with more permissive settings
-            fallback_opts = {
-                'format': 'bestaudio/best/18/worst',
-                'quiet': True,
-                'no_warnings': True,
-                'default_search': 'ytsearch',
-                'source_address': '0.0.0.0',
-                'http_headers': ytdl_format_options.get('http_headers'),
-                'extractor_args': ytdl_format_options.get('extractor_args'),
-                'geo_bypass': True,
-                'extractor_retries': 2
-            }
-            # propagate cookies settings if any
-            if 'cookiefile' in ytdl_format_options:
-                fallback_opts['cookiefile'] = ytdl_format_options['cookiefile']
-            if 'cookiesfrombrowser' in ytdl_format_options:
-                fallback_opts['cookiesfrombrowser'] = ytdl_format_options['cookiesfrombrowser']
-            fallback_ytdl = yt_dlp.YoutubeDL(fallback_opts)
+    def _idle(self):
+        self.state = self.IDLE
+        self.current = None
+        self.refresh_prefetch()
+        vc = self.guild.voice_client
+        if vc and not (vc.is_playing() or vc.is_paused()):
+            self.bot.schedule_cleanup(self.guild.id, random.randint(60, 120))
+
+    def _cancel_start(self):
+        task, self._start_task = self._start_task, None
+        if task is not None and not task.done():
+            task.cancel()
+
+    async def _start_next(self, start_position=0.0):
+        """Start the first song that works; gives up after MAX_FAILED_TRACKS in a row."""
+        failed = 0
+        while self.queue:
+            vc = self.guild.voice_client
+            if vc is None:
+                break
+            song = self.queue.popleft()
+            self.current = song
+            started = time.perf_counter()
+            opened = await self._open(song, start_position)
+            start_position = 0.0
+            if opened is None:
+                failed += 1
+                self.current = None
+                if failed >= MAX_FAILED_TRACKS:
+                    await self._say(f"❌ {failed} songs in a row could not be played, stopping here.")
+                    break
+                await asyncio.sleep(PLAY_RETRY_DELAY * failed)
+                continue
+            source, kind = opened
+            vc = self.guild.voice_client
+            if vc is None:
+                # Disconnected while it was opening; the song waits for the next start
+                source.cleanup()
+                self.queue.appendleft(song)
+                break
+            source.on_first_frame = lambda: self.bot.record_ttfa(kind, time.perf_counter() - started)
+            track = self._track = object()
             try:
-                data = await loop.run_in_executor(None, lambda: fallback_ytdl.extract_info(url, download=not stream))
-            except Exception as e2:
-                print(f"Fallback extraction also failed: {e2}")
-                raise e2
-        
-        if 'entries' in data:
-            data = data['entries'][0]
-        
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+                vc.play(source, after=lambda error: self._post_threadsafe('track_end', track, error))
+            except Exception as e:
+                # e.g. 'Not connected to voice.' when a disconnect races the start
+                print(f"Could not start {song.title} in guild {self.guild.id}: {e}")
+                FAILURES.inc('playback')
+                source.cleanup()
+                self._track = None
+                self.queue.appendleft(song)
+                break
+            self.state = self.PLAYING
+            audio_cache.record_play(song)
+            self.bot.cancel_cleanup(self.guild.id)
+            self.refresh_prefetch()
+            # The announcement doesn't hold up this task or the next command
+            messages.submit(self._announce(song))
+            return
+        self._idle()
+
+    async def _open(self, song, start_position):
+        """(source, kind) for `song`, trying PLAY_ATTEMPTS times; None if it can't be played."""
+        error = None
+        for attempt in range(PLAY_ATTEMPTS):
+            try:
+                return await self._create_source(song, start_position)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error playing song: {e}")
+                FAILURES.inc('playback')
+                error = e
+                # The stored stream URL may be what failed; extract afresh next time
+                song.resolved = None
+                if attempt + 1 < PLAY_ATTEMPTS:
+                    await asyncio.sleep(PLAY_RETRY_DELAY * 2 ** attempt)
+        if song.video_id and video_gone(error):
+            forget_video(song.video_id)
+        return None
+
+    async def _create_source(self, song, start_position):
+        source = await self.prefetcher.claim(song)
+        if source is not None and start_position:
+            # Prefetched sources start at the beginning
+            source.cleanup()
+            source = None
+        if isinstance(source, OpusTrackSource) and source.volume != self.volume:
+            source.cleanup()
+            source = None
+        local = audio_cache.lookup(song.video_id)
+        resolved = song.resolved
+        if source is not None:
+            source.volume = self.volume
+            return source, 'prefetched'
+        if local:
+            return await create_source(local, volume=self.volume, position=start_position), 'local'
+        if resolved and resolved.is_valid():
+            return await create_source(resolved, volume=self.volume, position=start_position), 'resolved'
+        # Never resolved, or the stream URL has expired: extract again
+        resolved = await YTDLSource.resolve(song.url, guild_id=self.guild.id)
+        song.resolved = resolved
+        return await create_source(resolved, volume=self.volume, position=start_position), 'cold'
+
+    async def _say(self, content=None, **kwargs):
+        if self.channel is None:
+            return None
+        return await messages.send(self.channel, content, **kwargs)
+
+    async def _announce(self, song):
+        # Remove any previous control panels so only the new message has buttons
+        self.bot.remove_controls(self.guild.id)
+        embed = discord.Embed(
+            title="🎵 Now Playing",
+            description=f"**{song.title}**",
+            color=0x00ff00,
+        )
+        if song.duration:
+            embed.add_field(
+                name="Duration",
+                value=f"{song.duration // 60}:{song.duration % 60:02d}",
+                inline=True,
+            )
+        if song.uploader:
+            embed.add_field(name="Uploader", value=song.uploader, inline=True)
+        if song.thumbnail:
+            embed.set_thumbnail(url=song.thumbnail)
+        embed.set_footer(text=f"Requested by {song.requester_name}")
 
-class MusicBot(commands.Bot):
+        msg = await self._say(embed=embed, view=MusicControlView(self.bot))
+        if msg is None:
+            return
+        if self.current is not song:
+            # The next song started while this was being sent
+            messages.remove_views([msg])
+            return
+        self.bot.register_control_message(self.guild.id, msg)
+
+class MusicBot(commands.AutoShardedBot):
     def __init__(self):
+        if SHARD_IDS is not None:
+            if SHARD_COUNT is None:
+                raise ValueError("SHARD_IDS is set without SHARD_COUNT; set both (shard_launcher.py does)")
+            if any(not 0 <= shard_id < SHARD_COUNT for shard_id in SHARD_IDS):
+                raise ValueError(f"SHARD_IDS {SHARD_IDS} must all be below SHARD_COUNT={SHARD_COUNT}")
         intents = discord.Intents.default()
         intents.message_content = True
-        super().__init__(command_prefix='!', intents=intents, help_command=None)
+        super().__init__(command_prefix='!', intents=intents, help_command=None,
+                         shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
         
-        # Music queue and state
-        self.queues = {}
-        self.current_song = {}
-        self.loop_mode = {}  # 0: no loop, 1: loop song, 2: loop queue
+        # GuildPlayer per guild ID. A process only sees guilds on its own
+        # shards, so nothing is shared between processes.
+        self.players = {}
         # Track control panel messages per guild for later cleanup
         self.control_messages = {}
         # Track scheduled cleanup tasks per guild
         self._cleanup_tasks = {}
+        # Time-to-first-audio samples (seconds), keyed by how the source was obtained:
+        # cold = extracted when the song starts, resolved = stored URL, prefetched = ffmpeg pre-started
+        # local = played from the audio cache
+        self.ttfa_samples = {kind: deque(maxlen=200) for kind in ('cold', 'resolved', 'prefetched', 'local')}
+        # Guilds whose player state changed since the last snapshot
+        self._dirty_state = set()
+        # Guilds with a saved snapshot that hasn't been restored yet
+        self._restore_pending = set()
+        self._snapshot_task = None
+        self._flush_task = None
+        self._strategy_task = None
         
+    async def setup_hook(self):
+        if METRICS_PORT:
+            try:
+                await metrics.start(METRICS_HOST, METRICS_PORT)
+                print(f'Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics')
+            except OSError as e:
+                print(f'Could not start the metrics endpoint: {e}')
+        self._flush_task = self.loop.create_task(self._flush_loop())
+        self._strategy_task = self.loop.create_task(self._strategy_save_loop())
+        for store in (resolution_cache, spotify_matches, extraction_strategies, audio_cache, player_state):
+            store.open()
+        # setup_hook runs right after the token has been accepted
+        mark_startup('login')
+
     async def on_ready(self):
+        if mark_startup('ready') and STARTUP_WARMUP:
+            self.loop.create_task(self.warm_up())
         print(f'🎵 {self.user} has connected to Discord!')
         print(f'Bot is ready in {len(self.guilds)} guilds')
+        shards = self.shard_ids if self.shard_ids is not None else list(self.shards)
+        print(f'Running shards {shards} of {self.shard_count}')
         
         # Set bot status
         activity = discord.Activity(type=discord.ActivityType.listening, name="!commands for help")
         await self.change_presence(activity=activity)
 
-    def get_queue(self, guild_id):
-        if guild_id not in self.queues:
-            self.queues[guild_id] = deque()
-        return self.queues[guild_id]
+        # on_ready fires again after reconnects; restore only once
+        if PLAYER_SNAPSHOT_INTERVAL > 0 and self._snapshot_task is None:
+            self._restore_pending = set(player_state.pending(self.owns_guild))
+            if self._restore_pending:
+                print(f'Restoring players in {len(self._restore_pending)} guilds')
+                self.loop.create_task(self.restore_players())
+            self._snapshot_task = self.loop.create_task(self._snapshot_loop())
+
+    async def close(self):
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            # Save the latest positions before the voice clients are torn down
+            self._dirty_state.update(vc.guild.id for vc in self.voice_clients)
+            self.snapshot_state()
+        for task in (self._flush_task, self._strategy_task):
+            if task is not None:
+                task.cancel()
+        resolution_cache.flush()
+        audio_cache.flush()
+        extraction_strategies.save()
+        if spotify is not None:
+            await spotify.close()
+        await metrics.stop()
+        await super().close()
+
+    async def warm_up(self):
+        """Do the one-off work the first requests would otherwise wait for."""
+        if extraction_scheduler.mode == 'thread':
+            # Imports yt_dlp too; off the event loop and the extraction workers
+            await self.loop.run_in_executor(None, warm_ytdl_pools)
+        if SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET:
+            try:
+                await get_spotify()._get_token()
+            except Exception as e:
+                print(f'Could not get a Spotify token: {e}')
+                FAILURES.inc('spotify')
+        mark_startup('warm')
+
+    async def _snapshot_loop(self):
+        while not self.is_closed():
+            await asyncio.sleep(PLAYER_SNAPSHOT_INTERVAL)
+            try:
+                self.snapshot_state()
+            except Exception as e:
+                print(f'Error saving player state: {e}')
+                FAILURES.inc('snapshot')
+
+    async def _strategy_save_loop(self):
+        while not self.is_closed():
+            await asyncio.sleep(EXTRACTION_STATS_SAVE_INTERVAL)
+            try:
+                extraction_strategies.save()
+            except Exception as e:
+                print(f'Error saving extraction stats: {e}')
+                FAILURES.inc('extraction_stats')
+
+    async def _flush_loop(self):
+        while not self.is_closed():
+            await asyncio.sleep(CACHE_FLUSH_INTERVAL)
+            try:
+                resolution_cache.flush()
+                audio_cache.flush()
+            except Exception as e:
+                print(f'Error flushing the cache database: {e}')
+                FAILURES.inc('cache_flush')
+
+    def owns_guild(self, guild_id: int) -> bool:
+        """Whether `guild_id` is on one of the shards this process runs."""
+        if self.shard_ids is None or self.shard_count is None:
+            return True
+        return shard_of(guild_id, self.shard_count) in self.shard_ids
+
+    def mark_state_dirty(self, guild_id: int):
+        self._dirty_state.add(guild_id)
+
+    def snapshot_state(self):
+        """Save guilds whose state changed; refresh the position of the rest."""
+        dirty, self._dirty_state = self._dirty_state, set()
+        for guild_id in dirty:
+            if guild_id in self._restore_pending:
+                continue
+            guild = self.get_guild(guild_id)
+            vc = guild.voice_client if guild else None
+            player = self.players.get(guild_id)
+            queue = player.queue if player else ()
+            playing = player is not None and player.state in (GuildPlayer.PLAYING, GuildPlayer.PAUSED)
+            current = player.current if playing else None
+            if vc is None or not (current or queue):
+                player_state.delete(guild_id)
+                continue
+            player_state.save(
+                guild_id,
+                voice_channel_id=vc.channel.id,
+                text_channel_id=player.channel.id if player.channel else None,
+                loop_mode=player.loop_mode,
+                volume=player.volume,
+                position=getattr(vc.source, 'position', 0.0) if current else 0.0,
+                current=current,
+                queue=queue,
+            )
+        player_state.save_positions({
+            vc.guild.id: vc.source.position
+            for vc in self.voice_clients
+            if vc.guild.id not in dirty and vc.is_playing() and hasattr(vc.source, 'position')
+        })
+
+    async def restore_players(self):
+        """Rejoin voice and resume playback in every guild with a snapshot.
+
+        Runs in the background after on_ready, a few guilds at a time, so
+        startup doesn't wait on it.
+        """
+        limit = asyncio.Semaphore(RESTORE_CONCURRENCY)
+
+        async def restore(guild_id):
+            async with limit:
+                try:
+                    await self.restore_player(guild_id)
+                except Exception as e:
+                    print(f'Error restoring player in guild {guild_id}: {e}')
+                    FAILURES.inc('restore')
+
+        await asyncio.gather(*(restore(guild_id) for guild_id in list(self._restore_pending)))
+
+    async def restore_player(self, guild_id: int):
+        if guild_id not in self._restore_pending:
+            return
+        self._restore_pending.discard(guild_id)
+        guild = self.get_guild(guild_id)
+        state = player_state.load(guild_id)
+        if guild is None or state is None:
+            return
+        channel = guild.get_channel(state['voice_channel_id'])
+        listeners = [m for m in channel.members if not m.bot] if channel else []
+        player = self.players.get(guild_id)
+        if not listeners or guild.voice_client or (player and (player.queue or player.active)):
+            # Channel gone or empty, or someone already started a new session
+            player_state.delete(guild_id)
+            return
+
+        player = self.get_player(guild)
+        player.queue.extend(state['queue'])
+        if state['current']:
+            player.queue.appendleft(state['current'])
+        player.loop_mode = state['loop_mode']
+        if state['volume'] is not None:
+            player.volume = state['volume']
+        player.channel = guild.get_channel(state['text_channel_id'] or 0) or channel
+
+        await channel.connect()
+        player_state.restores += 1
+        position = state['position'] if state['current'] else 0.0
+        await player.play(position)
+
+    def get_player(self, guild: discord.Guild) -> GuildPlayer:
+        player = self.players.get(guild.id)
+        if player is None:
+            player = self.players[guild.id] = GuildPlayer(self, guild)
+        return player
 
     def register_control_message(self, guild_id: int, message: discord.Message):
         arr = self.control_messages.get(guild_id)
@@ -173,14 +2894,11 @@ class MusicBot(commands.Bot):
             self.control_messages[guild_id] = arr
         arr.append(message)
 
-    async def remove_controls(self, guild_id: int):
+    def remove_controls(self, guild_id: int):
+        """Strip the buttons off the guild's control panels, in the background."""
         arr = self.control_messages.get(guild_id) or []
         self.control_messages[guild_id] = []
-        for msg in arr:
-            try:
-                await msg.edit(view=None)
-            except Exception:
-                pass
+        messages.remove_views(arr)
 
     def cancel_cleanup(self, guild_id: int):
         task = self._cleanup_tasks.get(guild_id)
@@ -194,13 +2912,35 @@ class MusicBot(commands.Bot):
         async def _job():
             try:
                 await asyncio.sleep(delay_seconds)
-                await self.remove_controls(guild_id)
+                self.remove_controls(guild_id)
             except asyncio.CancelledError:
                 return
         self._cleanup_tasks[guild_id] = self.loop.create_task(_job())
 
+    def get_volume(self, guild_id: int) -> float:
+        player = self.players.get(guild_id)
+        return player.volume if player else DEFAULT_VOLUME
+
+    def record_ttfa(self, kind: str, seconds: float):
+        # Runs on the audio thread; deque.append is thread-safe
+        self.ttfa_samples[kind].append(seconds)
+        TTFA_SECONDS.observe(seconds, kind)
+
 bot = MusicBot()
 
+metrics.register(Gauge('musicbot_voice_clients', 'Connected voice clients', lambda: len(bot.voice_clients)))
+metrics.register(Gauge(
+    'musicbot_queue_depth', 'Tracks waiting in each non-empty guild queue',
+    lambda: {(guild_id,): len(player.queue) for guild_id, player in list(bot.players.items()) if player.queue},
+    ('guild_id',)))
+metrics.register(Gauge(
+    'musicbot_extraction_backlog', 'Extractions waiting for a worker',
+    lambda: {(name,): count for name, count in extraction_scheduler.stats()['queued'].items()}, ('priority',)))
+metrics.register(Gauge(
+    'musicbot_extraction_workers_busy', 'Extraction workers currently running a job',
+    lambda: extraction_scheduler.stats()['active']))
+metrics.register(Gauge('musicbot_ffmpeg_processes', 'Running ffmpeg processes started for playback', _live_ffmpeg_processes))
+
 # ===== Button-based Controls (UI View) =====
 class MusicControlView(discord.ui.View):
     def __init__(self, bot: MusicBot):
@@ -229,12 +2969,10 @@ class MusicControlView(discord.ui.View):
         ok, msg = self._same_voice(interaction)
         if not ok:
             return await self._send_ephemeral(interaction, f"❌ {msg}")
-        vc = interaction.guild.voice_client
-        if vc.is_paused():
-            vc.resume()
+        player = self.bot.get_player(interaction.guild)
+        if await player.resume():
             await self._send_ephemeral(interaction, "▶️ Resumed")
-        elif vc.is_playing():
-            vc.pause()
+        elif await player.pause():
             await self._send_ephemeral(interaction, "⏸️ Paused")
         else:
             await self._send_ephemeral(interaction, "ℹ️ Nothing to play or already stopped.")
@@ -244,9 +2982,7 @@ class MusicControlView(discord.ui.View):
         ok, msg = self._same_voice(interaction)
         if not ok:
             return await self._send_ephemeral(interaction, f"❌ {msg}")
-        vc = interaction.guild.voice_client
-        if vc and (vc.is_playing() or vc.is_paused()):
-            vc.stop()
+        if await self.bot.get_player(interaction.guild).skip():
             await self._send_ephemeral(interaction, "⏭️ Skipped")
         else:
             await self._send_ephemeral(interaction, "ℹ️ Nothing to skip.")
@@ -258,8 +2994,7 @@ class MusicControlView(discord.ui.View):
             return await self._send_ephemeral(interaction, f"❌ {msg}")
         vc = interaction.guild.voice_client
         if vc:
-            vc.stop()
-            self.bot.get_queue(interaction.guild.id).clear()
+            await self.bot.get_player(interaction.guild).stop()
             await self._send_ephemeral(interaction, "⏹️ Stopped and cleared queue")
         else:
             await self._send_ephemeral(interaction, "ℹ️ I'm not connected.")
@@ -269,10 +3004,9 @@ class MusicControlView(discord.ui.View):
         ok, msg = self._same_voice(interaction)
         if not ok:
             return await self._send_ephemeral(interaction, f"❌ {msg}")
-        gid = interaction.guild.id
-        mode = self.bot.loop_mode.get(gid, 0)
-        mode = (mode + 1) % 3
-        self.bot.loop_mode[gid] = mode
+        player = self.bot.get_player(interaction.guild)
+        mode = (player.loop_mode + 1) % 3
+        await player.set_loop(mode)
         modes = {0: "Off", 1: "Song", 2: "Queue"}
         await self._send_ephemeral(interaction, f"🔁 Loop mode: {modes[mode]}")
 
@@ -281,14 +3015,10 @@ class MusicControlView(discord.ui.View):
         ok, msg = self._same_voice(interaction)
         if not ok:
             return await self._send_ephemeral(interaction, f"❌ {msg}")
-        q = self.bot.get_queue(interaction.guild.id)
-        if len(q) < 2:
+        player = self.bot.get_player(interaction.guild)
+        if len(player.queue) < 2:
             return await self._send_ephemeral(interaction, "ℹ️ Need at least 2 songs to shuffle.")
-        import random as _rand
-        _list = list(q)
-        _rand.shuffle(_list)
-        q.clear()
-        q.extend(_list)
+        player.shuffle()
         await self._send_ephemeral(interaction, "🔀 Queue shuffled")
 
     @discord.ui.button(label="Vol -", style=discord.ButtonStyle.secondary, emoji="🔉")
@@ -299,9 +3029,10 @@ class MusicControlView(discord.ui.View):
         vc = interaction.guild.voice_client
         if not vc or not vc.source:
             return await self._send_ephemeral(interaction, "ℹ️ Nothing is playing.")
-        vol = getattr(vc.source, 'volume', 0.5)
-        new = max(0.0, vol - 0.1)
-        vc.source.volume = new
+        player = self.bot.get_player(interaction.guild)
+        vol = player.volume
+        new = round(max(0.0, vol - 0.1), 2)
+        await player.set_volume(new)
         await self._send_ephemeral(interaction, f"🔉 Volume: {int(new*100)}%")
 
     @discord.ui.button(label="Vol +", style=discord.ButtonStyle.secondary, emoji="🔊")
@@ -312,35 +3043,36 @@ class MusicControlView(discord.ui.View):
         vc = interaction.guild.voice_client
         if not vc or not vc.source:
             return await self._send_ephemeral(interaction, "ℹ️ Nothing is playing.")
-        vol = getattr(vc.source, 'volume', 0.5)
-        new = min(1.0, vol + 0.1)
-        vc.source.volume = new
+        player = self.bot.get_player(interaction.guild)
+        vol = player.volume
+        new = round(min(1.0, vol + 0.1), 2)
+        await player.set_volume(new)
         await self._send_ephemeral(interaction, f"🔊 Volume: {int(new*100)}%")
 
     @discord.ui.button(label="Queue", style=discord.ButtonStyle.secondary, emoji="📜")
     async def queue_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        q = self.bot.get_queue(interaction.guild.id)
+        q = self.bot.get_player(interaction.guild).queue
         if not q:
             return await self._send_ephemeral(interaction, "📝 Queue is empty.")
         out = []
         for i, s in enumerate(list(q)[:10], 1):
-            out.append(f"{i}. {s['title']}")
+            out.append(f"{i}. {s.title}")
         text = "\n".join(out)
         await self._send_ephemeral(interaction, f"📝 Up Next:\n{text}")
 
     @discord.ui.button(label="Now", style=discord.ButtonStyle.secondary, emoji="🎵")
     async def now_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        current = self.bot.current_song.get(interaction.guild.id)
+        current = self.bot.get_player(interaction.guild).current
         vc = interaction.guild.voice_client
         if not current or not vc or not (vc.is_playing() or vc.is_paused()):
             return await self._send_ephemeral(interaction, "ℹ️ Nothing is currently playing.")
-        embed = discord.Embed(title="🎵 Now Playing", description=f"**{current['title']}**", color=0x00ff00)
-        if current.get('duration'):
-            embed.add_field(name="Duration", value=f"{current['duration'] // 60}:{current['duration'] % 60:02d}", inline=True)
-        if current.get('uploader'):
-            embed.add_field(name="Uploader", value=current['uploader'], inline=True)
-        if current.get('thumbnail'):
-            embed.set_thumbnail(url=current['thumbnail'])
+        embed = discord.Embed(title="🎵 Now Playing", description=f"**{current.title}**", color=0x00ff00)
+        if current.duration:
+            embed.add_field(name="Duration", value=f"{current.duration // 60}:{current.duration % 60:02d}", inline=True)
+        if current.uploader:
+            embed.add_field(name="Uploader", value=current.uploader, inline=True)
+        if current.thumbnail:
+            embed.set_thumbnail(url=current.thumbnail)
         if interaction.response.is_done():
             await interaction.followup.send(embed=embed, ephemeral=True)
         else:
@@ -353,7 +3085,7 @@ class MusicControlView(discord.ui.View):
             return await self._send_ephemeral(interaction, f"❌ {msg}")
         vc = interaction.guild.voice_client
         if vc:
-            await vc.disconnect()
+            await self.bot.get_player(interaction.guild).disconnect()
             await self._send_ephemeral(interaction, "👋 Disconnected")
         else:
             await self._send_ephemeral(interaction, "ℹ️ I'm not connected.")
@@ -388,148 +3120,355 @@ async def leave(ctx):
         await ctx.send(embed=embed)
         return
     
-    # Clear queue and stop current song
-    if ctx.guild.id in bot.queues:
-        bot.queues[ctx.guild.id].clear()
-    
-    await ctx.voice_client.disconnect()
+    # Clear queue, stop current song and disconnect
+    await bot.get_player(ctx.guild).disconnect()
     # Remove controls right away and cancel any pending cleanup
-    await bot.remove_controls(ctx.guild.id)
+    bot.remove_controls(ctx.guild.id)
     bot.cancel_cleanup(ctx.guild.id)
     
     embed = discord.Embed(title="👋 Disconnected", description="Left the voice channel", color=0xff9900)
     await ctx.send(embed=embed)
 
-def extract_spotify_info(url):
-    """Extract Spotify track/playlist info"""
+def spotify_track_info(track):
+    """The parts of a Spotify track object the bot needs."""
+    return {
+        'id': track.get('id'),
+        'name': track['name'],
+        'artist': ', '.join([artist['name'] for artist in track['artists']]),
+        'duration_ms': track.get('duration_ms'),
+        'isrc': (track.get('external_ids') or {}).get('isrc'),
+        'search_query': f"{track['name']} {track['artists'][0]['name']}"
+    }
+
+async def _spotify_tracks(tracks):
+    """spotify_track_info for each track of a list or async iterator of Spotify tracks."""
+    if not hasattr(tracks, '__aiter__'):
+        for track in tracks:
+            yield spotify_track_info(track)
+        return
+    try:
+        async for track in tracks:
+            yield spotify_track_info(track)
+    finally:
+        await tracks.aclose()
+
+# open.spotify.com links, with or without a locale segment (/intl-de/track/...)
+SPOTIFY_LINK_RE = re.compile(r'spotify\.com/(?:intl-[\w-]+/)?(track|album|playlist|artist)/([\w-]+)')
+
+# How each kind of multi-track import is named in status messages
+SPOTIFY_IMPORT_TITLES = {'playlist': 'Playlist', 'album': 'Album', 'artist': 'Top Tracks', 'tracks': 'Tracks'}
+
+async def extract_spotify_info(url):
+    """Extract Spotify track/playlist/album/artist info.
+
+    Several track links in one message come back as type 'tracks', fetched
+    BATCH_TRACKS per request. Everything but a single track has its tracks
+    as an async iterator that streams in page by page.
+    """
+    links = SPOTIFY_LINK_RE.findall(url)
+    if not links:
+        return None
     try:
-        if 'track/' in url:
-            track_id = url.split('track/')[-1].split('?')[0]
-            track = spotify.track(track_id)
+        track_ids = [item_id for kind, item_id in links if kind == 'track']
+        if len(track_ids) > 1:
             return {
-                'type': 'track',
-                'name': track['name'],
-                'artist': ', '.join([artist['name'] for artist in track['artists']]),
-                'search_query': f"{track['name']} {track['artists'][0]['name']}"
+                'type': 'tracks',
+                'name': f'{len(track_ids)} Spotify tracks',
+                'total': len(track_ids),
+                'tracks': _spotify_tracks(get_spotify().iter_tracks(track_ids))
             }
-        elif 'playlist/' in url:
-            playlist_id = url.split('playlist/')[-1].split('?')[0]
-            playlist = spotify.playlist(playlist_id)
-            tracks = []
-            for item in playlist['tracks']['items']:
-                if item['track']:
-                    track = item['track']
-                    tracks.append({
-                        'name': track['name'],
-                        'artist': ', '.join([artist['name'] for artist in track['artists']]),
-                        'search_query': f"{track['name']} {track['artists'][0]['name']}"
-                    })
+        kind, item_id = links[0]
+        if kind == 'track':
+            track = await get_spotify().track(item_id)
+            return {'type': 'track', **spotify_track_info(track)}
+        elif kind == 'playlist':
+            playlist = await get_spotify().playlist(item_id)
             return {
                 'type': 'playlist',
                 'name': playlist['name'],
-                'tracks': tracks
+                'total': playlist['tracks']['total'],
+                'tracks': _spotify_tracks(get_spotify().iter_playlist_tracks(item_id))
             }
+        elif kind == 'album':
+            album = await get_spotify().album(item_id)
+            artists = ', '.join(artist['name'] for artist in album.get('artists') or [])
+            return {
+                'type': 'album',
+                'name': f"{album['name']} - {artists}" if artists else album['name'],
+                'total': album['tracks']['total'],
+                'tracks': _spotify_tracks(get_spotify().iter_album_tracks(album))
+            }
+        elif kind == 'artist':
+            artist, top_tracks = await asyncio.gather(get_spotify().artist(item_id),
+                                                      get_spotify().artist_top_tracks(item_id))
+            return {
+                'type': 'artist',
+                'name': artist['name'],
+                'total': len(top_tracks),
+                'tracks': _spotify_tracks(top_tracks)
+            }
+    except SpotifyAuthError:
+        # A configuration problem, not a bad URL; on_command_error reports it
+        raise
     except Exception as e:
         print(f"Spotify error: {e}")
+        FAILURES.inc('spotify')
+        return None
+
+# Words that mark a different version of a song than the one asked for
+VERSION_WORDS = frozenset((
+    'live', 'cover', 'remix', 'karaoke', 'instrumental', 'acoustic', 'sped', 'slowed',
+    'reverb', 'nightcore', '8d', 'reaction', 'tutorial', 'lesson',
+))
+
+def _words(text):
+    return set(re.findall(r'\w+', (text or '').lower()))
+
+def match_score(entry, track):
+    """How well a search result matches a Spotify track (higher is better, at most 1)."""
+    title = _words(entry.get('title'))
+    channel = _words(entry.get('channel') or entry.get('uploader'))
+    name = _words(track.get('name'))
+    artist = _words(track.get('artist'))
+    score = 0.0
+    if name:
+        score += 0.5 * len(name & title) / len(name)
+    if artist:
+        score += 0.25 * len(artist & (title | channel)) / len(artist)
+    if (VERSION_WORDS & title) - name:
+        score -= 0.3
+    wanted = (track.get('duration_ms') or 0) / 1000
+    duration = entry.get('duration')
+    if wanted and duration:
+        # Full marks within 3 seconds of the Spotify duration, none from 30 off
+        score += 0.25 * max(0.0, 1 - max(0.0, abs(duration - wanted) - 3) / 27)
+    return score
+
+def pick_candidate(entries, track=None):
+    """The search result that best matches `track`; YouTube's order breaks ties."""
+    entries = [entry for entry in entries if entry and entry.get('id')]
+    if not entries:
+        return None
+    if track is None:
+        return entries[0]
+    return max(enumerate(entries), key=lambda item: match_score(item[1], track) - 0.02 * item[0])[1]
+
+async def _flat_search(query, track, guild_id, priority):
+    """Best of the top SEARCH_CANDIDATES results, listed without resolving any of them."""
+    data = await extract_info(f"ytsearch{SEARCH_CANDIDATES}:{query}", profile='search',
+                              guild_id=guild_id, priority=priority)
+    entry = pick_candidate(data.get('entries') or [], track)
+    if entry is None:
         return None
+    video_id = entry['id']
+    return {
+        'id': video_id,
+        'title': entry.get('title'),
+        'duration': entry.get('duration'),
+        'uploader': entry.get('uploader') or entry.get('channel'),
+        'thumbnail': entry.get('thumbnail') or f'https://i.ytimg.com/vi/{video_id}/hqdefault.jpg',
+        'webpage_url': entry.get('webpage_url') or f'https://www.youtube.com/watch?v={video_id}',
+    }
+
+async def _full_search(query, guild_id, priority):
+    """First result of a regular search, resolved formats and all."""
+    data = await extract_with_strategy('search', f"ytsearch:{query}", guild_id=guild_id, priority=priority)
+    if 'entries' in data and data['entries']:
+        return data['entries'][0]
+    return None
+
+async def search_youtube(query, *, track=None, guild_id=None, priority=PRIORITY_PLAYBACK):
+    """Search YouTube for a query and return the URL of the match, or None.
 
-async def search_youtube(query):
-    """Search YouTube for a query"""
+    With `track` (from spotify_track_info), a match already in the Spotify
+    match index skips the search; otherwise candidates are ranked against the
+    track and the choice is added to the index. The chosen video is cached
+    under its own URL too, so queueing it doesn't search again; its stream
+    is resolved when it is about to play.
+    """
+    weak = False
+    if track is not None:
+        match = spotify_matches.lookup(track)
+        if match and match[1] >= spotify_matches.min_confidence:
+            return f'https://www.youtube.com/watch?v={match[0]}'
+        # A weak match came from this query; its cached result would only repeat it
+        weak = match is not None
+    keys = [normalize_query(query)]
+    cached = None if weak else resolution_cache.get(keys[0])
+    if cached:
+        if track is not None:
+            spotify_matches.put(track, cached.get('id'), match_score(cached, track))
+        return cached['webpage_url']
     try:
-        loop = asyncio.get_event_loop()
-        
-        # Try with main ytdl instance
-        try:
-            data = await loop.run_in_executor(None, lambda: ytdl.extract_info(f"ytsearch:{query}", download=False))
-        except Exception as e:
-            print(f"Main search failed: {e}")
-            # Fallback search with simpler options
-            fallback_ytdl = yt_dlp.YoutubeDL({
-                'format': 'bestaudio/best/18/worst',
-                'quiet': True,
-                'no_warnings': True,
-                'default_search': 'ytsearch',
-                'http_headers': ytdl_format_options.get('http_headers'),
-                'extractor_args': ytdl_format_options.get('extractor_args'),
-                'geo_bypass': True
-            })
-            data = await loop.run_in_executor(None, lambda: fallback_ytdl.extract_info(f"ytsearch:{query}", download=False))
-        
-        if 'entries' in data and data['entries']:
-            return data['entries'][0]['webpage_url']
+        entry = None
+        if SEARCH_CANDIDATES > 0:
+            try:
+                entry = await _flat_search(query, track, guild_id, priority)
+            except Exception as e:
+                print(f"Flat search failed: {e}")
+                FALLBACKS.inc('flat_search')
+        if entry is None:
+            entry = await _full_search(query, guild_id, priority)
+        if entry:
+            if track is not None:
+                spotify_matches.put(track, entry.get('id'), match_score(entry, track))
+            for key in keys:
+                resolution_cache.put(key, entry)
+            # Lets the add_to_queue that usually follows skip its own lookup
+            resolution_cache.put(normalize_query(entry['webpage_url']), entry)
+            return entry['webpage_url']
     except Exception as e:
         print(f"YouTube search error: {e}")
+        FAILURES.inc('search')
     return None
 
-async def add_to_queue(ctx, query: str, custom_title: str | None = None, silent: bool = False):
-    """Resolve a query/URL to a song and add it to the guild queue. Starts playback if idle."""
+def song_from_info(data, requester, custom_title: str | None = None):
+    """Build a queue entry from extracted (or cached) video info."""
+    return QueueEntry(
+        url=data['webpage_url'],
+        title=custom_title or data.get('title') or 'Unknown',
+        duration=int(data.get('duration') or 0),
+        thumbnail=data.get('thumbnail'),
+        uploader=data.get('uploader') or 'Unknown',
+        requester_id=requester.id,
+        requester_name=requester.display_name,
+        video_id=data.get('id'),
+        # Keep the stream URL so the player doesn't have to extract again
+        resolved=ResolvedTrack.from_info(data),
+    )
+
+# Titles YouTube lists in place of videos that can't be played
+UNAVAILABLE_TITLES = frozenset(('[Private video]', '[Deleted video]', '[Unavailable video]'))
+# yt-dlp error texts meaning the playlist itself is gone, so listing it again won't help
+PLAYLIST_GONE_MARKERS = ('playlist does not exist', 'playlist is private', 'playlist is unavailable')
+
+def playlist_gone(error):
+    text = str(error).lower()
+    return video_gone(error) or any(marker in text for marker in PLAYLIST_GONE_MARKERS)
+
+def song_from_entry(entry, requester_id, requester_name):
+    """A placeholder queue entry for a flat playlist entry, or None if it can't play.
+
+    Only the listing's ID, title and duration are known; the stream is
+    resolved once the entry is next in line (see TrackPrefetcher).
+    """
+    video_id = entry.get('id')
+    if not video_id or entry.get('title') in UNAVAILABLE_TITLES:
+        return None
+    return QueueEntry(
+        url=f'https://www.youtube.com/watch?v={video_id}',
+        title=entry.get('title') or 'Unknown',
+        duration=int(entry.get('duration') or 0),
+        thumbnail=f'https://i.ytimg.com/vi/{video_id}/hqdefault.jpg',
+        uploader=entry.get('channel') or entry.get('uploader') or 'Unknown',
+        requester_id=requester_id,
+        requester_name=requester_name,
+        video_id=video_id,
+    )
+
+def youtube_playlist_id(url):
+    """The `list` parameter of a YouTube playlist, mix or watch URL, or None."""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    if not (host == 'youtu.be' or host == 'youtube.com' or host.endswith('.youtube.com')):
+        return None
+    return parse_qs(parsed.query).get('list', [None])[0]
+
+def is_youtube_playlist_page(url):
+    """True for a /playlist?list= link; a video watched from a playlist is just that video."""
+    return youtube_playlist_id(url) is not None and urlparse(url.strip()).path.rstrip('/') == '/playlist'
+
+def is_youtube_mix(url):
+    """True for a video played from a mix (list=RD...); mixes have no playlist page to link to."""
+    list_id = youtube_playlist_id(url)
+    return bool(list_id and list_id.startswith('RD') and _YOUTUBE_ID_RE.search(url))
+
+class PlaylistFeed:
+    """The part of a YouTube playlist not queued yet, listed one window at a time.
+
+    Each next_window() call lists YOUTUBE_PLAYLIST_PAGE entries (flat, from
+    `start` on) and returns them as placeholders; the guild's player asks for
+    the next window when its queue runs low. `done` is set once a window
+    comes back short or YOUTUBE_PLAYLIST_MAX_TRACKS is reached.
+    """
+
+    def __init__(self, url, requester_id, requester_name, *, start=1, skip_id=None):
+        self.url = url
+        self.name = 'YouTube playlist'
+        self.requester_id = requester_id
+        self.requester_name = requester_name
+        self.start = start
+        # A video already queued on its own (the one a watch link points at)
+        self.skip_id = skip_id
+        self.done = start > YOUTUBE_PLAYLIST_MAX_TRACKS
+
+    async def next_window(self, guild_id, priority=PRIORITY_BULK):
+        if self.done:
+            return []
+        end = min(self.start + YOUTUBE_PLAYLIST_PAGE - 1, YOUTUBE_PLAYLIST_MAX_TRACKS)
+        listing = await extract_info(self.url, profile='playlist', items=f'{self.start}-{end}',
+                                     guild_id=guild_id, priority=priority)
+        self.name = listing.get('title') or self.name
+        entries = listing.get('entries') or []
+        self.done = len(entries) <= end - self.start or end >= YOUTUBE_PLAYLIST_MAX_TRACKS
+        self.start = end + 1
+        songs = (song_from_entry(entry, self.requester_id, self.requester_name)
+                 for entry in entries if entry.get('id') != self.skip_id)
+        return [song for song in songs if song]
+
+async def resolve_song(query: str, requester, custom_title: str | None = None, *,
+                       guild_id=None, priority=PRIORITY_PLAYBACK):
+    """Resolve a query/URL to a queue entry without queueing it.
+
+    Cached resolutions skip yt-dlp entirely; their stream URL is looked up
+    later by the prefetcher or the player.
+    """
+    key = normalize_query(query)
+    cached = resolution_cache.get(key)
+    if cached:
+        return song_from_info(cached, requester, custom_title)
+
     try:
-        loop = asyncio.get_event_loop()
-        # Primary extraction
-        try:
-            data = await loop.run_in_executor(None, lambda: ytdl.extract_info(query, download=False))
-        except Exception as e:
-            print(f"Primary extraction failed: {e}")
-            # Fallback extraction
-            fallback_opts = {
-                'format': 'bestaudio/best/18/worst',
-                'quiet': True,
-                'no_warnings': True,
-                'default_search': 'ytsearch',
-                'extract_flat': False,
-                'ignoreerrors': True,
-                'http_headers': ytdl_format_options.get('http_headers'),
-                'extractor_args': ytdl_format_options.get('extractor_args'),
-                'geo_bypass': True
-            }
-            if 'cookiefile' in ytdl_format_options:
-                fallback_opts['cookiefile'] = ytdl_format_options['cookiefile']
-            if 'cookiesfrombrowser' in ytdl_format_options:
-                fallback_opts['cookiesfrombrowser'] = ytdl_format_options['cookiesfrombrowser']
-            fallback_ytdl = yt_dlp.YoutubeDL(fallback_opts)
-            try:
-                data = await loop.run_in_executor(None, lambda: fallback_ytdl.extract_info(query, download=False))
-            except Exception as e2:
-                print(f"Fallback extraction failed: {e2}")
-                raise Exception("Could not extract video information. The video might be unavailable or restricted.")
+        data = await extract_with_strategy('resolve', query, guild_id=guild_id, priority=priority)
+    except Exception as e:
+        if key.startswith('yt:') and video_gone(e):
+            forget_video(key[len('yt:'):])
+        raise Exception("Could not extract video information. The video might be unavailable or restricted.")
 
-        if 'entries' in data:
-            data = data['entries'][0]
+    if 'entries' in data:
+        data = data['entries'][0]
 
-        if not data or not data.get('webpage_url'):
-            raise Exception("No valid video data found")
+    if not data or not data.get('webpage_url'):
+        raise Exception("No valid video data found")
 
-        song_info = {
-            'url': data['webpage_url'],
-            'title': custom_title or data.get('title', 'Unknown'),
-            'duration': data.get('duration', 0),
-            'thumbnail': data.get('thumbnail'),
-            'uploader': data.get('uploader', 'Unknown'),
-            'requester': ctx.author
-        }
+    resolution_cache.put(key, data)
+    return song_from_info(data, requester, custom_title)
 
-        queue = bot.get_queue(ctx.guild.id)
-        queue.append(song_info)
-
-        # If something is already playing or there are items ahead, just acknowledge
-        if not silent:
-            vc = ctx.voice_client
-            position = len(queue)
-            if (vc and (vc.is_playing() or vc.is_paused())) or position > 1:
-                embed = discord.Embed(
-                    title="📝 Added to Queue",
-                    description=f"**{song_info['title']}**\nPosition in queue: {position}",
-                    color=0x00ff00,
-                )
-                if song_info.get('thumbnail'):
-                    embed.set_thumbnail(url=song_info['thumbnail'])
-                embed.set_footer(text=f"Requested by {ctx.author.display_name}")
-                await ctx.send(embed=embed)
+def queue_songs(guild, channel, songs, requester_name, *, dedupe=False, announce=True):
+    """Add a batch of songs to a guild's queue; what every command queues through.
 
-        # Start playback if idle
-        vc = ctx.voice_client
-        if vc and not (vc.is_playing() or vc.is_paused()):
-            await play_next(ctx)
+    The player gets them in one enqueue_many() call, so playback is started
+    at most once. With `announce`, one "Added to Queue" message covers the
+    batch; a song that starts playing right away is left out of it, its
+    now-playing message says enough. Returns the songs that were added.
+    """
+    player = bot.get_player(guild)
+    starts_now = not player.active and not player.queue
+    position = len(player.queue) + 1
+    added = player.enqueue_many(songs, channel=channel, dedupe=dedupe)
+    if announce and added:
+        if starts_now:
+            added_later, position = added[1:], 1
+        else:
+            added_later = added
+        messages.announce_queued(channel, added_later, position, requester_name)
+    return added
+
+async def add_to_queue(ctx, query: str, custom_title: str | None = None, silent: bool = False):
+    """Resolve a query/URL to a song and add it to the guild queue. Starts playback if idle."""
+    try:
+        song_info = await resolve_song(query, ctx.author, custom_title, guild_id=ctx.guild.id)
+        queue_songs(ctx.guild, ctx.channel, [song_info], ctx.author.display_name, announce=not silent)
 
     except Exception as e:
         print(f"Error adding to queue: {e}")
@@ -540,6 +3479,216 @@ async def add_to_queue(ctx, query: str, custom_title: str | None = None, silent:
         )
         await ctx.send(embed=embed)
 
+async def import_tracks(ctx, name: str, tracks, status: discord.Message, total: int | None = None):
+    """Resolve playlist tracks concurrently and enqueue them in playlist order.
+
+    `tracks` may be a list or an async iterator (e.g. Spotify pages streaming
+    in); at most `total` (default PLAYLIST_MAX_TRACKS) are taken. Up to
+    PLAYLIST_CONCURRENCY tracks are looked up at once. A finished track is
+    queued as soon as every track before it is done, so playback starts with
+    the first song while the rest are still resolving. Progress goes into
+    `status`, which is edited in place.
+    """
+    limit = min(total or PLAYLIST_MAX_TRACKS, PLAYLIST_MAX_TRACKS)
+    semaphore = asyncio.Semaphore(PLAYLIST_CONCURRENCY)
+    results = []
+    finished = []
+    state = {'next': 0, 'added': 0, 'skipped': 0, 'done': 0, 'fed': False}
+    all_done = asyncio.Event()
+
+    async def resolve(index, track):
+        # The first track is what the guild will hear next; the rest is bulk work
+        priority = PRIORITY_PLAYBACK if index == 0 else PRIORITY_BULK
+        async with semaphore:
+            youtube_url = await search_youtube(track['search_query'], track=track,
+                                               guild_id=ctx.guild.id, priority=priority)
+            if not youtube_url:
+                return None
+            return await resolve_song(youtube_url, ctx.author, f"🎵 {track['name']} - {track['artist']}",
+                                      guild_id=ctx.guild.id, priority=priority)
+
+    def check_done():
+        if state['fed'] and state['done'] == len(finished):
+            all_done.set()
+
+    async def worker(index, track):
+        try:
+            results[index] = await resolve(index, track)
+        except Exception as e:
+            print(f"Could not resolve {track['search_query']}: {e}")
+            FAILURES.inc('playlist_track')
+        finished[index] = True
+        state['done'] += 1
+        # Queue every consecutive finished track from the front
+        songs = []
+        while state['next'] < len(finished) and finished[state['next']]:
+            song_info = results[state['next']]
+            results[state['next']] = None
+            state['next'] += 1
+            if song_info:
+                songs.append(song_info)
+        if songs:
+            # `status` is the import's acknowledgement; no per-song messages
+            added = queue_songs(ctx.guild, ctx.channel, songs, ctx.author.display_name,
+                                dedupe=DEDUPE_IMPORTS, announce=False)
+            state['added'] += len(added)
+            state['skipped'] += len(songs) - len(added)
+        check_done()
+
+    async def feed():
+        workers = []
+        try:
+            if hasattr(tracks, '__aiter__'):
+                async for track in tracks:
+                    if len(finished) >= limit:
+                        break
+                    results.append(None)
+                    finished.append(False)
+                    workers.append(asyncio.create_task(worker(len(finished) - 1, track)))
+            else:
+                for track in list(tracks)[:limit]:
+                    results.append(None)
+                    finished.append(False)
+                    workers.append(asyncio.create_task(worker(len(finished) - 1, track)))
+        except Exception as e:
+            print(f"Error reading playlist {name}: {e}")
+        finally:
+            if hasattr(tracks, 'aclose'):
+                await tracks.aclose()
+            state['fed'] = True
+            check_done()
+        await asyncio.gather(*workers)
+
+    async def report_progress():
+        """Edit progress into `status`; returns the last edit's task."""
+        last_edit = None
+        while not all_done.is_set():
+            try:
+                await asyncio.wait_for(all_done.wait(), PLAYLIST_PROGRESS_INTERVAL)
+            except asyncio.TimeoutError:
+                expected = len(finished) if state['fed'] else limit
+                embed = discord.Embed(title="🎵 Adding Playlist",
+                                      description=f"Resolved {state['done']}/{expected} tracks from **{name}** "
+                                                  f"({state['added']} queued)...",
+                                      color=0x1db954)
+                # Skip this update if the last one is still waiting out a rate limit
+                if last_edit is None or last_edit.done():
+                    last_edit = messages.submit(messages.edit(status, embed=embed))
+        return last_edit
+
+    reporter = asyncio.create_task(report_progress())
+    await feed()
+    last_edit = await reporter
+    if last_edit is not None:
+        # Let a late progress edit land before the final one, not after it
+        await last_edit
+
+    description = f"Added {state['added']} tracks from **{name}**"
+    if state['skipped']:
+        description += f" ({state['skipped']} already in the queue)"
+    embed = discord.Embed(title="✅ Playlist Added", description=description, color=0x00ff00)
+    if not await messages.edit(status, embed=embed):
+        await messages.send(ctx.channel, embed=embed)
+
+async def prematch_tracks(name: str, tracks, status: discord.Message, total: int | None = None):
+    """Match playlist tracks to YouTube videos ahead of time without queueing them.
+
+    Tracks already in the Spotify match index are only counted; the rest are
+    searched PLAYLIST_CONCURRENCY at a time at bulk priority, so guilds that
+    are playing go first. The result goes into `status`.
+    """
+    limit = min(total or PLAYLIST_MAX_TRACKS, PLAYLIST_MAX_TRACKS)
+    semaphore = asyncio.Semaphore(PLAYLIST_CONCURRENCY)
+    counts = {'known': 0, 'matched': 0, 'missing': 0}
+
+    async def match(track):
+        if spotify_matches.get(track):
+            counts['known'] += 1
+            return
+        async with semaphore:
+            youtube_url = await search_youtube(track['search_query'], track=track, priority=PRIORITY_BULK)
+        counts['matched' if youtube_url else 'missing'] += 1
+
+    workers = []
+    read_error = None
+    try:
+        async for track in tracks:
+            if len(workers) >= limit:
+                break
+            workers.append(asyncio.create_task(match(track)))
+    except Exception as e:
+        print(f"Error reading playlist {name}: {e}")
+        FAILURES.inc('spotify')
+        read_error = e
+    finally:
+        await tracks.aclose()
+    results = await asyncio.gather(*workers, return_exceptions=True)
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed:
+        print(f"{len(failed)} tracks of {name} could not be matched, e.g.: {failed[0]}")
+        FAILURES.inc('search')
+
+    description = (f"**{name}**: {counts['matched']} tracks matched, "
+                   f"{counts['known']} already known, {counts['missing']} not found on YouTube")
+    if failed:
+        description += f", {len(failed)} failed"
+    if read_error is not None:
+        description += f"\nStopped early, the playlist could not be read: {str(read_error)[:200]}"
+    embed = discord.Embed(title="✅ Playlist Matched", description=description, color=0x00ff00)
+    await messages.edit(status, embed=embed)
+
+# Running !prematch jobs, kept so they aren't garbage-collected mid-run
+prematch_tasks = set()
+
+def _prematch_finished(task, status):
+    prematch_tasks.discard(task)
+    if task.cancelled() or task.exception() is None:
+        return
+    print(f"Error matching playlist: {task.exception()}")
+    FAILURES.inc('spotify')
+    embed = discord.Embed(title="❌ Error", description=f"Matching failed: {str(task.exception())[:200]}",
+                          color=0xff0000)
+    messages.submit(messages.edit(status, embed=embed))
+
+async def import_youtube_playlist(ctx, url: str, *, start=1, skip_id=None):
+    """Queue a YouTube playlist or mix as placeholders, without extracting any video.
+
+    Only the first YOUTUBE_PLAYLIST_PAGE entries (from `start`) are listed
+    and queued now, so playback starts after a single flat extraction. The
+    rest (up to YOUTUBE_PLAYLIST_MAX_TRACKS) is handed to the guild's player
+    as a PlaylistFeed and listed a window at a time as the queue drains.
+    """
+    embed = discord.Embed(title="🎵 Adding YouTube Playlist", description="Listing the playlist...", color=0xff0000)
+    status = await ctx.send(embed=embed)
+    feed = PlaylistFeed(url, ctx.author.id, ctx.author.display_name, start=start, skip_id=skip_id)
+    try:
+        songs = await feed.next_window(ctx.guild.id, PRIORITY_PLAYBACK)
+    except Exception as e:
+        print(f"Error listing YouTube playlist {url}: {e}")
+        FAILURES.inc('youtube_playlist')
+        embed = discord.Embed(title="❌ Error", description=f"Could not load this playlist: {str(e)[:200]}",
+                              color=0xff0000)
+        await messages.edit(status, embed=embed)
+        return
+    queued = queue_songs(ctx.guild, ctx.channel, songs, ctx.author.display_name,
+                         dedupe=DEDUPE_IMPORTS, announce=False)
+    if not feed.done:
+        bot.get_player(ctx.guild).add_feed(feed)
+
+    description = f"Added {len(queued)} tracks from **{feed.name}**"
+    if len(songs) > len(queued):
+        description += f" ({len(songs) - len(queued)} already in the queue)"
+    if not feed.done:
+        description += "; the rest is added as the queue plays"
+    await messages.edit(status, embed=discord.Embed(title="✅ Playlist Added", description=description, color=0x00ff00))
+
+async def queue_from_watch_link(ctx, url: str):
+    """Queue the video of a watch?v=...&list=... link, then its playlist or mix after it."""
+    await add_to_queue(ctx, url)
+    index = parse_qs(urlparse(url.strip()).query).get('index', [''])[0]
+    start = int(index) + 1 if index.isdigit() else 1
+    await import_youtube_playlist(ctx, url, start=start, skip_id=_YOUTUBE_ID_RE.search(url).group(1))
+
 @bot.command(name='play', aliases=['p'])
 async def play(ctx, *, query):
     """Play music from YouTube or Spotify"""
@@ -553,7 +3702,7 @@ async def play(ctx, *, query):
 
     # Check if it's a Spotify URL
     if 'spotify.com' in query:
-        spotify_info = extract_spotify_info(query)
+        spotify_info = await extract_spotify_info(query)
         if not spotify_info:
             embed = discord.Embed(title="❌ Error", description="Invalid Spotify URL!", color=0xff0000)
             await ctx.send(embed=embed)
@@ -561,125 +3710,86 @@ async def play(ctx, *, query):
         
         if spotify_info['type'] == 'track':
             # Single track
-            youtube_url = await search_youtube(spotify_info['search_query'])
+            youtube_url = await search_youtube(spotify_info['search_query'], track=spotify_info,
+                                               guild_id=ctx.guild.id)
             if youtube_url:
                 await add_to_queue(ctx, youtube_url, f"🎵 {spotify_info['name']} - {spotify_info['artist']}")
             else:
                 embed = discord.Embed(title="❌ Error", description="Couldn't find this track on YouTube!", color=0xff0000)
                 await ctx.send(embed=embed)
         
-        elif spotify_info['type'] == 'playlist':
-            # Playlist
-            embed = discord.Embed(title="🎵 Adding Spotify Playlist", 
-                                description=f"Adding {len(spotify_info['tracks'])} tracks from **{spotify_info['name']}**...", 
+        else:
+            # Playlist, album, artist top tracks or several track links
+            embed = discord.Embed(title=f"🎵 Adding Spotify {SPOTIFY_IMPORT_TITLES[spotify_info['type']]}", 
+                                description=f"Adding {min(spotify_info['total'], PLAYLIST_MAX_TRACKS)} tracks from **{spotify_info['name']}**...", 
                                 color=0x1db954)
-            await ctx.send(embed=embed)
-            
-            added = 0
-            for track in spotify_info['tracks'][:50]:  # Limit to 50 tracks to avoid spam
-                youtube_url = await search_youtube(track['search_query'])
-                if youtube_url:
-                    await add_to_queue(ctx, youtube_url, f"🎵 {track['name']} - {track['artist']}", silent=True)
-                    added += 1
-            
-            embed = discord.Embed(title="✅ Playlist Added", 
-                                description=f"Added {added} tracks from **{spotify_info['name']}**", 
-                                color=0x00ff00)
-            await ctx.send(embed=embed)
+            status = await ctx.send(embed=embed)
+            await import_tracks(ctx, spotify_info['name'], spotify_info['tracks'], status, total=spotify_info['total'])
     
+    elif is_youtube_playlist_page(query):
+        await import_youtube_playlist(ctx, query)
+
+    elif is_youtube_mix(query):
+        await queue_from_watch_link(ctx, query)
+
     else:
         # YouTube URL or search query
         await add_to_queue(ctx, query)
 
-async def play_next(ctx):
-    """Play the next song in queue"""
-    queue = bot.get_queue(ctx.guild.id)
-    vc = ctx.voice_client
-
-    if not vc:
+@bot.command(name='playlist', aliases=['pl'])
+async def playlist(ctx, *, url: str):
+    """Queue the YouTube playlist a link belongs to; from a watch link, that video first"""
+    if not ctx.author.voice:
+        embed = discord.Embed(title="❌ Error", description="You need to be in a voice channel!", color=0xff0000)
+        await ctx.send(embed=embed)
         return
-
-    if not queue:
-        # Nothing to play; schedule cleanup if we're idle
-        if not vc.is_playing() and not vc.is_paused():
-            bot.schedule_cleanup(ctx.guild.id, random.randint(60, 120))
+    if not youtube_playlist_id(url):
+        embed = discord.Embed(title="❌ Error", description="Give a YouTube playlist or mix URL!", color=0xff0000)
+        await ctx.send(embed=embed)
         return
+    if not ctx.voice_client:
+        await join(ctx)
 
-    song_info = queue.popleft()
-    bot.current_song[ctx.guild.id] = song_info
-
-    try:
-        source = await YTDLSource.from_url(song_info['url'], loop=bot.loop, stream=True)
-
-        # Cancel any pending cleanup since music is resuming
-        bot.cancel_cleanup(ctx.guild.id)
-
-        # Remove any previous control panels so only the new message has buttons
-        await bot.remove_controls(ctx.guild.id)
-
-        def after_playing(error):
-            if error:
-                print(f'Player error: {error}')
-
-            # Handle loop mode
-            loop_mode = bot.loop_mode.get(ctx.guild.id, 0)
-            if loop_mode == 1:  # Loop current song
-                queue.appendleft(song_info)
-            elif loop_mode == 2:  # Loop queue
-                queue.append(song_info)
-
-            # Play next song (or schedule cleanup if ended)
-            coro = play_next(ctx)
-            fut = asyncio.run_coroutine_threadsafe(coro, bot.loop)
-            try:
-                fut.result()
-            except Exception as e:
-                print(f'Error in after_playing: {e}')
-
-        vc.play(source, after=after_playing)
-
-        # Send now playing message with control panel
-        embed = discord.Embed(
-            title="🎵 Now Playing",
-            description=f"**{song_info['title']}**",
-            color=0x00ff00,
-        )
-        if song_info.get('duration'):
-            embed.add_field(
-                name="Duration",
-                value=f"{song_info['duration'] // 60}:{song_info['duration'] % 60:02d}",
-                inline=True,
-            )
-        if song_info.get('uploader'):
-            embed.add_field(name="Uploader", value=song_info['uploader'], inline=True)
-        if song_info.get('thumbnail'):
-            embed.set_thumbnail(url=song_info['thumbnail'])
-        embed.set_footer(text=f"Requested by {song_info['requester'].display_name}")
-
-        view = MusicControlView(bot)
-        msg = await ctx.send(embed=embed, view=view)
-        bot.register_control_message(ctx.guild.id, msg)
+    if _YOUTUBE_ID_RE.search(url) is None:
+        await import_youtube_playlist(ctx, url)
+    else:
+        await queue_from_watch_link(ctx, url)
 
-    except Exception as e:
-        print(f"Error playing song: {e}")
-        await play_next(ctx)  # Try next song
+@bot.command(name='prematch')
+async def prematch(ctx, *, url: str):
+    """Match a Spotify playlist, album or artist to YouTube in the background so it queues instantly later"""
+    spotify_info = await extract_spotify_info(url)
+    if not spotify_info or spotify_info['type'] == 'track':
+        embed = discord.Embed(title="❌ Error", description="Give a Spotify playlist, album or artist URL!",
+                              color=0xff0000)
+        await ctx.send(embed=embed)
+        return
+    embed = discord.Embed(title=f"🔎 Matching Spotify {SPOTIFY_IMPORT_TITLES[spotify_info['type']]}",
+                          description=f"Matching {min(spotify_info['total'], PLAYLIST_MAX_TRACKS)} tracks from "
+                                      f"**{spotify_info['name']}** in the background...",
+                          color=0x1db954)
+    status = await ctx.send(embed=embed)
+    task = bot.loop.create_task(prematch_tracks(spotify_info['name'], spotify_info['tracks'], status,
+                                                total=spotify_info['total']))
+    prematch_tasks.add(task)
+    task.add_done_callback(lambda task: _prematch_finished(task, status))
 
 @bot.command(name='skip', aliases=['s'])
 async def skip(ctx):
     """Skip the current song"""
-    if not ctx.voice_client or not ctx.voice_client.is_playing():
+    if not ctx.voice_client or not await bot.get_player(ctx.guild).skip():
         embed = discord.Embed(title="❌ Error", description="Nothing is currently playing!", color=0xff0000)
         await ctx.send(embed=embed)
         return
     
-    ctx.voice_client.stop()
     embed = discord.Embed(title="⏭️ Skipped", description="Skipped the current song", color=0xff9900)
     await ctx.send(embed=embed)
 
 @bot.command(name='queue', aliases=['q'])
 async def show_queue(ctx):
     """Show the current queue"""
-    queue = bot.get_queue(ctx.guild.id)
+    player = bot.get_player(ctx.guild)
+    queue = player.queue
     
     if not queue:
         embed = discord.Embed(title="📝 Queue", description="The queue is empty!", color=0xff9900)
@@ -687,16 +3797,16 @@ async def show_queue(ctx):
         return
     
     # Show current song
-    current = bot.current_song.get(ctx.guild.id)
+    current = player.current
     embed = discord.Embed(title="📝 Music Queue", color=0x00ff00)
     
     if current:
-        embed.add_field(name="🎵 Now Playing", value=f"**{current['title']}**", inline=False)
+        embed.add_field(name="🎵 Now Playing", value=f"**{current.title}**", inline=False)
     
     # Show next 10 songs in queue
     queue_text = ""
     for i, song in enumerate(list(queue)[:10], 1):
-        queue_text += f"{i}. **{song['title']}**\n"
+        queue_text += f"{i}. **{song.title}**\n"
     
     if queue_text:
         embed.add_field(name="⏭️ Up Next", value=queue_text, inline=False)
@@ -709,8 +3819,7 @@ async def show_queue(ctx):
 @bot.command(name='clear')
 async def clear_queue(ctx):
     """Clear the queue"""
-    queue = bot.get_queue(ctx.guild.id)
-    queue.clear()
+    bot.get_player(ctx.guild).clear()
     
     embed = discord.Embed(title="🗑️ Queue Cleared", description="Cleared all songs from the queue", color=0xff9900)
     await ctx.send(embed=embed)
@@ -718,8 +3827,7 @@ async def clear_queue(ctx):
 @bot.command(name='pause')
 async def pause(ctx):
     """Pause the current song"""
-    if ctx.voice_client and ctx.voice_client.is_playing():
-        ctx.voice_client.pause()
+    if ctx.voice_client and await bot.get_player(ctx.guild).pause():
         embed = discord.Embed(title="⏸️ Paused", description="Paused the current song", color=0xff9900)
         await ctx.send(embed=embed)
     else:
@@ -729,8 +3837,7 @@ async def pause(ctx):
 @bot.command(name='resume')
 async def resume(ctx):
     """Resume the current song"""
-    if ctx.voice_client and ctx.voice_client.is_paused():
-        ctx.voice_client.resume()
+    if ctx.voice_client and await bot.get_player(ctx.guild).resume():
         embed = discord.Embed(title="▶️ Resumed", description="Resumed the current song", color=0x00ff00)
         await ctx.send(embed=embed)
     else:
@@ -741,8 +3848,7 @@ async def resume(ctx):
 async def stop(ctx):
     """Stop the current song and clear queue"""
     if ctx.voice_client:
-        ctx.voice_client.stop()
-        bot.get_queue(ctx.guild.id).clear()
+        await bot.get_player(ctx.guild).stop()
         
         embed = discord.Embed(title="⏹️ Stopped", description="Stopped playing and cleared the queue", color=0xff9900)
         await ctx.send(embed=embed)
@@ -759,7 +3865,7 @@ async def volume(ctx, volume: int = None):
         return
     
     if volume is None:
-        current_volume = int(ctx.voice_client.source.volume * 100)
+        current_volume = int(bot.get_player(ctx.guild).volume * 100)
         embed = discord.Embed(title="🔊 Current Volume", description=f"Volume is set to {current_volume}%", color=0x00ff00)
         await ctx.send(embed=embed)
         return
@@ -769,24 +3875,21 @@ async def volume(ctx, volume: int = None):
         await ctx.send(embed=embed)
         return
     
-    ctx.voice_client.source.volume = volume / 100
+    await bot.get_player(ctx.guild).set_volume(volume / 100)
     embed = discord.Embed(title="🔊 Volume Changed", description=f"Set volume to {volume}%", color=0x00ff00)
     await ctx.send(embed=embed)
 
 @bot.command(name='shuffle')
 async def shuffle(ctx):
     """Shuffle the queue"""
-    queue = bot.get_queue(ctx.guild.id)
+    player = bot.get_player(ctx.guild)
     
-    if len(queue) < 2:
+    if len(player.queue) < 2:
         embed = discord.Embed(title="❌ Error", description="Need at least 2 songs in queue to shuffle!", color=0xff0000)
         await ctx.send(embed=embed)
         return
     
-    queue_list = list(queue)
-    random.shuffle(queue_list)
-    queue.clear()
-    queue.extend(queue_list)
+    player.shuffle()
     
     embed = discord.Embed(title="🔀 Queue Shuffled", description="Shuffled the music queue", color=0x00ff00)
     await ctx.send(embed=embed)
@@ -801,8 +3904,9 @@ async def control_panel(ctx):
 @bot.command(name='loop')
 async def loop_command(ctx, mode: str = None):
     """Set loop mode: off, song, queue"""
+    player = bot.get_player(ctx.guild)
     if mode is None:
-        current_mode = bot.loop_mode.get(ctx.guild.id, 0)
+        current_mode = player.loop_mode
         modes = {0: "Off", 1: "Song", 2: "Queue"}
         embed = discord.Embed(title="🔁 Loop Mode", description=f"Current loop mode: **{modes[current_mode]}**", color=0x00ff00)
         await ctx.send(embed=embed)
@@ -810,13 +3914,13 @@ async def loop_command(ctx, mode: str = None):
     
     mode = mode.lower()
     if mode in ['off', '0']:
-        bot.loop_mode[ctx.guild.id] = 0
+        await player.set_loop(0)
         embed = discord.Embed(title="🔁 Loop Mode", description="Loop mode: **Off**", color=0xff9900)
     elif mode in ['song', '1']:
-        bot.loop_mode[ctx.guild.id] = 1
+        await player.set_loop(1)
         embed = discord.Embed(title="🔁 Loop Mode", description="Loop mode: **Song**", color=0x00ff00)
     elif mode in ['queue', '2']:
-        bot.loop_mode[ctx.guild.id] = 2
+        await player.set_loop(2)
         embed = discord.Embed(title="🔁 Loop Mode", description="Loop mode: **Queue**", color=0x00ff00)
     else:
         embed = discord.Embed(title="❌ Error", description="Invalid loop mode! Use: `off`, `song`, or `queue`", color=0xff0000)
@@ -826,7 +3930,8 @@ async def loop_command(ctx, mode: str = None):
 @bot.command(name='nowplaying', aliases=['np'])
 async def now_playing(ctx):
     """Show the currently playing song"""
-    current = bot.current_song.get(ctx.guild.id)
+    player = bot.get_player(ctx.guild)
+    current = player.current
     
     if not current or not ctx.voice_client or not ctx.voice_client.is_playing():
         embed = discord.Embed(title="❌ Error", description="Nothing is currently playing!", color=0xff0000)
@@ -834,22 +3939,22 @@ async def now_playing(ctx):
         return
     
     embed = discord.Embed(title="🎵 Now Playing", 
-                        description=f"**{current['title']}**", 
+                        description=f"**{current.title}**", 
                         color=0x00ff00)
     
-    if current.get('duration'):
-        embed.add_field(name="Duration", value=f"{current['duration'] // 60}:{current['duration'] % 60:02d}", inline=True)
-    if current.get('uploader'):
-        embed.add_field(name="Uploader", value=current['uploader'], inline=True)
+    if current.duration:
+        embed.add_field(name="Duration", value=f"{current.duration // 60}:{current.duration % 60:02d}", inline=True)
+    if current.uploader:
+        embed.add_field(name="Uploader", value=current.uploader, inline=True)
     
     # Show loop mode
-    loop_mode = bot.loop_mode.get(ctx.guild.id, 0)
+    loop_mode = player.loop_mode
     loop_modes = {0: "Off", 1: "Song", 2: "Queue"}
     embed.add_field(name="Loop", value=loop_modes[loop_mode], inline=True)
     
-    if current.get('thumbnail'):
-        embed.set_thumbnail(url=current['thumbnail'])
-    embed.set_footer(text=f"Requested by {current['requester'].display_name}")
+    if current.thumbnail:
+        embed.set_thumbnail(url=current.thumbnail)
+    embed.set_footer(text=f"Requested by {current.requester_name}")
     
     await ctx.send(embed=embed)
 
@@ -864,42 +3969,21 @@ async def force_play(ctx, *, query):
     if not ctx.voice_client:
         await join(ctx)
     
-    # Use alternative ytdl settings for problematic videos
-    alternative_ytdl = yt_dlp.YoutubeDL({
-        'format': 'worst[ext=mp4]/worst[ext=webm]/worst',
-        'quiet': True,
-        'no_warnings': True,
-        'default_search': 'ytsearch',
-        'ignoreerrors': True,
-        'extract_flat': False
-    })
-    
     try:
-        loop = asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: alternative_ytdl.extract_info(query, download=False))
+        # Use alternative ytdl settings for problematic videos
+        data = await extract_info(query, profile='forceplay', guild_id=ctx.guild.id)
         
         if 'entries' in data:
             data = data['entries'][0]
         
-        song_info = {
-            'url': data['webpage_url'],
-            'title': data.get('title', 'Unknown'),
-            'duration': data.get('duration', 0),
-            'thumbnail': data.get('thumbnail'),
-            'uploader': data.get('uploader', 'Unknown'),
-            'requester': ctx.author
-        }
+        song_info = song_from_info(data, ctx.author)
         
-        queue = bot.get_queue(ctx.guild.id)
-        queue.append(song_info)
+        queue_songs(ctx.guild, ctx.channel, [song_info], ctx.author.display_name, announce=False)
         
         embed = discord.Embed(title="🔧 Force Added to Queue", 
-                            description=f"**{song_info['title']}**\nUsed alternative extraction method", 
+                            description=f"**{song_info.title}**\nUsed alternative extraction method", 
                             color=0x00ff00)
         await ctx.send(embed=embed)
-        
-        if not ctx.voice_client.is_playing():
-            await play_next(ctx)
             
     except Exception as e:
         embed = discord.Embed(title="❌ Force Play Failed", 
@@ -911,8 +3995,7 @@ async def force_play(ctx, *, query):
 async def test_video(ctx, *, url):
     """Test if a video URL works"""
     try:
-        loop = asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=False))
+        data = await extract_info(url, guild_id=ctx.guild.id, priority=PRIORITY_DEBUG)
         
         if 'entries' in data:
             data = data['entries'][0]
@@ -937,8 +4020,7 @@ async def test_video(ctx, *, url):
 async def list_formats(ctx, *, url: str):
     """List available formats for a YouTube URL (debugging helper)."""
     try:
-        loop = asyncio.get_event_loop()
-        info = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=False))
+        info = await extract_info(url, guild_id=ctx.guild.id, priority=PRIORITY_DEBUG)
         if 'formats' not in info:
             raise Exception('No formats available')
         lines = []
@@ -957,6 +4039,78 @@ async def list_formats(ctx, *, url: str):
     except Exception as e:
         await ctx.send(f"Failed to list formats: {e}")
 
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+@bot.command(name='stats')
+async def playback_stats(ctx):
+    """Show playback latency statistics (debugging helper)."""
+    embed = discord.Embed(title="📊 Playback Stats", color=0x00ff00)
+    lines = []
+    for kind, samples in bot.ttfa_samples.items():
+        if samples:
+            p50 = _percentile(samples, 50)
+            p90 = _percentile(samples, 90)
+            lines.append(f"{kind}: n={len(samples)} p50={p50:.2f}s p90={p90:.2f}s")
+        else:
+            lines.append(f"{kind}: no samples")
+    embed.add_field(name="Time to first audio", value="\n".join(lines), inline=False)
+    cache = resolution_cache.stats()
+    embed.add_field(
+        name="Resolution cache",
+        value=f"{cache['entries']} entries, {cache['hits']} hits / {cache['misses']} misses "
+              f"({cache['hit_rate']:.0%}), {cache['evictions']} evicted",
+        inline=False,
+    )
+    matches = spotify_matches.stats()
+    embed.add_field(
+        name="Spotify matches",
+        value=f"{matches['entries']} tracks, {matches['hits']} hits / {matches['misses']} misses, "
+              f"{matches['weak']} too weak, {matches['invalidated']} invalidated",
+        inline=False,
+    )
+    files = audio_cache.stats()
+    embed.add_field(
+        name="Audio cache",
+        value=f"{files['files']} files, {files['bytes'] / 1024 / 1024:.0f} MB, "
+              f"{files['hits']} hits / {files['misses']} misses ({files['hit_rate']:.0%}), "
+              f"{files['downloads']} downloaded, {files['evictions']} evicted",
+        inline=False,
+    )
+    flights = extraction_flights.stats()
+    embed.add_field(
+        name="Coalesced extractions",
+        value=f"{flights['saved']} of {flights['calls']} extraction requests shared an in-flight one",
+        inline=False,
+    )
+    sched = extraction_scheduler.stats()
+    queued = ", ".join(f"{name} {count}" for name, count in sched['queued'].items())
+    peak = ", ".join(f"{name} {count}" for name, count in sched['max_queued'].items())
+    embed.add_field(
+        name="Extraction pool",
+        value=f"{sched['active']}/{sched['workers']} {sched['mode']} workers busy, {sched['waiting_guilds']} guilds waiting\n"
+              f"Queued: {queued}\nPeak queued: {peak}",
+        inline=False,
+    )
+    if sched['mode'] == 'thread':
+        pools = ", ".join(f"{profile} {pool.stats()['idle']}/{pool.stats()['built']}"
+                          for profile, pool in ytdl_pools.items() if pool.built)
+        embed.add_field(name="YoutubeDL instances (idle/built)", value=pools or "none built yet", inline=False)
+    strategies = [
+        f"{profile}: {entry['successes']}/{entry['attempts']} ok, "
+        f"{entry['seconds'] / entry['attempts']:.2f}s avg" + (" (skipped, failing)" if entry['open'] else "")
+        for profile, entry in extraction_strategies.stats().items() if entry['attempts']
+    ]
+    embed.add_field(name="Extraction profiles", value="\n".join(strategies) or "no attempts yet", inline=False)
+    phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_seconds.items())
+    embed.add_field(name="Startup", value=phases or "-", inline=False)
+    latencies = ", ".join(f"#{shard_id} {latency * 1000:.0f} ms" for shard_id, latency in bot.latencies)
+    embed.add_field(name=f"Shards ({bot.shard_count} total)", value=latencies or "not connected", inline=False)
+    await ctx.send(embed=embed)
+
 @bot.command(name='commands')
 async def help_command(ctx):
     """Show all available commands"""
@@ -967,6 +4121,7 @@ async def help_command(ctx):
     commands_list = [
         ("**Music Commands**", ""),
         ("`!play <song/url>`", "Play music from YouTube or Spotify"),
+        ("`!playlist <youtube url>`", "Queue a YouTube playlist or mix, from the linked video on"),
         ("`!forceplay <song/url>`", "Force play with alternative method"),
         ("`!skip`", "Skip the current song"),
         ("`!pause`", "Pause the current song"),
@@ -985,14 +4140,16 @@ async def help_command(ctx):
         ("`!leave`", "Leave the voice channel"),
         ("", ""),
         ("**Utilities**", ""),
+        ("`!prematch <playlist/album url>`", "Match Spotify tracks to YouTube ahead of time"),
         ("`!test <url>`", "Test if a video URL works"),
+        ("`!stats`", "Show playback latency statistics"),
         ("`!commands`", "Show this help message")
     ]
     
     for name, value in commands_list:
         embed.add_field(name=name, value=value, inline=False)
     
-    embed.set_footer(text="Supports YouTube URLs, YouTube searches, Spotify tracks, and Spotify playlists!")
+    embed.set_footer(text="Supports YouTube URLs, YouTube searches, and Spotify tracks, playlists, albums and artists!")
     await ctx.send(embed=embed)
 
 # Error handling
@@ -1008,9 +4165,21 @@ async def on_command_error(ctx, error):
                             description=f"Missing required argument: {error.param}", 
                             color=0xff0000)
         await ctx.send(embed=embed)
+    elif isinstance(error, commands.CommandInvokeError) and isinstance(error.original, SpotifyAuthError):
+        print(f"Spotify error: {error.original}")
+        FAILURES.inc('spotify')
+        embed = discord.Embed(title="❌ Spotify Unavailable",
+                              description=f"{error.original}. Ask the bot owner to check SPOTIFY_CLIENT_ID "
+                                          f"and SPOTIFY_CLIENT_SECRET.",
+                              color=0xff0000)
+        await ctx.send(embed=embed)
     else:
         print(f"An error occurred: {error}")
 
+# Extraction worker processes import this module too; only the bot itself reports startup
+if multiprocessing.current_process().name == 'MainProcess':
+    mark_startup('import')
+
 if __name__ == "__main__":
     if not DISCORD_TOKEN:
         print("ERROR: Discord token not found! Please check your .env file.")
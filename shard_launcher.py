@@ -0,0 +1,124 @@
+"""Run the bot as several processes, each handling a cluster of shards.
+
+    python shard_launcher.py                      # Discord's recommended shard count
+    python shard_launcher.py --shards 16 --per-process 4
+
+Every process runs music_bot.py with SHARD_COUNT and SHARD_IDS set, so it
+gets its own event loop, GIL and extraction pool. The processes share the
+SQLite cache (CACHE_DB_PATH) and the audio cache directory. A process that
+exits is started again; Ctrl+C stops them all.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'music_bot.py')
+GATEWAY_URL = 'https://discord.com/api/v10/gateway/bot'
+# Discord allows one shard to identify every 5 seconds (per concurrency bucket)
+IDENTIFY_INTERVAL = 5.0
+# Seconds before restarting a process that exited, doubled for each quick crash
+RESTART_DELAY = 5.0
+RESTART_DELAY_MAX = 300.0
+
+def recommended_shards(token):
+    request = urllib.request.Request(GATEWAY_URL, headers={
+        'Authorization': f'Bot {token}',
+        'User-Agent': 'DiscordBot (https://github.com/Rapptz/discord.py, 2.0)',
+    })
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)['shards']
+
+def shard_clusters(shard_count, per_process):
+    """Split shard IDs 0..shard_count-1 into consecutive groups of `per_process`."""
+    return [list(range(start, min(start + per_process, shard_count))) for start in range(0, shard_count, per_process)]
+
+class Cluster:
+    def __init__(self, index, shard_ids, shard_count):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.started = 0.0
+        self.restart_at = None
+        self.delay = RESTART_DELAY
+
+    def start(self):
+        env = dict(os.environ, SHARD_COUNT=str(self.shard_count), SHARD_IDS=','.join(map(str, self.shard_ids)))
+        metrics_port = int(os.getenv('METRICS_PORT', '9108'))
+        if metrics_port:
+            # One metrics endpoint per process: METRICS_PORT, METRICS_PORT + 1, ...
+            env['METRICS_PORT'] = str(metrics_port + self.index)
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+        self.started = time.monotonic()
+        self.restart_at = None
+        print(f'[launcher] cluster {self.index} (shards {self.shard_ids}) started as pid {self.process.pid}')
+
+    def check(self):
+        """Restart the process if it has exited; call periodically."""
+        now = time.monotonic()
+        if self.restart_at is not None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            return
+        if now - self.started >= 60:
+            self.delay = RESTART_DELAY
+        self.restart_at = now + self.delay
+        print(f'[launcher] cluster {self.index} exited with code {code}, restarting in {self.delay:.0f}s')
+        # Back off while it keeps crashing right after start
+        self.delay = min(self.delay * 2, RESTART_DELAY_MAX)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Run the music bot as multiple shard processes.')
+    parser.add_argument('--shards', type=int, default=int(os.getenv('SHARD_COUNT') or 0),
+                        help='total shard count (default: SHARD_COUNT or Discord\'s recommendation)')
+    parser.add_argument('--per-process', type=int, default=int(os.getenv('SHARDS_PER_PROCESS', '4')),
+                        help='shards run by each process (default: SHARDS_PER_PROCESS or 4)')
+    args = parser.parse_args()
+
+    shard_count = args.shards
+    if not shard_count:
+        token = os.getenv('DISCORD_TOKEN')
+        if not token:
+            print("ERROR: Discord token not found! Please check your .env file.")
+            return
+        shard_count = recommended_shards(token)
+    clusters = [
+        Cluster(index, shard_ids, shard_count)
+        for index, shard_ids in enumerate(shard_clusters(shard_count, max(1, args.per_process)))
+    ]
+    print(f'[launcher] {shard_count} shards in {len(clusters)} processes')
+
+    try:
+        for cluster in clusters:
+            cluster.start()
+            # Each process identifies its shards one by one; don't overlap with the next
+            time.sleep(IDENTIFY_INTERVAL * len(cluster.shard_ids))
+        while True:
+            time.sleep(1)
+            for cluster in clusters:
+                cluster.check()
+    except KeyboardInterrupt:
+        print('[launcher] stopping')
+    finally:
+        for cluster in clusters:
+            cluster.stop()
+        for cluster in clusters:
+            if cluster.process:
+                cluster.process.wait()
+
+if __name__ == '__main__':
+    main()